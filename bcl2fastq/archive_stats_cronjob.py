@@ -183,9 +183,6 @@ def main():
                         logger.fatal("MongoDB OperationFailure")
                         sys.exit(0)
                     num_triggers += 1
-
-    # close the connection to MongoDB
-    connection.close()
     logger.info("%s dirs with triggers", num_triggers)
 
 
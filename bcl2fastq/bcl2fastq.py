@@ -50,7 +50,7 @@ __license__ = "The MIT License (MIT)"
 yaml.Dumper.ignore_aliases = lambda *args: True
 
 
-PIPELINE_BASEDIR = os.path.dirname(sys.argv[0])
+PIPELINE_BASEDIR = os.path.dirname(os.path.realpath(__file__))
 CFG_DIR = os.path.join(PIPELINE_BASEDIR, "cfg")
 
 # same as folder name. also used for cluster job names
@@ -165,7 +165,7 @@ def main():
 
     # FIXME ugly and code duplication in bcl2fastq_dbupdate.py
     mongo_status_script = os.path.abspath(os.path.join(
-        os.path.dirname(sys.argv[0]), "mongo_status.py"))
+        PIPELINE_BASEDIR, "mongo_status.py"))
     assert os.path.exists(mongo_status_script)
 
     default_parser = default_argparser(
@@ -262,7 +262,7 @@ def main():
     #
     # FIXME ugly assumes same directory (just like import above). better to import and run main()?
     generate_bcl2fastq = os.path.join(
-        os.path.dirname(sys.argv[0]), "generate_bcl2fastq_cfg.py")
+        PIPELINE_BASEDIR, "generate_bcl2fastq_cfg.py")
     assert os.path.exists(generate_bcl2fastq)
     cmd = [generate_bcl2fastq, '-r', rundir, '-o', outdir]
     if args.testing:
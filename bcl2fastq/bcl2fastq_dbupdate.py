@@ -11,11 +11,11 @@ import sys
 import os
 import argparse
 import logging
-import subprocess
 from datetime import datetime
 
 #--- third-party imports
 #
+import pymongo
 import yaml
 ## only dump() and following do not automatically create aliases
 yaml.Dumper.ignore_aliases = lambda *args: True
@@ -28,9 +28,15 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import runcomplete_set_run_status
+from mongodb import runcomplete_add_mux_status
 from pipelines import generate_window
+from pipelines import is_production_user
 from pipelines import PipelineHandler
 from utils import timestamp_from_string
+from utils import generate_timestamp
+from utils import read_cache
+from utils import write_cache
 
 
 __author__ = "Andreas Wilm"
@@ -43,6 +49,9 @@ DBUPDATE_TRIGGER_FILE_FMT = "TRIGGER.DBUPDATE.{num}"
 # up to DBUPDATE_TRIGGER_FILE_MAXNUM trigger files allowed
 DBUPDATE_TRIGGER_FILE_MAXNUM = 9
 
+# bump if format of checkpoints changes
+CHECKPOINT_CACHE_KEY = 1
+
 
 BASEDIR = os.path.dirname(sys.argv[0])
 
@@ -57,7 +66,9 @@ logger.addHandler(handler)
 
 
 class MongoUpdate(object):
-    """Helper class for mongodb updates
+    """Helper class for mongodb updates. Updates are done in-process
+    on a shared connection (see mongo_status.py and
+    mongo_status_per_mux.py for the command line equivalents)
     """
 
     def __init__(self, run_num, analysis_id, testing=False, dryrun=False):
@@ -66,41 +77,41 @@ class MongoUpdate(object):
         self.testing = testing
         self.dryrun = dryrun
 
-        mongo_status_script = os.path.abspath(os.path.join(
-            os.path.dirname(sys.argv[0]), "mongo_status.py"))
-        assert os.path.exists(mongo_status_script), (
-            "Missing {}".format(mongo_status_script))
-        self.mongo_status_script = mongo_status_script
 
-        mongo_status_per_mux_script = os.path.abspath(os.path.join(
-            os.path.dirname(sys.argv[0]), "mongo_status_per_mux.py"))
-        assert os.path.exists(mongo_status_per_mux_script), (
-            "Missing {}".format(mongo_status_per_mux_script))
-        self.mongo_status_per_mux_script = mongo_status_per_mux_script
+    def _db(self):
+        """runcomplete collection or None if updates are not allowed
+        """
+        if not is_production_user():
+            logger.warning("Not a production user. Skipping MongoDB update")
+            return None
+        connection = mongodb_conn(self.testing)
+        if connection is None:
+            return None
+        return connection.gisds.runcomplete
 
 
     def update_run(self, status, outdir):
         """update status for run
         """
         logger.info("Updating status for run %s analysis %s to %s",
-                    self.analysis_id, self.run_num, status)
-        cmd = [self.mongo_status_script, '-r', self.run_num,
-               '-a', self.analysis_id, '-s', status, '-o', outdir]
-
-        if self.testing:
-            cmd.append("-t")
-        if self.dryrun:
-            cmd.append("--dry-run")
-
-        try:
-            _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            logger.critical("The following command failed with return code %s: %s",
-                            e.returncode, ' '.join(cmd))
-            logger.critical("Output: %s", e.output.decode())
+                    self.run_num, self.analysis_id, status)
+        db = self._db()
+        if db is None:
             return False
+        if status in ["SUCCESS", "FAILED"]:
+            end_time = generate_timestamp()
         else:
+            end_time = None
+        if self.dryrun:
             return True
+        try:
+            runcomplete_set_run_status(db, self.run_num, self.analysis_id, status,
+                                       outdir, end_time=end_time)
+        except (pymongo.errors.OperationFailure, AssertionError) as e:
+            logger.critical("MongoDB update failure while setting run %s analysis_id %s to %s: %s",
+                            self.run_num, self.analysis_id, status, e)
+            return False
+        return True
 
 
     def update_mux(self, status, mux_id, mux_dir):
@@ -108,24 +119,20 @@ class MongoUpdate(object):
         """
         logger.info("Updating status for mux %s of analysis %s in run %s to %s",
                     mux_id, self.analysis_id, self.run_num, status)
-        cmd = [self.mongo_status_per_mux_script, '-r', self.run_num,
-               '-a', self.analysis_id, '-s', status,
-               '-i', mux_id, '-d', mux_dir]
-
-        if self.testing:
-            cmd.append("-t")
+        db = self._db()
+        if db is None:
+            return False
         if self.dryrun:
-            cmd.append("--dry-run")
-
+            return True
         try:
-            _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            logger.critical("The following command failed with return code %s: %s",
-                            e.returncode, ' '.join(cmd))
-            logger.critical("Output: %s", e.output.decode())
+            runcomplete_add_mux_status(db, self.run_num, self.analysis_id,
+                                       mux_id, mux_dir, status)
+        except pymongo.errors.OperationFailure as e:
+            logger.critical("MongoDB update failure while setting mux %s of run %s"
+                            " analysis_id %s to %s: %s",
+                            mux_id, self.run_num, self.analysis_id, status, e)
             return False
-        else:
-            return True
+        return True
 
 
 def get_started_outdirs_from_db(testing=True, win=None):
@@ -153,40 +160,167 @@ def get_started_outdirs_from_db(testing=True, win=None):
             yield analysis["out_dir"]
 
 
-def mux_dir_complete(muxdir, completed_after=None):
+def list_dir(path):
+    """Return dict of file name to os.DirEntry for all entries of path,
+    using a single directory listing. Returns None if path doesn't exist
+    """
+    try:
+        with os.scandir(path) as it:
+            return dict((entry.name, entry) for entry in it)
+    except FileNotFoundError:
+        return None
+
+
+def find_trigger_files(outdir, entries=None):
+    """Return trigger files in outdir in processing order. entries as
+    returned by list_dir() can be passed to avoid listing again
+    """
+    if entries is None:
+        entries = list_dir(outdir) or dict()
+    trigger_files = []
+    for i in range(DBUPDATE_TRIGGER_FILE_MAXNUM+1):
+        # multiple trigger files per directory allowed (but rare)
+        name = DBUPDATE_TRIGGER_FILE_FMT.format(num=i)
+        if name in entries:
+            trigger_files.append(os.path.join(outdir, name))
+    return trigger_files
+
+
+def mux_dir_complete(muxdir, completed_after=None, entries=None):
     """Will check whether necessary flag files for muxdir exist. Will
     return false if one is missing.  If completed_after is given or if
-    both exist, but none is newer than completed_after.
+    both exist, but none is newer than completed_after. entries as
+    returned by list_dir() can be passed to avoid listing again
 
     """
 
-    if not os.path.exists(muxdir):
+    if entries is None:
+        entries = list_dir(muxdir)
+    if entries is None:
         logger.info("Directory %s doesn't exist", muxdir)
         return False
 
     at_least_one_newer = False
     for f in ['bcl2fastq.SUCCESS', 'fastqc.SUCCESS']:
-        f = os.path.join(muxdir, f)
-        if not os.path.exists(f):
+        if f not in entries:
             logger.debug("mux dir %s incomplete: %s is missing", muxdir, f)
             return False
         if completed_after:
-            if datetime.fromtimestamp(os.path.getmtime(f)) > completed_after:
+            if datetime.fromtimestamp(entries[f].stat().st_mtime) > completed_after:
                 at_least_one_newer = True
     if completed_after and not at_least_one_newer:
         return False
     return True
 
 
+def checkpoint_cache_name(testing):
+    """Name of the cache holding per outdir scan checkpoints"""
+    return "bcl2fastq_dbupdate:checkpoints:{}".format(
+        "testing" if testing else "production")
+
+
+def read_checkpoints(testing):
+    """Return dict of outdir to directory mtime (ns) at the last scan
+    after which nothing was left to do
+    """
+    return read_cache(checkpoint_cache_name(testing), CHECKPOINT_CACHE_KEY) or dict()
+
+
+def write_checkpoints(testing, checkpoints):
+    """Store checkpoints as returned by read_checkpoints()"""
+    write_cache(checkpoint_cache_name(testing), CHECKPOINT_CACHE_KEY, checkpoints)
+
+
+def dir_mtime_ns(path):
+    """Modification time of path in ns or None if it doesn't exist.
+    Changes whenever a (trigger) file is created or deleted in path
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def process_outdir(outdir, testing=False, dryrun=False):
+    """Process trigger files in outdir. Returns number of trigger
+    files found and whether all of them were processed
+    successfully (i.e. nothing left to do)
+    """
+
+    trigger_files = find_trigger_files(outdir)
+    if not trigger_files:
+        return 0, True
+
+    # load mux info from config instead of relying on filesystem
+    #
+    logger.debug("Loading config for %s", outdir)
+    config_file = os.path.join(outdir, PipelineHandler.PIPELINE_CFGFILE)
+    if not os.path.exists(config_file):
+        logger.critical("Missing config file %s. Skipping this directory", config_file)
+        return len(trigger_files), False
+    with open(config_file) as fh:
+        cfg = yaml.safe_load(fh)
+    muxes = dict([(x['mux_id'], x['mux_dir']) for x in cfg['units'].values()])
+
+    # use info in trigger files for update and delete
+    #
+    all_done = True
+    for trigger_file in trigger_files:
+        logger.debug("Processing trigger file %s", trigger_file)
+        with open(trigger_file) as fh:
+            update_info = yaml.safe_load(fh)
+
+        mongo_updater = MongoUpdate(update_info['run_num'],
+                                    update_info['analysis_id'],
+                                    testing, dryrun)
+
+        res = mongo_updater.update_run(update_info['status'], outdir)
+        if not res:
+            # don't delete trigger. don't processe muxes. try again later
+            logger.critical("Skipping this analysis (%s) for run %s",
+                            update_info['analysis_id'], update_info['run_num'])
+            all_done = False
+            continue
+
+        # update per MUX
+        #
+        keep_trigger = False
+        for mux_id, mux_dir_base in muxes.items():
+            mux_dir = os.path.join(outdir, "out", mux_dir_base)# ugly
+            # listed once for both checks
+            mux_entries = list_dir(mux_dir)
+            if mux_dir_complete(mux_dir, entries=mux_entries):
+                # skip the ones completed before
+                completed_after = timestamp_from_string(update_info['analysis_id'])
+                if not mux_dir_complete(mux_dir, completed_after=completed_after,
+                                        entries=mux_entries):
+                    continue
+                no_archive = cfg.get('no_archive', None)
+                if no_archive:
+                    status = 'NOARCHIVE'
+                else:
+                    status = 'SUCCESS'
+            else:
+                status = 'FAILED'
+
+            res = mongo_updater.update_mux(status, mux_id, mux_dir_base)
+            if not res:
+                # don't delete trigger. try again later
+                logger.critical("Skipping rest of analysis %s for run %s",
+                                update_info['analysis_id'], update_info['run_num'])
+                keep_trigger = True
+                break
+
+        if keep_trigger or dryrun:
+            all_done = False
+        else:
+            os.unlink(trigger_file)
+    return len(trigger_files), all_done
+
+
 def main():
     """main function
     """
-    # FIXME ugly and duplicated in bcl2fastq.py
-    mongo_status_per_mux_script = os.path.abspath(os.path.join(
-        os.path.dirname(sys.argv[0]), "mongo_status_per_mux.py"))
-    assert os.path.exists(mongo_status_per_mux_script)
-    assert os.path.exists(mongo_status_per_mux_script)
-
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-t', "--testing", action='store_true',
                         help="Use MongoDB test server")
@@ -195,6 +329,9 @@ def main():
     parser.add_argument('--outdirs', nargs="*",
                         help="Ignore DB entries and go through this list"
                         " of directories (DEBUGGING)")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="Skip output directories that haven't changed"
+                        " since the last scan after which nothing was left to do")
     parser.add_argument('-n', '--dry-run', action='store_true')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
@@ -221,73 +358,32 @@ def main():
         # generator!
         outdirs = get_started_outdirs_from_db(args.testing, args.win)
 
+    if args.incremental:
+        checkpoints = read_checkpoints(args.testing)
     num_triggers = 0
+    num_skipped = 0
     for outdir in outdirs:
-
-        # load mux info from config instead of relying on filesystem
-        #
-        logger.debug("Loading config for %s", outdir)
-        config_file = os.path.join(outdir, PipelineHandler.PIPELINE_CFGFILE)
-        if not os.path.exists(config_file):
-            logger.critical("Missing config file %s. Skipping this directory", config_file)
-            continue
-        with open(config_file) as fh:
-            cfg = yaml.safe_load(fh)
-        muxes = dict([(x['mux_id'], x['mux_dir']) for x in cfg['units'].values()])
-
-        # look for trigger files. use their info for update and delete
-        #
-        for i in range(DBUPDATE_TRIGGER_FILE_MAXNUM+1):
-            # multiple trigger files per directory allowed (but rare)
-            trigger_file = os.path.join(outdir, DBUPDATE_TRIGGER_FILE_FMT.format(num=i))
-            if not os.path.exists(trigger_file):
+        if args.incremental:
+            mtime = dir_mtime_ns(outdir)
+            if mtime is not None and checkpoints.get(outdir) == mtime:
+                logger.debug("%s unchanged since last scan. Skipping", outdir)
+                num_skipped += 1
                 continue
 
-            logger.debug("Processing trigger file %s", trigger_file)
-            num_triggers += 1
-            with open(trigger_file) as fh:
-                update_info = yaml.safe_load(fh)
-
-            mongo_updater = MongoUpdate(update_info['run_num'],
-                                        update_info['analysis_id'],
-                                        args.testing, args.dry_run)
+        n, all_done = process_outdir(outdir, args.testing, args.dry_run)
+        num_triggers += n
 
-            res = mongo_updater.update_run(update_info['status'], outdir)
-            if not res:
-                # don't delete trigger. don't processe muxes. try again later
-                logger.critical("Skipping this analysis (%s) for run %s",
-                                update_info['analysis_id'], update_info['run_num'])
-                continue
+        if args.incremental:
+            if all_done:
+                # stat again: deleting triggers changes the mtime
+                checkpoints[outdir] = dir_mtime_ns(outdir)
+            else:
+                checkpoints.pop(outdir, None)
 
-            # update per MUX
-            #
-            keep_trigger = False
-            for mux_id, mux_dir_base in muxes.items():
-                mux_dir = os.path.join(outdir, "out", mux_dir_base)# ugly
-                if mux_dir_complete(mux_dir):
-                    # skip the ones completed before
-                    completed_after = timestamp_from_string(update_info['analysis_id'])
-                    if not mux_dir_complete(mux_dir, completed_after=completed_after):
-                        continue
-                    no_archive = cfg.get('no_archive', None)
-                    if no_archive:
-                        status = 'NOARCHIVE'
-                    else:
-                        status = 'SUCCESS'
-                else:
-                    status = 'FAILED'
-
-                res = mongo_updater.update_mux(status, mux_id, mux_dir_base)
-                if not res:
-                    # don't delete trigger. try again later
-                    logger.critical("Skipping rest of analysis %s for run %s",
-                                    update_info['analysis_id'], update_info['run_num'])
-                    keep_trigger = True
-                    break
-
-            if not args.dry_run and not keep_trigger:
-                os.unlink(trigger_file)
-    logger.info("%s dirs with triggers", num_triggers)
+    if args.incremental:
+        write_checkpoints(args.testing, checkpoints)
+        logger.info("%s dirs unchanged since last scan", num_skipped)
+    logger.info("%s trigger files processed", num_triggers)
 
 if __name__ == "__main__":
     main()
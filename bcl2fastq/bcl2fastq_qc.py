@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """Bcl2fastq QC checks
 
+Demux stats are loaded with demux_stats.py, i.e. from Stats.json if
+present and the html reports otherwise. The notes below apply to both.
+
 We are running bcl2fastq per MUX, hence one demux html input
 corresponds to one MUX. Since a single lane cannot hold more than one
 MUX, the lane info contained in one html is complete. In other words,
@@ -22,10 +25,7 @@ default/Undetermined/unknown/lane.html
 #
 import sys
 import os
-import glob
-import re
 import pprint
-from collections import OrderedDict
 import argparse
 import logging
 
@@ -35,7 +35,8 @@ import yaml
 
 #--- project specific imports
 #
-from html_table_parser import HTMLTableParser
+from demux_stats import load_run_demux_stats
+from demux_stats import project_dirs_for_bcl2fastq_dir
 # add lib dir for this pipeline installation to PYTHONPATH
 LIB_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
@@ -61,9 +62,6 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
-DEMUX_HTML_FILE_PATTERN = r'.*Project_(\w+)/html/([\w-]+)/\w+/\w+/\w+/lane.html'
-
-
 def get_machine_type_from_run_num(run_num):
     """these are the values to be used in config for machine dependent settings"""
     id_to_machine = {
@@ -105,137 +103,14 @@ def email_qcfails(subject, body):
     send_mail(subject, body, toaddr=toaddr, ccaddr=ccaddr,
               pass_exception=False)
 
-def htmlparser_demux_table_to_dict(table_in, decimal_mark=".", thousands_sep=","):
-    """cleans raw bcl2fastq html table formatting as created by htmlparser
-    and converts to OrderedDict using sequential row numbers as first
-    key (i.e. row[0][key] = value)
-    """
-
-    assert decimal_mark != thousands_sep
-    table_out = OrderedDict()
-    header = table_in[0]
-    for row_no, row in enumerate(table_in[1:]):
-        table_out[row_no] = OrderedDict()
-        for k, v in OrderedDict(zip(header, row)).items():
-            #print("RAW", k, v)
-            if thousands_sep:
-                v = v.replace(thousands_sep, "")
-            if v == "NaN":
-                v = None
-            elif decimal_mark in v:
-                v = float(v)
-            elif len(v):
-                v = int(v)
-            else:
-                v = None
-            table_out[row_no][k] = v
-            #print(k, ":", v)
-        #print()
-    return table_out
-
-
-def process_demux_html(html_file):
-    """returns flowcell summary and lane summary as dicts"""
-
-    with open(html_file, encoding='utf-8') as fh:
-        html_data = fh.read()
-    p = HTMLTableParser()
-    p.feed(html_data)
-
-    assert len(p.tables) == 3, (
-        "Parsing tables from {} failed".format(html_file))
-    flowcell_id = p.tables[0][0][0].split()[0]# html parsing sucks
-    flowcell_htmlparser_table = p.tables[1]
-    lane_htmlparser_table = p.tables[2]
-
-    # clean up flowcell table
-    #
-    flowcell_table = htmlparser_demux_table_to_dict(flowcell_htmlparser_table)
-    # htmlparser_demux_table_to_dict() creates rows which don't make
-    # sense for flowcell, so we rename the sole row 0 to flowcell_id
-    assert len(flowcell_table) == 1
-    flowcell_table[flowcell_id] = flowcell_table.pop(0)
-
-    # clean up lane table
-    #
-    lane_table = htmlparser_demux_table_to_dict(lane_htmlparser_table)
-    # htmlparser_demux_table_to_dict() creates sequentially numbered
-    # rows but we want to use the lane numbers as keys. has to happen
-    # in two iterations, to avoid overwriting existing keys
-    row_idxs = list(lane_table.keys())
-    for row_idx in row_idxs:# can't mutate during key iteration
-        d = lane_table.pop(row_idx)
-        k = "Lane " + str(d['Lane'])
-        del d['Lane']
-        lane_table[k] = d
-    # now convert back to int/lane
-    row_idxs = list(lane_table.keys())
-    for row_idx in row_idxs:# can't mutate during key iteration
-        d = lane_table.pop(row_idx)
-        assert row_idx.startswith("Lane ")
-        k = int(row_idx.split()[1])
-        lane_table[k] = d
-
-    return flowcell_table, lane_table
-
-
-def gather_demux_stats(demux_html_files):
-    """Parse all demux html stats, parse and combine (logically
-    representing one run). Teturn flowcell summary table and lane
-    summary table as two dicts()
-    """
-
-    flowcell_table = OrderedDict()
-    lane_table = OrderedDict()
-
-    # extract tables from all demux_html_files
-    #
-    for html_file in demux_html_files:
-        m = re.search(DEMUX_HTML_FILE_PATTERN, html_file)
-        if not m or not len(m.groups()) == 2:
-            logger.fatal("html file name (%s) doesn't match"
-                         " expected pattern (%s)\n",
-                         html_file, DEMUX_HTML_FILE_PATTERN)
-            sys.exit(1)
-
-        #mux_id = m.groups()[0]
-        flowcell_id = m.groups()[1]
-        logger.info("Reading %s", html_file)
-        this_flowcell_table, this_lane_table = process_demux_html(html_file)
-        # pure paranoia test
-        assert [flowcell_id] == list(this_flowcell_table.keys())
-
-        for lane in this_lane_table.keys():
-            assert lane not in lane_table.keys(), (
-                "Seen lane {} before, i.e. html files are not from same run".format(lane))
-        lane_table.update(this_lane_table)
-
-        if not flowcell_id in flowcell_table:
-            flowcell_table = this_flowcell_table
-        else:
-            for k, v in this_flowcell_table[flowcell_id].items():
-                flowcell_table[flowcell_id][k] += v
-
-    return flowcell_table, lane_table
-
-
-
 def run_qc_checks(project_dirs, machine_type):
     """main function"""
     qcfails = []
     assert len(project_dirs) >= 1
 
-    # determine all all/all/all/lane.html in project subdirs of given demux_dir
-    #
-    demux_html_files = []
-    for d in project_dirs:
-        g = os.path.join(d, 'html/*/all/all/all/lane.html')
-        f = glob.glob(g)
-        assert len(f) == 1, (
-            "Was expecting exactly one matching demux html"
-            " but found {} for glob {}".format(f, g))
-        demux_html_files.extend(f)
-    flowcell_table, lane_table = gather_demux_stats(demux_html_files)
+    demux_stats = load_run_demux_stats(project_dirs)
+    flowcell_table = demux_stats['flowcell']
+    lane_table = demux_stats['lanes']
     logger.debug("# Combined Flowcell Summary")
     logger.debug(pprint.pformat(flowcell_table))
     logger.debug("# Combined per Lane")
@@ -289,17 +164,8 @@ def run_qc_checks(project_dirs, machine_type):
         """
         
 
-    # info about 'undetermined' sits elsewhere (only makes sense if demuxed)
-    #
-    undet_demux_html_files = []
-    for d in project_dirs:
-        g = os.path.join(d, 'html/*/default/Undetermined/all/lane.html')
-        f = glob.glob(g)
-        if f:
-            # otherwise probably non-muxed
-            undet_demux_html_files.extend(f)
-    # for non-demuxed input (empty input files) everything below still works as expected
-    _, undet_lane_table = gather_demux_stats(undet_demux_html_files)
+    # for non-demuxed input this is empty
+    undet_lane_table = demux_stats['undetermined']
     logger.debug("# Undetermined combined per Lane")
     logger.debug(pprint.pformat(undet_lane_table))
 
@@ -353,13 +219,7 @@ def main():
     run_num = bcl2fastq_cfg["run_num"]
     machine_type = get_machine_type_from_run_num(run_num)
 
-    project_dirs = []
-    for _, mux_info in bcl2fastq_cfg["units"].items():
-        d = os.path.join(args.bcl2fastq_dir, "out", mux_info['mux_dir'])
-        if not os.path.exists(d):
-            logger.warning("Ignoring missing directory %s", d)
-        else:
-            project_dirs.append(d)
+    project_dirs = project_dirs_for_bcl2fastq_dir(args.bcl2fastq_dir)
 
     if len(project_dirs) == 0:
         logger.error("Exiting because no project directories where found in %s", args.bcl2fastq_dir)
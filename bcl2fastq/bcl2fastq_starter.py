@@ -116,9 +116,6 @@ def main():
         if args.break_after_first:
             logger.info("Stopping after first sequencing run")
             break
-
-    # close the connection to MongoDB
-    connection.close()
     logger.info("Successful program exit")
 
 
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""Demultiplexing statistics of bcl2fastq runs
+
+Loads per lane, per sample and 'undetermined' tables for a project
+(i.e. MUX) directory from bcl2fastq's Stats.json (ConversionResults),
+falling back to the html reports for older runs without it. Tables use
+the column names of the bcl2fastq html reports (e.g. 'PF Clusters',
+'% >= Q30 bases') with typed values (None for NaN) and are keyed by
+lane number. Results are cached in a sidecar (see SIDECAR) in the
+project directory, which is reused as long as its source doesn't
+change.
+
+Run as script to print the combined tables for a bcl2fastq output
+directory as YAML.
+"""
+
+#--- standard library imports
+#
+import sys
+import os
+import glob
+import re
+import json
+import logging
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+from html_table_parser import HTMLTableParser
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+DEMUX_HTML_FILE_PATTERN = r'.*Project_(\w+)/html/([\w-]+)/\w+/\w+/\w+/lane.html'
+
+# bcl2fastq is run with --stats-dir set to the project dir. default
+# location as fallback
+STATS_JSON_CANDIDATES = ["Stats.json", os.path.join("Stats", "Stats.json")]
+
+SIDECAR = "demux_stats.json"
+# increase whenever the sidecar format changes
+SIDECAR_VERSION = 1
+
+
+def htmlparser_demux_table_to_dict(table_in, decimal_mark=".", thousands_sep=","):
+    """cleans raw bcl2fastq html table formatting as created by htmlparser
+    and converts to OrderedDict using sequential row numbers as first
+    key (i.e. row[0][key] = value)
+    """
+
+    assert decimal_mark != thousands_sep
+    table_out = OrderedDict()
+    header = table_in[0]
+    for row_no, row in enumerate(table_in[1:]):
+        table_out[row_no] = OrderedDict()
+        for k, v in OrderedDict(zip(header, row)).items():
+            if thousands_sep:
+                v = v.replace(thousands_sep, "")
+            if v == "NaN":
+                v = None
+            elif decimal_mark in v:
+                v = float(v)
+            elif len(v):
+                v = int(v)
+            else:
+                v = None
+            table_out[row_no][k] = v
+    return table_out
+
+
+def process_demux_html(html_file):
+    """returns flowcell summary and lane summary as dicts"""
+
+    with open(html_file, encoding='utf-8') as fh:
+        html_data = fh.read()
+    p = HTMLTableParser()
+    p.feed(html_data)
+
+    assert len(p.tables) == 3, (
+        "Parsing tables from {} failed".format(html_file))
+    flowcell_id = p.tables[0][0][0].split()[0]# html parsing sucks
+    flowcell_htmlparser_table = p.tables[1]
+    lane_htmlparser_table = p.tables[2]
+
+    # clean up flowcell table
+    #
+    flowcell_table = htmlparser_demux_table_to_dict(flowcell_htmlparser_table)
+    # htmlparser_demux_table_to_dict() creates rows which don't make
+    # sense for flowcell, so we rename the sole row 0 to flowcell_id
+    assert len(flowcell_table) == 1
+    flowcell_table[flowcell_id] = flowcell_table.pop(0)
+
+    # clean up lane table: use lane numbers as keys
+    #
+    lane_table = OrderedDict()
+    for d in htmlparser_demux_table_to_dict(lane_htmlparser_table).values():
+        lane = int(d.pop('Lane'))
+        lane_table[lane] = d
+
+    return flowcell_table, lane_table
+
+
+def _pct(num, den):
+    """percentage rounded as in bcl2fastq reports or None if undefined
+
+    >>> _pct(1, 3)
+    33.33
+    >>> _pct(1, 0) is None
+    True
+    """
+    if not den:
+        return None
+    return round(100.0 * num / den, 2)
+
+
+def _yield_stats(results):
+    """return yield (Mbases), % >= Q30 bases and mean quality score for
+    list of Stats.json demux results
+    """
+    yield_bases = sum(r.get('Yield', 0) for r in results)
+    q30_bases = sum(m.get('YieldQ30', 0) for r in results for m in r.get('ReadMetrics', []))
+    qual_sum = sum(m.get('QualityScoreSum', 0) for r in results for m in r.get('ReadMetrics', []))
+    return OrderedDict([
+        ('Yield (Mbases)', yield_bases // 1000000),
+        ('% >= Q30 bases', _pct(q30_bases, yield_bases)),
+        ('Mean Quality Score', round(qual_sum / yield_bases, 2) if yield_bases else None)])
+
+
+def _mismatch_counts(result, num_mismatches):
+    """number of reads with given number of barcode mismatches"""
+    return sum(m.get('MismatchCounts', dict()).get(str(num_mismatches), 0)
+               for m in result.get('IndexMetrics') or [])
+
+
+def stats_from_json(stats_json):
+    """Parse bcl2fastq Stats.json and return dict of flowcell, lane,
+    sample and undetermined tables
+    """
+    with open(stats_json) as fh:
+        stats = json.load(fh)
+
+    flowcell_id = stats['Flowcell']
+    flowcell = OrderedDict([('Clusters (Raw)', 0), ('Clusters(PF)', 0), ('Yield (MBases)', 0)])
+    lanes = OrderedDict()
+    samples = []
+    undetermined = OrderedDict()
+    for cr in stats['ConversionResults']:
+        lane = int(cr['LaneNumber'])
+        raw_clusters = cr['TotalClustersRaw']
+        pf_clusters = cr['TotalClustersPF']
+        demux_results = cr.get('DemuxResults', [])
+        undet = cr.get('Undetermined')
+        all_results = demux_results + ([undet] if undet else [])
+        # non-muxed lanes have no index metrics: percentages are
+        # undefined (NaN in html)
+        is_muxed = any(r.get('IndexMetrics') for r in demux_results)
+
+        lane_yield = cr.get('Yield', sum(r.get('Yield', 0) for r in all_results))
+        flowcell['Clusters (Raw)'] += raw_clusters
+        flowcell['Clusters(PF)'] += pf_clusters
+        flowcell['Yield (MBases)'] += lane_yield // 1000000
+
+        d = OrderedDict()
+        d['PF Clusters'] = pf_clusters
+        d['% of the lane'] = 100.0
+        d['% Perfect barcode'] = _pct(sum(_mismatch_counts(r, 0) for r in demux_results),
+                                      pf_clusters) if is_muxed else None
+        d['% One mismatch barcode'] = _pct(sum(_mismatch_counts(r, 1) for r in demux_results),
+                                           pf_clusters) if is_muxed else None
+        d.update(_yield_stats(all_results))
+        d['Yield (Mbases)'] = lane_yield // 1000000
+        d['% PF Clusters'] = _pct(pf_clusters, raw_clusters)
+        lanes[lane] = d
+
+        for r in demux_results:
+            s = OrderedDict()
+            s['Lane'] = lane
+            s['Sample_ID'] = r.get('SampleId')
+            s['Sample_Name'] = r.get('SampleName')
+            s['Barcode'] = '+'.join(m['IndexSequence'] for m in r.get('IndexMetrics') or [])
+            s['PF Clusters'] = r.get('NumberReads', 0)
+            s['% of the lane'] = _pct(s['PF Clusters'], pf_clusters)
+            s['% Perfect barcode'] = _pct(_mismatch_counts(r, 0), s['PF Clusters']) \
+                                     if is_muxed else None
+            s.update(_yield_stats([r]))
+            samples.append(s)
+
+        if undet and is_muxed:
+            u = OrderedDict()
+            u['PF Clusters'] = undet.get('NumberReads', 0)
+            u['% of the lane'] = _pct(u['PF Clusters'], pf_clusters)
+            u.update(_yield_stats([undet]))
+            undetermined[lane] = u
+
+    return {'flowcell': OrderedDict([(flowcell_id, flowcell)]),
+            'lanes': lanes,
+            'samples': samples,
+            'undetermined': undetermined}
+
+
+def stats_from_html(project_dir):
+    """Parse bcl2fastq html reports in project_dir and return dict of
+    flowcell, lane and undetermined tables (no sample table)
+    """
+    g = os.path.join(project_dir, 'html/*/all/all/all/lane.html')
+    f = glob.glob(g)
+    assert len(f) == 1, (
+        "Was expecting exactly one matching demux html"
+        " but found {} for glob {}".format(f, g))
+    html_file = f[0]
+    m = re.search(DEMUX_HTML_FILE_PATTERN, html_file)
+    if not m or not len(m.groups()) == 2:
+        raise ValueError("html file name ({}) doesn't match expected pattern ({})".format(
+            html_file, DEMUX_HTML_FILE_PATTERN))
+    flowcell_table, lane_table = process_demux_html(html_file)
+    # pure paranoia test
+    assert [m.groups()[1]] == list(flowcell_table.keys())
+
+    # info about 'undetermined' sits elsewhere (only exists if demuxed)
+    undetermined = OrderedDict()
+    for undet_html in glob.glob(os.path.join(
+            project_dir, 'html/*/default/Undetermined/all/lane.html')):
+        _, undet_lane_table = process_demux_html(undet_html)
+        undetermined.update(undet_lane_table)
+
+    return {'flowcell': flowcell_table,
+            'lanes': lane_table,
+            'samples': [],
+            'undetermined': undetermined}
+
+
+def _source_for_project(project_dir):
+    """return Stats.json or html report used for project_dir or None"""
+    for f in STATS_JSON_CANDIDATES:
+        f = os.path.join(project_dir, f)
+        if os.path.exists(f):
+            return f
+    f = glob.glob(os.path.join(project_dir, 'html/*/all/all/all/lane.html'))
+    if len(f) == 1:
+        return f[0]
+    return None
+
+
+def _int_keys(table):
+    """convert (JSON string) lane keys back to int"""
+    return OrderedDict((int(k), v) for k, v in table.items())
+
+
+def load_project_demux_stats(project_dir, use_sidecar=True):
+    """Return dict of flowcell, lane, sample and undetermined tables for
+    project_dir (see module docstring). Uses and writes sidecar if
+    use_sidecar is set
+    """
+    source = _source_for_project(project_dir)
+    if not source:
+        raise ValueError("No Stats.json or demux html found in {}".format(project_dir))
+    stat = os.stat(source)
+    sidecar = os.path.join(project_dir, SIDECAR)
+
+    if use_sidecar and os.path.exists(sidecar):
+        try:
+            with open(sidecar) as fh:
+                cached = json.load(fh, object_pairs_hook=OrderedDict)
+        except ValueError:
+            cached = dict()
+        if cached.get('version') == SIDECAR_VERSION and \
+           cached.get('source') == os.path.basename(source) and \
+           cached.get('source_size') == stat.st_size and \
+           cached.get('source_mtime_ns') == stat.st_mtime_ns:
+            logger.debug("Using cached demux stats %s", sidecar)
+            return {'flowcell': cached['flowcell'],
+                    'lanes': _int_keys(cached['lanes']),
+                    'samples': cached['samples'],
+                    'undetermined': _int_keys(cached['undetermined'])}
+
+    logger.info("Reading %s", source)
+    if source.endswith(".json"):
+        tables = stats_from_json(source)
+    else:
+        tables = stats_from_html(project_dir)
+
+    if use_sidecar:
+        cached = OrderedDict([('version', SIDECAR_VERSION),
+                              ('source', os.path.basename(source)),
+                              ('source_size', stat.st_size),
+                              ('source_mtime_ns', stat.st_mtime_ns)])
+        cached.update(tables)
+        try:
+            with open(sidecar + ".tmp", 'w') as fh:
+                json.dump(cached, fh, indent=1)
+            os.rename(sidecar + ".tmp", sidecar)
+        except OSError as e:
+            logger.warning("Couldn't write %s: %s", sidecar, e)
+    return tables
+
+
+def load_run_demux_stats(project_dirs, use_sidecar=True, max_workers=8):
+    """Load demux stats of all project_dirs (logically representing one
+    run) concurrently and combine them. Lanes cannot be shared between
+    MUXes, so lane tables are complete. The flowcell table is summed up
+    over all projects
+    """
+    project_dirs = list(project_dirs)
+    if len(project_dirs) > 1 and max_workers > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(project_dirs))) as executor:
+            per_project = list(executor.map(load_project_demux_stats, project_dirs,
+                                            [use_sidecar] * len(project_dirs)))
+    else:
+        per_project = [load_project_demux_stats(d, use_sidecar) for d in project_dirs]
+
+    combined = {'flowcell': OrderedDict(),
+                'lanes': OrderedDict(),
+                'samples': [],
+                'undetermined': OrderedDict()}
+    for project_dir, tables in zip(project_dirs, per_project):
+        for lane in tables['lanes']:
+            assert lane not in combined['lanes'], (
+                "Seen lane {} before, i.e. {} is not from same run".format(lane, project_dir))
+        combined['lanes'].update(tables['lanes'])
+        combined['undetermined'].update(tables['undetermined'])
+        combined['samples'].extend(tables['samples'])
+        for flowcell_id, values in tables['flowcell'].items():
+            if flowcell_id not in combined['flowcell']:
+                combined['flowcell'][flowcell_id] = OrderedDict(values)
+            else:
+                for k, v in values.items():
+                    if v is not None:
+                        combined['flowcell'][flowcell_id][k] = \
+                            (combined['flowcell'][flowcell_id][k] or 0) + v
+    return combined
+
+
+def project_dirs_for_bcl2fastq_dir(bcl2fastq_dir):
+    """Return existing project dirs listed in conf.yaml of bcl2fastq
+    output directory
+    """
+    with open(os.path.join(bcl2fastq_dir, 'conf.yaml')) as fh:
+        bcl2fastq_cfg = yaml.safe_load(fh)
+    project_dirs = []
+    for _, mux_info in bcl2fastq_cfg["units"].items():
+        d = os.path.join(bcl2fastq_dir, "out", mux_info['mux_dir'])
+        if not os.path.exists(d):
+            logger.warning("Ignoring missing directory %s", d)
+        else:
+            project_dirs.append(d)
+    return project_dirs
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', "--bcl2fastq-dir", required=True,
+                        help="bcl2fastq directory (containing a conf.yaml)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't use or write sidecars")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    project_dirs = project_dirs_for_bcl2fastq_dir(args.bcl2fastq_dir)
+    if not project_dirs:
+        logger.fatal("No project directories found in %s", args.bcl2fastq_dir)
+        sys.exit(1)
+    tables = load_run_demux_stats(project_dirs, use_sidecar=not args.no_cache)
+    # plain dicts for readable yaml
+    tables = json.loads(json.dumps(tables))
+    yaml.safe_dump(tables, sys.stdout, default_flow_style=False)
+
+
+if __name__ == '__main__':
+    main()
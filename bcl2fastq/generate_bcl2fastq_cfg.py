@@ -12,7 +12,6 @@ import xml.etree.ElementTree as ET
 
 #--- third-party imports
 #
-import requests
 import yaml
 
 #--- project specific imports
@@ -22,9 +21,9 @@ LIB_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
-from config import rest_services
 from config import bcl2fastq_conf
 from pipelines import get_machine_run_flowcell_id
+from rest import run_details
 from pipelines import email_for_user
 from pipelines import send_mail
 from pipelines import is_devel_version
@@ -134,17 +133,11 @@ def get_rest_data(run_num, test_server=None):
     """ Get rest info from ELM
     """
     if test_server:
-        rest_url = rest_services['run_details']['testing'].replace("run_num", run_num)
         logger.info("development server")
     else:
-        rest_url = rest_services['run_details']['production'].replace("run_num", run_num)
         logger.info("production server")
-    response = requests.get(rest_url)
-    if response.status_code != requests.codes.ok:
-        response.raise_for_status()
-        sys.exit(1)
-    rest_data = response.json()
-    logger.debug("rest_data from %s: %s", rest_url, rest_data)
+    rest_data = run_details(run_num, testing=bool(test_server))
+    logger.debug("rest_data for %s: %s", run_num, rest_data)
     return rest_data
 
 def generate_samplesheet(rest_data, flowcellid, outdir, runinfo):
@@ -23,6 +23,7 @@ from utils import generate_timestamp
 from pipelines import get_site
 from pipelines import is_production_user
 from mongodb import mongodb_conn
+from mongodb import runcomplete_set_run_status
 
 __author__ = "Lavanya Veeravalli"
 __email__ = "veeravallil@gis.a-star.edu.sg"
@@ -83,49 +84,20 @@ def main():
     logger.debug("DB %s", db)
     logger.info("Status for %s is %s", run_number, args.status)
     if args.status in ["STARTED", "SEQRUNFAILED"]:
-        try:
-            if not args.dry_run:
-                res = db.update_one({"run": run_number},
-                                    {"$push":
-                                     {"analysis": {
-                                         "analysis_id" : args.analysis_id,
-                                         "user_name" : user_name,
-                                         "out_dir" : args.out,
-                                         "Status" :  args.status,
-                                     }}})
-                assert res.modified_count == 1, (
-                    "Modified {} documents instead of 1".format(res.modified_count))
-        except (pymongo.errors.OperationFailure, AssertionError) as e:
-            logger.fatal("MongoDB update failure while setting run %s analysis_id %s to %s",
-                         run_number, args.analysis_id, args.status)
-            sys.exit(1)
-
+        end_time = None
     elif args.status in ["SUCCESS", "FAILED"]:
         end_time = generate_timestamp()
         logger.info("Setting timestamp to %s", end_time)
-        try:
-            if not args.dry_run:
-                res = db.update_one({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                                    {"$set":
-                                     {"analysis.$": {
-                                         "analysis_id" : args.analysis_id,
-                                         "end_time" : end_time,
-                                         "user_name" : user_name,
-                                         "out_dir" : args.out,
-                                         "Status" :  args.status,
-                                     }}})
-                assert res.modified_count == 1, (
-                    "Modified {} documents instead of 1".format(res.modified_count))
-        except (pymongo.errors.OperationFailure, AssertionError) as e:
-            logger.fatal("MongoDB update failure while setting run %s analysis_id %s to %s",
-                         run_number, args.analysis_id, args.status)
-            sys.exit(1)
-
     else:
         raise ValueError(args.status)
-
-    # close the connection to MongoDB
-    connection.close()
+    try:
+        if not args.dry_run:
+            runcomplete_set_run_status(db, run_number, args.analysis_id, args.status,
+                                       args.out, end_time=end_time, user_name=user_name)
+    except (pymongo.errors.OperationFailure, AssertionError) as e:
+        logger.fatal("MongoDB update failure while setting run %s analysis_id %s to %s",
+                     run_number, args.analysis_id, args.status)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
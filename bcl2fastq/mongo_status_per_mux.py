@@ -20,6 +20,7 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import runcomplete_add_mux_status
 
 
 __author__ = "Lavanya Veeravalli"
@@ -81,63 +82,13 @@ def main():
         sys.exit(1)
     logger.info("Database connection established")
     db = connection.gisds.runcomplete
-    if args.mux_status == "SUCCESS":
-        try:
-            if not args.dry_run:
-                db.update({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                          {
-                              "$push": {
-                                  "analysis.$.per_mux_status":  {
-                                      "mux_id" : args.mux_id,
-                                      "mux_dir" : args.mux_dir,
-                                      "Status" : args.mux_status,
-                                      "StatsSubmission" : "TODO",
-                                      "ArchiveSubmission" : "TODO",
-                                      "DownstreamSubmission" : "TODO",
-                                      "email_sent" : False,
-
-                                  }}})
-        except pymongo.errors.OperationFailure:
-            logger.fatal("mongoDB OperationFailure")
-            sys.exit(0)
-    elif args.mux_status == "FAILED":
-        try:
-            if not args.dry_run:
-                db.update({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                          {
-                              "$push": {
-                                  "analysis.$.per_mux_status":  {
-                                      "mux_id" : args.mux_id,
-                                      "mux_dir" : args.mux_dir,
-                                      "Status" : args.mux_status,
-                                      "email_sent" : False,
-                                  }}})
-        except pymongo.errors.OperationFailure:
-            logger.fatal("mongoDB OperationFailure")
-            sys.exit(0)
-    elif args.mux_status == "NOARCHIVE":
-        try:
-            if not args.dry_run:
-                db.update({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                          {
-                              "$push": {
-                                  "analysis.$.per_mux_status":  {
-                                      "mux_id" : args.mux_id,
-                                      "mux_dir" : args.mux_dir,
-                                      "Status" : args.mux_status,
-                                      "StatsSubmission" : "NOARCHIVE",
-                                      "ArchiveSubmission" : "NOARCHIVE",
-                                      "DownstreamSubmission" : "TODO",
-                                      "email_sent" : True,
-
-                                  }}})
-        except pymongo.errors.OperationFailure:
-            logger.fatal("mongoDB OperationFailure")
-            sys.exit(0)
-    else:
-        raise ValueError(args.status)
-     # close the connection to MongoDB
-    connection.close()
+    try:
+        if not args.dry_run:
+            runcomplete_add_mux_status(db, run_number, args.analysis_id,
+                                       args.mux_id, args.mux_dir, args.mux_status)
+    except pymongo.errors.OperationFailure:
+        logger.fatal("mongoDB OperationFailure")
+        sys.exit(0)
 
 if __name__ == "__main__":
     logger.info("MongoDB status update starting")
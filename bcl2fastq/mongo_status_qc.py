@@ -125,7 +125,6 @@ def main():
                              e.returncode, ' '.join(bcl2fastq_qc_cmd))
                 logger.fatal("Output: %s", e.output.decode())
                 logger.fatal("Exiting")
-    connection.close()
 if __name__ == "__main__":
     logger.info("Demultiplexing QC status")
     main()
@@ -181,8 +181,6 @@ def main():
                             os.path.abspath(out_dir))
             elif analysis.get("Status") == "FAILED":
                 logger.debug("BCL2FASTQ FAILED for %s under %s", run_number, out_dir)
-     # close the connection to MongoDB
-    connection.close()
     logger.info("%s dirs with triggers", num_triggers)
 
 
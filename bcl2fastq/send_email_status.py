@@ -189,9 +189,6 @@ def main():
                     num_emails += 1
                     update_mongodb_email(db, run_number, analysis_id, email_sent_query, True)
 
-
-    # close the connection to MongoDB
-    connection.close()
     logger.info("%d emails sent", num_emails)
 
 
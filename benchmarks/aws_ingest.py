@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Benchmark accounting ingest of tools/aws.py on a synthetic (U/S)GE
+accounting file.
+
+Modes:
+- per-row: former ingest of aws.py, i.e. one INSERT statement built as
+  string per record, indexes in place and one transaction per file
+- batched: ingest_accounting() into a new database, then create_indexes()
+- rerun: ingest_accounting() on the unchanged file (skipped)
+- append: ingest_accounting() after appending 10% records
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import gzip
+import time
+import re
+import random
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+TOOLS_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "tools"))
+if TOOLS_PATH not in sys.path:
+    sys.path.insert(0, TOOLS_PATH)
+import aws
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+OWNERS = ['userrig', 'user1', 'user2', 'user3']
+
+CREATE_ACCOUNTING_SQL = "CREATE TABLE accounting (" + ", ".join(aws.FIELDS) + \
+                        ", PRIMARY KEY (jobnumber, qsub_time, start_time, end_time));"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def accounting_line(jobnumber, rand):
+    """Return one synthetic accounting line (45 fields) for jobnumber"""
+    owner = rand.choice(OWNERS)
+    qsub_time = 1500000000 + jobnumber
+    wallclock = rand.randint(1, 36000)
+    fields = ['all.q', 'node{}'.format(rand.randint(1, 100)), 'users', owner,
+              'pipeline.slave.rule{}.{}.sh'.format(rand.randint(1, 50), jobnumber),
+              str(jobnumber), 'sge', '0', str(qsub_time), str(qsub_time + 10),
+              str(qsub_time + 10 + wallclock), '0', '0', str(wallclock)]
+    fields += ['0'] * 17# ru_utime .. ru_nivcsw
+    fields += ['NONE', 'defaultdepartment', 'OpenMP', '1', '0', str(wallclock), '0', '0',
+               '-U {} -l h_rt=86400,h_vmem=4G,mem_free=4G -pe OpenMP {}'.format(
+                   owner, rand.randint(1, 16)),
+               '0', 'NONE', str(rand.randint(2**20, 2**33)), '0', '0']
+    assert len(fields) == 45
+    return ":".join(fields) + "\n"
+
+
+def write_accounting(acct, jobnumbers, mode='w', seed=0):
+    """Write (or append) synthetic accounting lines for jobnumbers"""
+    rand = random.Random(seed)
+    opener = gzip.open if acct.endswith(".gz") else open
+    with opener(acct, mode + 't') as fh:
+        for jobnumber in jobnumbers:
+            fh.write(accounting_line(jobnumber, rand))
+
+
+def new_db(dbfile, with_indexes=False):
+    """Create empty database as aws.py does"""
+    db = sqlite3.connect(dbfile)
+    db.execute(CREATE_ACCOUNTING_SQL)
+    if with_indexes:
+        aws.create_indexes(db)
+    return db
+
+
+def per_row_sql(l, owners):
+    """INSERT statement for split accounting line l as built by the
+    former aws.py parse_list() or None for other owners
+    """
+    if l[0].startswith("#") or l[3] not in owners:
+        return None
+    values = ["'" + v + "'" for v in [l[0], l[1], l[3], l[4], l[5], l[8], l[9],
+                                      l[10], l[11], l[12], l[13], l[42]]]
+    for pattern, start in [(r"h_rt=\d+", 5), (r"h_vmem=\d+", 7), (r"mem_free=\d+", 9)]:
+        if len(re.findall(pattern, l[39])) > 0:
+            values.append("'" + re.findall(pattern, l[39])[0][start:] + "'")
+        else:
+            values.append("''")
+    if len(re.findall(r"OpenMP\s\d+", l[39])) > 0:
+        values.append("'" + re.findall(r"OpenMP\s\d+", l[39])[0].split(" ")[1] + "'")
+    else:
+        values.append("''")
+    return "INSERT OR IGNORE INTO accounting (" + ", ".join("'" + f + "'" for f in aws.FIELDS) + \
+        ") VALUES (" + ", ".join(values) + ");"
+
+
+def ingest_per_row(db, acct, owners):
+    """One INSERT statement per record, committed once per file"""
+    num_inserted = 0
+    opener = gzip.open if acct.endswith(".gz") else open
+    with opener(acct, 'rb') as fh:
+        for line in fh:
+            sql = per_row_sql(line.decode().rstrip().split(":"), owners)
+            if sql:
+                num_inserted += db.execute(sql).rowcount
+    db.commit()
+    return num_inserted
+
+
+def timed(func, *args):
+    """Return seconds func(*args) took and its result"""
+    start = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - start, res
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--num-lines', type=int, default=1000000,
+                        help="Number of accounting lines")
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help="Use gzipped accounting file")
+    parser.add_argument('--skip-per-row', action='store_true',
+                        help="Skip (slow) per-row mode")
+    parser.add_argument('-t', '--tmpdir',
+                        help="Directory for accounting file and databases (default: system tmp)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    workdir = tempfile.mkdtemp(prefix="aws_ingest.", dir=args.tmpdir)
+    try:
+        acct = os.path.join(workdir, "accounting" + (".gz" if args.gzip else ""))
+        logger.info("Writing %d lines to %s", args.num_lines, acct)
+        write_accounting(acct, range(1, args.num_lines + 1))
+        owners = set(OWNERS[:2])
+
+        print("\t".join(["mode", "lines", "inserted", "seconds", "lines_per_s"]))
+        def report(mode, secs, num_lines, num_inserted):
+            print("\t".join([mode, str(num_lines), str(num_inserted), "{:.1f}".format(secs),
+                             "{:.0f}".format(num_lines / secs if secs else 0)]))
+
+        if not args.skip_per_row:
+            db = new_db(os.path.join(workdir, "per-row.db"), with_indexes=True)
+            secs, num_inserted = timed(ingest_per_row, db, acct, owners)
+            db.close()
+            report("per-row", secs, args.num_lines, num_inserted)
+
+        db = new_db(os.path.join(workdir, "batched.db"))
+        db.execute("PRAGMA journal_mode = WAL;")
+        db.execute("PRAGMA synchronous = NORMAL;")
+        aws.create_offset_table(db)
+        start = time.perf_counter()
+        num_lines, num_inserted = aws.ingest_accounting(db, acct, owners)
+        aws.create_indexes(db)
+        report("batched", time.perf_counter() - start, num_lines, num_inserted)
+
+        secs, (num_lines, num_inserted) = timed(aws.ingest_accounting, db, acct, owners)
+        report("rerun", secs, num_lines, num_inserted)
+
+        num_append = args.num_lines // 10
+        write_accounting(acct, range(args.num_lines + 1, args.num_lines + num_append + 1),
+                         mode='a', seed=1)
+        secs, (num_lines, num_inserted) = timed(aws.ingest_accounting, db, acct, owners)
+        report("append", secs, num_lines, num_inserted)
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Benchmark import time of cron scripts with lazily loaded and cached
+configs (lib/config.py) against eagerly parsing all existing config
+files (as done before configs were loaded lazily).
+
+Each import runs in a fresh interpreter. Modes:
+- eager: parse all existing config files in etc, uncached
+- lazy-cold: parse only configs accessed on import, empty cache
+- lazy-warm: as lazy-cold, but with primed cache
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+ROOT_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+SCRIPTS = [os.path.join(ROOT_PATH, "bcl2fastq", "bcl2fastq_dbupdate.py"),
+           os.path.join(ROOT_PATH, "downstream-handlers", "downstream_handler.py")]
+
+MODES = ['eager', 'lazy-cold', 'lazy-warm']
+
+# run in a fresh interpreter: import script (as module, i.e. main()
+# not executed) and print import time and parsed configs as json
+IMPORT_CODE = """
+import importlib.util, json, os, sys, time
+script, mode = sys.argv[1:3]
+sys.path.insert(0, os.path.dirname(script))
+start = time.perf_counter()
+if mode == 'eager':
+    sys.path.insert(0, {lib_path!r})
+    import config
+    for name, cfgfile in config.CFG_FILES.items():
+        if os.path.exists(cfgfile):
+            config._loaded_cfgs[name] = config.load_cfgfile(cfgfile, use_cache=False)
+spec = importlib.util.spec_from_file_location("benchmarked", script)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+secs = time.perf_counter() - start
+import config
+print(json.dumps(dict(secs=secs, parsed=sorted(config._loaded_cfgs))))
+""".format(lib_path=os.path.join(ROOT_PATH, "lib"))
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def time_import(script, mode, cache_dir):
+    """import script in fresh interpreter. returns import time in
+    seconds and list of parsed configs
+    """
+    env = dict(os.environ)
+    env['RPD_CACHE_DIR'] = cache_dir
+    res = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_CODE, script, mode], env=env)
+    res = json.loads(res.decode().splitlines()[-1])
+    return res['secs'], res['parsed']
+
+
+def benchmark(script, num_runs):
+    """returns dict of mode to (median import time, parsed configs)"""
+    results = dict()
+    for mode in MODES:
+        times = []
+        warm_cache_dir = tempfile.mkdtemp(prefix="config_import.")
+        if mode == 'lazy-warm':
+            time_import(script, mode, warm_cache_dir)# prime
+        for _ in range(num_runs):
+            if mode == 'lazy-warm':
+                cache_dir = warm_cache_dir
+            else:
+                cache_dir = tempfile.mkdtemp(prefix="config_import.")
+            secs, parsed = time_import(script, mode, cache_dir)
+            times.append(secs)
+            if cache_dir != warm_cache_dir:
+                shutil.rmtree(cache_dir)
+        shutil.rmtree(warm_cache_dir)
+        times.sort()
+        results[mode] = (times[len(times)//2], parsed)
+        logger.debug("%s %s: %s", os.path.basename(script), mode, times)
+    return results
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scripts', nargs='*', default=SCRIPTS,
+                        help="Scripts to import (default: {})".format(
+                            ", ".join(os.path.relpath(s, ROOT_PATH) for s in SCRIPTS)))
+    parser.add_argument('-n', '--num-runs', type=int, default=5,
+                        help="Number of imports per mode (median is reported)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    print("\t".join(["script", "mode", "import_ms", "parsed_configs"]))
+    for script in args.scripts:
+        for mode, (secs, parsed) in benchmark(os.path.abspath(script), args.num_runs).items():
+            print("\t".join([os.path.basename(script), mode, "{:.1f}".format(secs * 1000),
+                             ",".join(parsed)]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Benchmark MongoDB status updates and indexes of the downstream
+handlers on synthetic pipeline_runs records.
+
+Modes:
+- per-record: former handler updates, i.e. find_one plus update_one
+  per record
+- bulk: the same updates queued in lib/mongodb.BulkWriter
+- indexes: cron query without and with ensure_indexes(), and the
+  number of createIndexes sent by a repeated ensure_indexes()
+
+Uses mongomock unless --uri points to a (throw-away) mongod. With
+mongomock, --latency-ms emulates the network round trip time.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+from collections import Counter
+
+#--- third-party imports
+#
+import pymongo
+
+#--- project specific imports
+#
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from mongodb import BulkWriter, ensure_indexes, INDEXES
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+SITE = "GIS"
+
+# collection methods that result in one round trip each
+ROUND_TRIP_METHODS = ['find_one', 'update_one', 'bulk_write', 'create_index',
+                      'index_information', 'count_documents']
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+class CountingCollection(object):
+    """Wraps a collection, counts round trips per method in calls and
+    sleeps latency seconds per round trip
+    """
+
+    def __init__(self, collection, calls, latency=0.0):
+        self._collection = collection
+        self._calls = calls
+        self._latency = latency
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in ROUND_TRIP_METHODS:
+            return attr
+        def counted(*args, **kwargs):
+            self._calls[name] += 1
+            if self._latency:
+                time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingDB(object):
+    """Wraps a database so that collections are CountingCollections"""
+
+    def __init__(self, db, calls, latency=0.0):
+        self._db = db
+        self._calls = calls
+        self._latency = latency
+
+
+    def __getitem__(self, colname):
+        return CountingCollection(self._db[colname], self._calls, self._latency)
+
+
+def get_db(uri):
+    """Return empty benchmark database, either on mongod at uri or in
+    mongomock
+    """
+    if uri:
+        client = pymongo.MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    client.drop_database("rpd_benchmark")
+    return client.rpd_benchmark
+
+
+def insert_runs(col, num_records, seed=0):
+    """Insert num_records synthetic pipeline_runs of which half are
+    STARTED. Returns ids of the started ones
+    """
+    rand = random.Random(seed)
+    docs = []
+    now = int(time.time())
+    for i in range(num_records):
+        status = "STARTED" if i % 2 == 0 else "SUCCESS"
+        docs.append({"ctime": now - rand.randint(0, 30*24*3600),
+                     "site": rand.choice([SITE, "NSCC", "AWS"]),
+                     "pipeline_name": "pipeline{}".format(i % 10),
+                     "execution": {"status": status,
+                                   "out_dir": "/output/run{}".format(i)}})
+    res = col.insert_many(docs)
+    return [dbid for dbid, doc in zip(res.inserted_ids, docs)
+            if doc['execution']['status'] == "STARTED"]
+
+
+def update_per_record(col, dbids):
+    """former set_completion_if(): find_one plus update_one per record"""
+    for dbid in dbids:
+        job = col.find_one({"_id": dbid})
+        assert job['execution']['status'] == "STARTED"
+        res = col.update_one({"_id": dbid},
+                             {"$set": {"execution.status": "SUCCESS",
+                                       "execution.end_time": "2017-01-01T00:00:00"}})
+        assert res.modified_count == 1
+
+
+def update_bulk(col, dbids, batch_size):
+    """all updates queued in one BulkWriter"""
+    with BulkWriter(col, batch_size=batch_size) as bulk:
+        for dbid in dbids:
+            bulk.update_one({"_id": dbid, "execution.status": "STARTED"},
+                            {"$set": {"execution.status": "SUCCESS",
+                                      "execution.end_time": "2017-01-01T00:00:00"}})
+    return bulk.num_round_trips
+
+
+def cron_query(col, repeats):
+    """cron query of downstream_handler.py, repeats times. Returns
+    average seconds
+    """
+    now = int(time.time())
+    start = time.perf_counter()
+    for _ in range(repeats):
+        list(col.find({"ctime": {"$gt": now - 14*24*3600, "$lt": now}, "site": SITE},
+                      projection=["execution"]))
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--num-records', type=int, default=1000,
+                        help="Number of pipeline_runs records (half of them get updated)")
+    parser.add_argument('-b', '--batch-size', type=int, default=200,
+                        help="BulkWriter batch size")
+    parser.add_argument('-l', '--latency-ms', type=float, default=1.0,
+                        help="Emulated round trip time for mongomock (ignored with --uri)")
+    parser.add_argument('-u', '--uri',
+                        help="MongoDB URI of a throw-away server (default: mongomock)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    db = get_db(args.uri)
+    latency = 0.0 if args.uri else args.latency_ms / 1000.0
+    print("\t".join(["mode", "updates", "round_trips", "seconds"]))
+
+    for mode in ["per-record", "bulk"]:
+        db.drop_collection("pipeline_runs")
+        dbids = insert_runs(db.pipeline_runs, args.num_records)
+        calls = Counter()
+        col = CountingCollection(db.pipeline_runs, calls, latency)
+        start = time.perf_counter()
+        if mode == "per-record":
+            update_per_record(col, dbids)
+        else:
+            update_bulk(col, dbids, args.batch_size)
+        secs = time.perf_counter() - start
+        assert db.pipeline_runs.count_documents({"execution.status": "STARTED"}) == 0
+        print("\t".join([mode, str(len(dbids)), str(sum(calls.values())),
+                         "{:.3f}".format(secs)]))
+
+    db.drop_collection("pipeline_runs")
+    insert_runs(db.pipeline_runs, args.num_records)
+    print()
+    print("\t".join(["index_mode", "round_trips", "create_indexes", "query_seconds"]))
+    print("\t".join(["no-indexes", "0", "0", "{:.4f}".format(cron_query(db.pipeline_runs, 10))]))
+    indexes = {'pipeline_runs': INDEXES['pipeline_runs']}
+    for mode in ["ensure-first", "ensure-again"]:
+        calls = Counter()
+        assert ensure_indexes(CountingDB(db, calls, latency), indexes)
+        print("\t".join([mode, str(sum(calls.values())), str(calls['create_index']),
+                         "{:.4f}".format(cron_query(db.pipeline_runs, 10))]))
+
+
+if __name__ == '__main__':
+    main()
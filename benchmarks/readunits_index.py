@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Benchmark readunit lookups done in rule params during DAG
+construction on synthetic samples/readunits configs.
+
+The four read group params of the per-unit mapping rules (e.g. map_sort
+in mapping/BWA-MEM/bwa_mem.rules) are evaluated once per unit job, as
+snakemake does when building the DAG. Modes:
+- linear: former lookups, i.e. get_sample_for_unit() searching all
+  samples and gen_rg_lib_id()/gen_rg_pu_id() per call
+- indexed: lookups via readunits.unit_index() (get_read_group_for_unit()
+  and get_sample_for_unit())
+
+Results of both modes are checked to be identical.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import time
+import logging
+import argparse
+from collections import namedtuple
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from readunits import ReadUnit, key_for_readunit, create_rg_id_from_ru
+from readunits import gen_rg_lib_id, gen_rg_pu_id
+from readunits import get_sample_for_unit, get_read_group_for_unit
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# stand-in for snakemake's wildcards object
+Wildcards = namedtuple('Wildcards', ['unit'])
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def synthetic_config(num_samples, units_per_sample):
+    """Return config with samples and readunits as created by
+    sample_conf.py
+    """
+    config = {'samples': dict(), 'readunits': dict()}
+    for s in range(num_samples):
+        samplename = "sample-{}".format(s)
+        config['samples'][samplename] = []
+        for u in range(units_per_sample):
+            lane = u % 8 + 1
+            ru = ReadUnit(run_id="HS00{}".format(s % 7),
+                          flowcell_id="FC{:05d}".format(s + u // 8),
+                          library_id="lib-{}".format(s),
+                          lane_id=str(lane), rg_id=None,
+                          fq1="/data/{}/{}_R1.fastq.gz".format(samplename, u),
+                          fq2="/data/{}/{}_R2.fastq.gz".format(samplename, u))
+            ru = ru._replace(rg_id=create_rg_id_from_ru(ru))
+            key = key_for_readunit(ru)
+            config['readunits'][key] = dict(ru._asdict())
+            config['samples'][samplename].append(key)
+    return config
+
+
+def linear_get_sample_for_unit(unitname, config):
+    """former get_sample_for_unit(), searching all samples"""
+    for samplename, readunits in config["samples"].items():
+        if unitname in readunits:
+            return samplename
+    raise ValueError(unitname)
+
+
+def linear_params(config):
+    """former rule params"""
+    return dict(
+        rg_id=lambda wc: config["readunits"][wc.unit]['rg_id'],
+        lib_id=lambda wc: gen_rg_lib_id(config["readunits"][wc.unit]),
+        pu_id=lambda wc: gen_rg_pu_id(config["readunits"][wc.unit]),
+        sample=lambda wc: linear_get_sample_for_unit(wc.unit, config))
+
+
+def indexed_params(config):
+    """current rule params"""
+    return dict(
+        rg_id=lambda wc: get_read_group_for_unit(wc.unit, config).rg_id,
+        lib_id=lambda wc: get_read_group_for_unit(wc.unit, config).lib_id,
+        pu_id=lambda wc: get_read_group_for_unit(wc.unit, config).pu_id,
+        sample=lambda wc: get_sample_for_unit(wc.unit, config))
+
+
+def evaluate_params(config, params):
+    """Evaluate params once per unit job. Returns results per unit"""
+    res = []
+    for unit in config['readunits']:
+        wc = Wildcards(unit=unit)
+        res.append(tuple(params[p](wc) for p in ['rg_id', 'lib_id', 'pu_id', 'sample']))
+    return res
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--num-samples', type=int, nargs='+', default=[100, 1000, 5000],
+                        help="Number of samples (one run per value)")
+    parser.add_argument('-u', '--units-per-sample', type=int, default=4,
+                        help="Number of readunits per sample")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    print("\t".join(["samples", "units", "linear_s", "indexed_s"]))
+    for num_samples in args.num_samples:
+        config = synthetic_config(num_samples, args.units_per_sample)
+        secs = dict()
+        results = dict()
+        for mode, params in [('linear', linear_params(config)),
+                             ('indexed', indexed_params(config))]:
+            start = time.perf_counter()
+            results[mode] = evaluate_params(config, params)
+            secs[mode] = time.perf_counter() - start
+        if results['linear'] != results['indexed']:
+            logger.error("Results differ for %d samples", num_samples)
+            sys.exit(1)
+        print("\t".join([str(num_samples), str(len(config['readunits'])),
+                         "{:.2f}".format(secs['linear']), "{:.2f}".format(secs['indexed'])]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Benchmark concatenation of per region cluster gVCFs as done by
+concat_split_vcfs (variant-calling/gatk/gatk_haplotype_caller.rules)
+on synthetic, BGZF compressed and tabix indexed gVCFs.
+
+Modes:
+- former-rule: decode lines in Python and pipe them through bgzip,
+  then tabix (the former rule). Uses pysam instead of bgzip and tabix
+  if these are not in PATH
+- bcftools: bcftools concat --naive (block copy), then tabix. Skipped
+  if bcftools and tabix are not in PATH
+- vcfcat-merge: lib/vcfcat.concat_vcfs(), merging input indices
+- vcfcat-scan: lib/vcfcat.concat_vcfs() with records indexed while
+  copying, i.e. no input indices
+
+The uncompressed output of all modes is checked to be identical.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import io
+import gzip
+import time
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from vcfcat import concat_vcfs, BgzfWriter, VcfTabixIndexer, BGZF_BLOCK_DATA_MAX
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+MODES = ['former-rule', 'bcftools', 'vcfcat-merge', 'vcfcat-scan']
+
+HEADER = """##fileformat=VCFv4.2
+##ALT=<ID=NON_REF,Description="Represents any possible alternative allele at this location">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">
+##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">
+##INFO=<ID=END,Number=1,Type=Integer,Description="Stop position of the interval">
+{contigs}
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	S1
+"""
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def gvcf_lines(chroms, num_records, rand):
+    """Yield synthetic gVCF record lines (reference blocks and
+    variants) for chroms
+    """
+    for chrom in chroms:
+        pos = 1
+        for _ in range(num_records):
+            if rand.random() < 0.8:
+                end = pos + rand.randint(0, 200)
+                yield "{}\t{}\t.\tA\t<NON_REF>\t.\t.\tEND={}\tGT:DP:GQ\t0/0:{}:{}\n".format(
+                    chrom, pos, end, rand.randint(0, 60), rand.randint(0, 99))
+                pos = end + 1
+            else:
+                yield "{}\t{}\t.\tC\tT,<NON_REF>\t{:.2f}\t.\t.\tGT:DP:GQ\t0/1:{}:{}\n".format(
+                    chrom, pos, rand.uniform(10, 1000), rand.randint(0, 60), rand.randint(0, 99))
+                pos += 1
+
+
+def write_gvcf(path, chroms, contigs, num_records, seed):
+    """Write BGZF compressed gVCF for chroms with tabix index"""
+    rand = random.Random(seed)
+    data = (HEADER.format(contigs=contigs) + "".join(
+        gvcf_lines(chroms, num_records, rand))).encode()
+    indexer = VcfTabixIndexer()
+    with open(path, 'wb') as fh:
+        writer = BgzfWriter(fh)
+        blocks = []
+        for i in range(0, len(data), BGZF_BLOCK_DATA_MAX):
+            blocks.extend(writer.write_data(data[i:i+BGZF_BLOCK_DATA_MAX]))
+        for (offset, chunk), nxt in zip(blocks, blocks[1:] + [(writer.offset, None)]):
+            indexer.feed(offset, chunk, nxt[0])
+        writer.close()
+    indexer.write(path + ".tbi")
+
+
+def concat_former_rule(vcfs, out_vcf):
+    """former concat_split_vcfs: decode lines, keep header of first
+    file and pipe through bgzip, then index with tabix
+    """
+    bgzip, tabix = shutil.which("bgzip"), shutil.which("tabix")
+    if bgzip and tabix:
+        fhout_raw = open(out_vcf, 'wb')
+        proc = subprocess.Popen([bgzip, '--'], stdin=subprocess.PIPE, stdout=fhout_raw)
+        fhout = io.TextIOWrapper(proc.stdin)
+    else:
+        import pysam
+        fhout = io.TextIOWrapper(pysam.libcbgzf.BGZFile(out_vcf, 'wb'))
+    header_printed = False
+    for f in vcfs:
+        with gzip.open(f) as fhingz:
+            with io.BufferedReader(fhingz) as fhin:
+                had_header = False
+                for line in fhin:
+                    line = line.decode()
+                    if line.startswith('#'):
+                        if not header_printed:
+                            had_header = True
+                            fhout.write(line)
+                    else:
+                        fhout.write(line)
+                if had_header:
+                    header_printed = True
+    fhout.close()
+    if bgzip and tabix:
+        proc.wait()
+        fhout_raw.close()
+        subprocess.check_call([tabix, '-f', '-p', 'vcf', out_vcf])
+    else:
+        pysam.tabix_index(out_vcf, preset='vcf', force=True)
+
+
+def concat_bcftools(vcfs, out_vcf):
+    """bcftools concat --naive, then tabix"""
+    subprocess.check_call(["bcftools", "concat", "--naive", "-O", "z", "-o", out_vcf] + vcfs)
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", out_vcf])
+
+
+def content_md5(path):
+    """md5sum of uncompressed content"""
+    md5 = hashlib.md5()
+    with gzip.open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--num-clusters', type=int, default=4,
+                        help="Number of region clusters, i.e. input gVCFs")
+    parser.add_argument('-n', '--num-records', type=int, default=160000,
+                        help="Number of records per cluster")
+    parser.add_argument('-t', '--tmpdir',
+                        help="Directory for input and output (default: system tmp)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    workdir = tempfile.mkdtemp(prefix="vcf_concat.", dir=args.tmpdir)
+    try:
+        chroms = ["chr{}".format(i + 1) for i in range(args.num_clusters)]
+        contigs = "\n".join("##contig=<ID={},length=250000000>".format(c) for c in chroms)
+        vcfs = []
+        for ctr, chrom in enumerate(chroms):
+            vcf = os.path.join(workdir, "in.{}.g.vcf.gz".format(ctr))
+            write_gvcf(vcf, [chrom], contigs, args.num_records, seed=ctr)
+            vcfs.append(vcf)
+        # same input without indices for vcfcat-scan
+        noidx_dir = os.path.join(workdir, "noidx")
+        os.mkdir(noidx_dir)
+        noidx_vcfs = []
+        for vcf in vcfs:
+            noidx_vcfs.append(os.path.join(noidx_dir, os.path.basename(vcf)))
+            shutil.copy(vcf, noidx_vcfs[-1])
+        input_bytes = sum(os.path.getsize(vcf) for vcf in vcfs)
+        logger.info("Wrote %d gVCFs with %d records each (%d bytes)",
+                    len(vcfs), args.num_records, input_bytes)
+
+        print("\t".join(["mode", "records", "input_bytes", "seconds"]))
+        md5s = dict()
+        for mode in MODES:
+            out_vcf = os.path.join(workdir, "{}.concat.g.vcf.gz".format(mode))
+            if mode == 'bcftools' and not (shutil.which("bcftools") and shutil.which("tabix")):
+                print("\t".join([mode, "-", "-", "skipped (bcftools or tabix not in PATH)"]))
+                continue
+            start = time.perf_counter()
+            if mode == 'former-rule':
+                concat_former_rule(vcfs, out_vcf)
+            elif mode == 'bcftools':
+                concat_bcftools(vcfs, out_vcf)
+            elif mode == 'vcfcat-merge':
+                concat_vcfs(vcfs, out_vcf)
+            elif mode == 'vcfcat-scan':
+                concat_vcfs(noidx_vcfs, out_vcf)
+            secs = time.perf_counter() - start
+            assert os.path.exists(out_vcf + ".tbi")
+            md5s[mode] = content_md5(out_vcf)
+            print("\t".join([mode, str(len(vcfs) * args.num_records), str(input_bytes),
+                             "{:.2f}".format(secs)]))
+        if len(set(md5s.values())) != 1:
+            logger.error("Output content differs between modes: %s", md5s)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -40,7 +40,7 @@ __license__ = "The MIT License (MIT)"
 yaml.Dumper.ignore_aliases = lambda *args: True
 
 
-PIPELINE_BASEDIR = os.path.dirname(sys.argv[0])
+PIPELINE_BASEDIR = os.path.dirname(os.path.realpath(__file__))
 CFG_DIR = os.path.join(PIPELINE_BASEDIR, "cfg")
 
 # same as folder name. also used for cluster job names
@@ -12,7 +12,6 @@ from collections import namedtuple
 
 #--- third party imports
 #
-import requests
 import pymongo
 import yaml
 
@@ -23,14 +22,17 @@ LIB_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
-from config import rest_services
 from config import legacy_mapper
 from mongodb import mongodb_conn
+from mongodb import ensure_indexes, INDEXES
+from mongodb import BulkWriter
 from pipelines import generate_window
 from pipelines import get_site
 from pipelines import send_mail
 from pipelines import get_machine_run_flowcell_id
 from readunits import key_for_readunit
+from rest import run_details
+from rest import run_details_many
 
 ReadUnit = namedtuple('ReadUnit', ['run_id', 'flowcell_id', 'library_id',
                                    'lane_id', 'rg_id', 'fq1', 'fq2'])
@@ -68,44 +70,30 @@ def check_fastq(fastq_data_dir, libid, laneId):
     else:
         return False, None, None
 
-def mongodb_update_runcomplete(run_num_flowcell, analysis_id, mux_id, insert_id, connection):
-    """Change the status to DELEGATED in runcomplete collection of MongoDB
+def mongodb_update_runcomplete(run_num_flowcell, analysis_id, mux_id, insert_id, bulk):
+    """Queue status change to DELEGATED in runcomplete collection of
+    MongoDB. bulk is a BulkWriter for runcomplete
     """
-    try:
-        db = connection.gisds.runcomplete
-        db.update({"run": run_num_flowcell, \
-            'analysis.analysis_id' : analysis_id, \
-            'analysis.per_mux_status.mux_id' : mux_id}, \
-            {"$set": {insert_id: "DELEGATED", }})
-        logger.info("MONGO DB updated")
-    except pymongo.errors.OperationFailure:
-        logger.fatal("MongoDB OperationFailure")
-        return False
-    else:
-        return True
+    bulk.update_one({"run": run_num_flowcell, \
+        'analysis.analysis_id' : analysis_id, \
+        'analysis.per_mux_status.mux_id' : mux_id}, \
+        {"$set": {insert_id: "DELEGATED", }})
 
-def mongodb_insert_libjob(lib_info, connection):
-    """Insert records into pipeline_runs collection of MongoDB
+def mongodb_insert_libjobs(lib_infos, connection):
+    """Insert records into pipeline_runs collection of MongoDB in one
+    ordered bulk insert
     """
+    if not lib_infos:
+        return True
     try:
         db = connection.gisds.pipeline_runs
-        db.insert_one(lib_info)
+        db.insert_many(lib_infos, ordered=True)
     except pymongo.errors.OperationFailure:
         logger.fatal("mongoDB OperationFailure")
         return False
     else:
         return True
 
-def mongodb_remove_muxjob(mux_id, run_id, ctime, connection):
-    """Delete libraries from MUX, runID and ctime if insertion fails
-    """
-    try:
-        db = connection.gisds.runcomplete
-        db.remove({"run_id": run_id, "mux_id": mux_id, "ctime": ctime})
-    except pymongo.errors.OperationFailure:
-        logger.fatal("mongoDB OperationFailure")
-        sys.exit(1)
-
 def get_reference_info(analysis, pipeline_version, ref, site=None):
     """reference yaml for each library
     """
@@ -227,16 +215,11 @@ def get_lib_details(run_num_flowcell, mux_list, testing):
     _, run_num, _ = get_machine_run_flowcell_id(run_num_flowcell)
     # Call rest service to get component libraries
     if testing:
-        rest_url = rest_services['run_details']['testing'].replace("run_num", run_num)
         logger.info("development server")
     else:
-        rest_url = rest_services['run_details']['production'].replace("run_num", run_num)
         logger.info("production server")
-    response = requests.get(rest_url)
-    if response.status_code != requests.codes.ok:
-        response.raise_for_status()
-    rest_data = response.json()
-    logger.debug("rest_data from %s: %s", rest_url, rest_data)
+    rest_data = run_details(run_num, testing)
+    logger.debug("rest_data for %s: %s", run_num, rest_data)
     sample_info = {}
     mux_analysis_list = set()
     if rest_data.get('runId') is None:
@@ -295,10 +278,14 @@ def main():
     connection = mongodb_conn(args.testing)
     if connection is None:
         sys.exit(1)
+    if not args.dry_run:
+        ensure_indexes(connection.gisds, {'runcomplete': INDEXES['runcomplete']})
     db = connection.gisds.runcomplete
     epoch_present, epoch_back = generate_window(args.win)
     results = db.find({"analysis.per_mux_status" : {"$exists": True},
-                       "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
+                       "timestamp": {"$gt": epoch_back, "$lt": epoch_present}},
+                      projection=['run', 'analysis.analysis_id', 'analysis.out_dir',
+                                  'analysis.per_mux_status'])
     logger.info("Found %s runs", results.count())
     run_list = {}
     mongo_db_ref = {}
@@ -344,6 +331,10 @@ def main():
                 continue
             mux_info = (mux_id, out_dir)
             run_list.setdefault(run_number, []).append(mux_info)
+    # fetch ELM details of all runs concurrently. cached for
+    # get_lib_details(). best-effort: errors surface there, per run
+    run_details_many([get_machine_run_flowcell_id(r)[1] for r in run_list],
+                     args.testing, raise_errors=False)
     for run_num_flowcell, mux_list in run_list.items():
         update_status = True
         pipeline_params_dict, mux_analysis_list = get_lib_details(run_num_flowcell, \
@@ -352,6 +343,7 @@ def main():
             logger.warning("pipeline params is empty for run num %s", run_num_flowcell)
             continue
         # Insert jobs into pipeline_runs collection
+        jobs = []
         for lib, lib_info in pipeline_params_dict.items():
             job = {}
             rd_list = {}
@@ -380,45 +372,45 @@ def main():
                 logger.warning("Skipping job delegation for %s", \
                     lib)
                 continue
-            res = mongodb_insert_libjob(job, connection)
-            if not res:
-                logger.critical("Skipping rest of analysis job submission" \
-                     "for %s from %s", lib, lib_info.run_id)
-                subject = "Downstream delegator failed job submission for" \
-                    "{}".format(lib)
-                if args.testing:
-                    subject += " (testing)"
-                body = "Downstream delegator failed to insert job submission for" \
-                    "{}".format(lib)
-                send_mail(subject, body, toaddr='veeravallil', ccaddr=None)
-                update_status = False
-                logger.warning("Clean up the database for mux %s from run %s and ctime %s", \
-                    lib_info.mux_id, lib_info.run_id, lib_info.ctime)
-                mongodb_remove_muxjob(lib_info.mux_id, lib_info.run_id, \
-                    lib_info.ctime, connection)
-                break
+            jobs.append(job)
+        # Insert jobs of this run into pipeline_runs collection in one go
+        res = mongodb_insert_libjobs(jobs, connection)
+        if not res:
+            libs = ", ".join(pipeline_params_dict.keys())
+            logger.critical("Skipping rest of analysis job submission" \
+                 "for %s from %s", libs, run_num_flowcell)
+            subject = "Downstream delegator failed job submission for" \
+                "{}".format(run_num_flowcell)
+            if args.testing:
+                subject += " (testing)"
+            body = "Downstream delegator failed to insert job submission for" \
+                "{}".format(libs)
+            send_mail(subject, body, toaddr='veeravallil', ccaddr=None)
+            update_status = False
         # Update runcomplete collection for delegated jobs
         if not args.dry_run and update_status:
+            bulk = BulkWriter(connection.gisds.runcomplete)
             value = mongo_db_ref[run_num_flowcell]
             for mux_id, insert_id, analysis_id in value:
                 if mux_id in mux_analysis_list:
                     logger.info("Update mongoDb pipeline_runs for mux_id %s from run number %s" \
                         "and analysis_id is %s", mux_id, run_num_flowcell, analysis_id)
-                    res = mongodb_update_runcomplete(run_num_flowcell, analysis_id, mux_id, \
-                        insert_id, connection)
-                    if not res:
-                        logger.critical("Skipping rest of analysis job submission for %s" \
-                            "from %s", mux_id, run_num_flowcell)
-                        subject = "Downstream delegator failed job submission for {}" \
-                            .format(mux_id)
-                        if args.testing:
-                            subject += " (testing)"
-                        body = "Downstream delegator failed to insert job submission for" \
-                            "{}".format(mux_id)
-                        send_mail(subject, body, toaddr='veeravallil', ccaddr=None)
-                        update_status = False
-                        break
-    connection.close()
+                    mongodb_update_runcomplete(run_num_flowcell, analysis_id, mux_id, \
+                        insert_id, bulk)
+            try:
+                bulk.flush()
+                logger.info("MONGO DB updated")
+            except pymongo.errors.OperationFailure:
+                logger.fatal("MongoDB OperationFailure")
+                logger.critical("Skipping rest of analysis job submission for %s", \
+                    run_num_flowcell)
+                subject = "Downstream delegator failed job submission for {}" \
+                    .format(run_num_flowcell)
+                if args.testing:
+                    subject += " (testing)"
+                body = "Downstream delegator failed to update runcomplete for" \
+                    "{}".format(run_num_flowcell)
+                send_mail(subject, body, toaddr='veeravallil', ccaddr=None)
 
 if __name__ == "__main__":
     logger.info("Jobs delegated")
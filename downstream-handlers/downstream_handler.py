@@ -14,6 +14,7 @@ import glob
 from datetime import datetime
 import tempfile
 import subprocess
+import shlex
 
 #--- third party imports
 #
@@ -30,6 +31,8 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import ensure_indexes, INDEXES
+from mongodb import BulkWriter
 from pipelines import is_production_user
 from pipelines import generate_window
 from pipelines import get_downstream_outdir
@@ -65,12 +68,17 @@ HANDLER.setFormatter(logging.Formatter(
 LOGGER.addHandler(HANDLER)
 
 
+# fields needed for status checks. full records are only fetched for
+# jobs to be started
+STATUS_PROJECTION = ['execution', 'out_dir_override', 'requestor',
+                     'pipeline_name', 'pipeline_version']
+
 # warning thresholds
 THRESHOLD_H_SINCE_LAST_TIMESTAMP = 24
 THRESHOLD_H_SINCE_START = 72
 
-def start_cmd_execution(record, site, out_dir, testing):
-    """ Start the analysis
+def get_pipeline_cmd(record, site, out_dir):
+    """ Create (shell) command that starts the analysis for record
     """
     pipeline_params = " "
     extra_conf = " --extra-conf "
@@ -117,6 +125,12 @@ def start_cmd_execution(record, site, out_dir, testing):
         pipeline_cmd += pipeline_params
     if extra_conf:
         pipeline_cmd += extra_conf
+    return pipeline_cmd
+
+def start_cmd_execution(record, site, out_dir, testing):
+    """ Start the analysis
+    """
+    pipeline_cmd = get_pipeline_cmd(record, site, out_dir)
     try:
         LOGGER.info(pipeline_cmd)
         _ = subprocess.check_output(pipeline_cmd, stderr=subprocess.STDOUT, shell=True)
@@ -126,7 +140,26 @@ def start_cmd_execution(record, site, out_dir, testing):
             e.returncode, ' '.join(pipeline_cmd))
         LOGGER.fatal("Output: %s", e.output.decode())
         return False
-    
+
+def start_batch_execution(jobs, site):
+    """ Start analyses for all (record, out_dir) tuples in jobs within
+    this process (see PipelineHandler.setup_many). Returns success
+    status per job
+    """
+    records = []
+    for record, out_dir in jobs:
+        pipeline_cmd = shlex.split(get_pipeline_cmd(record, site, out_dir))
+        LOGGER.info(' '.join(pipeline_cmd))
+        records.append((pipeline_cmd[0], pipeline_cmd[1:]))
+    return PipelineHandler.setup_many(records)
+
+def set_job_out_dir(bulk, dbid, out_dir):
+    """ Record out_dir of started job
+    """
+    bulk.update_one(
+        {"_id": ObjectId(dbid)},
+        {"$set": {"execution.out_dir": out_dir}})
+
 def get_pipeline_path(site, pipeline_name, pipeline_version):
     """ get the pipeline path
     """
@@ -148,13 +181,12 @@ def list_starterflags(path):
     return glob.glob(os.path.join(
         path, StarterFlag.pattern.format(timestamp="*")))
 
-def set_completion_if(dbcol, dbid, out_dir, dryrun=False):
-    """Update values for already started job based on log file in out_dir
+def set_completion_if(bulk, rec, out_dir, dryrun=False):
+    """Update values for already started job (rec) based on log file in
+    out_dir. Updates are queued in bulk (BulkWriter)
     """
 
-    rec = dbcol.find_one({"_id": dbid})
-    assert rec, "No objects found with db-id {}".format(dbid)
-
+    dbid = rec['_id']
     assert rec.get('execution'), ("Looks like job %s was never started", dbid)
     old_status = rec['execution'].get('status')
     start_time = rec['execution'].get('start_time')
@@ -177,14 +209,14 @@ def set_completion_if(dbcol, dbid, out_dir, dryrun=False):
 
     if status == "SUCCESS":
         assert end_time
-        dbcol.update_one({"_id": ObjectId(dbid)},
-                         {"$set": {"execution.status": "SUCCESS",
-                                   "execution.end_time": end_time}})
+        bulk.update_one({"_id": ObjectId(dbid)},
+                        {"$set": {"execution.status": "SUCCESS",
+                                  "execution.end_time": end_time}})
     elif status == "ERROR":
         assert end_time
-        dbcol.update_one({"_id": ObjectId(dbid)},
-                         {"$set": {"execution.status": "FAILED",
-                                   "execution.end_time": end_time}})
+        bulk.update_one({"_id": ObjectId(dbid)},
+                        {"$set": {"execution.status": "FAILED",
+                                  "execution.end_time": end_time}})
     else:
         if end_time:# without status end_time means last seen time in snakemake
             delta = datetime.now() - dateutil.parser.parse(end_time)
@@ -200,11 +232,11 @@ def set_completion_if(dbcol, dbid, out_dir, dryrun=False):
             LOGGER.warning("Job id %s was started %s hours ago. That's a bit long", dbid, diff_hours)
 
 
-def set_started(dbcol, dbid, start_time, dryrun=False):
-    """Update records for started or restarted analysis
+def set_started(bulk, rec, start_time, dryrun=False):
+    """Update records for started or restarted analysis (rec). Updates
+    are queued in bulk (BulkWriter)
     """
-    rec = dbcol.find_one({"_id": ObjectId(dbid)})
-    assert rec, "No objects found with db-id {}".format(dbid)
+    dbid = rec['_id']
 
     # determine if this is a start or a restart (or a mistake)
     assert rec.get('execution')
@@ -220,27 +252,15 @@ def set_started(dbcol, dbid, start_time, dryrun=False):
         return
     out_dir = rec['execution'].get('out_dir')
     if mode == 'start':
-        res = dbcol.update_one(
+        bulk.update_one(
             {"_id": ObjectId(dbid)},
             {"$set": {"execution": {"start_time" : start_time, "status" : "STARTED", "out_dir" : out_dir}}})
-        assert res.modified_count == 1, (
-            "Modified {} documents instead of 1".format(res.modified_count))
 
     elif mode == 'restart':
-        res = dbcol.update_one({"_id": ObjectId(dbid)},
-                               {"$set": {"execution.status": "RESTART"}})
-        assert res.modified_count == 1, (
-            "Modified {} documents instead of 1".format(res.modified_count))
-
-        res = dbcol.update_one({"_id": ObjectId(dbid)},
-                               {"$unset": {"execution.end_time": ""}})
-        assert res.modified_count == 1, (
-            "Modified {} documents instead of 1".format(res.modified_count))
-
-        res = dbcol.update_one({"_id": ObjectId(dbid)},
-                               {"$inc":{"execution.num_restarts": 1}})
-        assert res.modified_count == 1, (
-            "Modified {} documents instead of 1".format(res.modified_count))
+        bulk.update_one({"_id": ObjectId(dbid)},
+                        {"$set": {"execution.status": "RESTART"},
+                         "$unset": {"execution.end_time": ""},
+                         "$inc": {"execution.num_restarts": 1}})
 
     else:
         raise ValueError(mode)
@@ -254,6 +274,10 @@ def main():
                         help="Don't actually update DB (best used in conjunction with -v -v)")
     parser.add_argument('-t', "--testing", action='store_true',
                         help="Use MongoDB test-server. Don't do anything")
+    parser.add_argument('-b', "--batch", action='store_true',
+                        help="Set up all new analyses within this process and"
+                        " submit them together (instead of one wrapper call per analysis)."
+                        " Only pipelines of this installation's version run in-process")
     default = 14
     parser.add_argument('-w', '--win', type=int, default=default,
                         help="Number of days to look back (default {})".format(default))
@@ -275,11 +299,18 @@ def main():
     if connection is None:
         sys.exit(1)
     #LOGGER.info("Database connection established")
+    if not args.dryrun:
+        ensure_indexes(connection.gisds, {'pipeline_runs': INDEXES['pipeline_runs']})
     dbcol = connection.gisds.pipeline_runs
+    # all status changes are sent in bulk
+    bulk = BulkWriter(dbcol, dryrun=args.dryrun)
     site = get_site()
     epoch_now, epoch_then = generate_window(args.win)
-    cursor = dbcol.find({"ctime": {"$gt": epoch_then, "$lt": epoch_now}, "site" : site})
+    cursor = dbcol.find({"ctime": {"$gt": epoch_then, "$lt": epoch_now}, "site" : site},
+                        projection=STATUS_PROJECTION)
     LOGGER.info("Looping through {} jobs".format(cursor.count()))
+    jobs_to_start = []
+    used_starterflags = []
     for job in cursor:
         dbid = job['_id']
         # only set here to avoid code duplication below
@@ -299,6 +330,7 @@ def main():
                     mux = os.path.basename(out_dir)
                     if not args.dryrun:
                         LOGGER.critical("Analysis for {} already exists under {}. Please start the analysis manually" .format(mux, out_dir))
+                        bulk.flush()
                         res = dbcol.update_one({"_id": ObjectId(dbid)},
                                         {"$set": {"execution.status": "MANUAL"}})
                         assert res.modified_count == 1, (
@@ -316,15 +348,7 @@ def main():
             if args.dryrun:
                 LOGGER.info("Skipping dry run option")
                 continue
-            status = start_cmd_execution(job, site, out_dir, args.testing)
-            if status:
-                res = dbcol.update_one(
-                    {"_id": ObjectId(dbid)},
-                    {"$set": {"execution.out_dir": out_dir}})
-                assert res.modified_count == 1, (
-                    "Modified {} documents instead of 1".format(res.modified_count))
-            else:
-                LOGGER.warning("Job {} could not be started".format(dbid))
+            jobs_to_start.append((dbid, out_dir))
         elif job['execution'].get('status') == "MANUAL":
             continue
         elif list_starterflags(out_dir):# out_dir cannot be none because it's part of execution dict 
@@ -336,16 +360,45 @@ def main():
                 "Got several starter flags in {}".format(out_dir))
             sflag = StarterFlag(matches[0])
             assert sflag.dbid == str(dbid)
-            set_started(dbcol, sflag.dbid, str(sflag.timestamp), dryrun=args.dryrun)
-            os.unlink(sflag.filename)
+            set_started(bulk, job, str(sflag.timestamp), dryrun=args.dryrun)
+            if not args.dryrun:
+                used_starterflags.append(sflag.filename)
 
         elif job['execution'].get('status') in ['STARTED', 'RESTART']:
             LOGGER.info('Job %s in %s set as re|started so checking on completion', dbid, out_dir)
-            set_completion_if(dbcol, dbid, out_dir, dryrun=args.dryrun)
+            set_completion_if(bulk, job, out_dir, dryrun=args.dryrun)
 
         else:
             # job complete
             LOGGER.debug('Job %s in %s should be completed', dbid, out_dir)
+
+    # only remove starter flags once their status is in the DB
+    bulk.flush()
+    for flagfile in used_starterflags:
+        os.unlink(flagfile)
+
+    if jobs_to_start:
+        # full records (incl. sample config) fetched in one go
+        out_dirs = dict(jobs_to_start)
+        records = dict((rec['_id'], rec) for rec in dbcol.find(
+            {"_id": {"$in": list(out_dirs.keys())}}))
+        jobs = [(records[dbid], out_dir) for dbid, out_dir in jobs_to_start]
+        if args.batch:
+            LOGGER.info("Starting %d jobs in batch mode", len(jobs))
+            statuses = start_batch_execution(jobs, site)
+        else:
+            statuses = [None] * len(jobs)
+        for i, (job, out_dir) in enumerate(jobs):
+            if statuses[i] is None:
+                statuses[i] = start_cmd_execution(job, site, out_dir, args.testing)
+            if statuses[i]:
+                set_job_out_dir(bulk, job['_id'], out_dir)
+                if not args.batch:
+                    # record right away: execution.out_dir prevents double starts
+                    bulk.flush()
+            else:
+                LOGGER.warning("Job {} could not be started".format(job['_id']))
+        bulk.flush()
     LOGGER.info("Successful program exit")
 
 if __name__ == "__main__":
@@ -0,0 +1,466 @@
+"""Collection and analysis of Snakemake benchmark logs
+
+Rules write benchmark logs named {output}.{rule}.benchmark.log (see
+tools/pipelint.py). These are collected per analysis (output
+directory) into an SQLite database together with wildcards and
+threads taken from the Snakemake log, which allows per rule runtime
+distributions, regressions between pipeline versions and finding the
+most expensive rules. Scheduler accounting records of the analysis
+(logs/*.acct, see tools/logs2acct.py) are collected as well.
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import logging
+import sqlite3
+import statistics
+from datetime import datetime
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+from readunits import max_sample_input_bytes
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+BENCHMARK_SUFFIX = ".benchmark.log"
+
+# columns written by different Snakemake versions (older ones only
+# have s and h:m:s). sizes are in MB, io in MB, load in percent
+METRICS = ['s', 'max_rss', 'max_vms', 'max_uss', 'max_pss',
+           'io_in', 'io_out', 'mean_load', 'cpu_time']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+  id INTEGER PRIMARY KEY,
+  outdir TEXT UNIQUE NOT NULL,
+  pipeline_name TEXT,
+  pipeline_version TEXT,
+  input_bytes INTEGER,
+  collected TEXT
+);
+CREATE TABLE IF NOT EXISTS benchmarks (
+  analysis_id INTEGER NOT NULL REFERENCES analyses(id),
+  rule TEXT NOT NULL,
+  target TEXT NOT NULL,
+  wildcards TEXT,
+  threads INTEGER,
+  {metrics}
+);
+CREATE INDEX IF NOT EXISTS benchmarks_rule ON benchmarks(rule);
+CREATE INDEX IF NOT EXISTS benchmarks_analysis ON benchmarks(analysis_id);
+CREATE TABLE IF NOT EXISTS accounting (
+  analysis_id INTEGER NOT NULL REFERENCES analyses(id),
+  rule TEXT NOT NULL,
+  jobnumber INTEGER,
+  wall_s REAL,
+  maxvmem_mb REAL,
+  slots INTEGER,
+  failed INTEGER
+);
+CREATE INDEX IF NOT EXISTS accounting_analysis ON accounting(analysis_id);
+""".format(metrics=",\n  ".join("{} REAL".format(m) for m in METRICS))
+
+# job info in snakemake log: optional timestamp, then rule name
+JOB_START_RE = re.compile(r'^(?:\[[^\]]+\]\s*)?(?:local)?rule (\S+):\s*$')
+
+# cluster job names as set in run.template.*.sh
+JOBNAME_RE = re.compile(r'\.slave\.(\w+)\.\d+\.sh$')
+
+# qacct size units
+SIZE_UNITS_MB = {'B': 1.0/1024**2, 'K': 1.0/1024, 'M': 1.0, 'G': 1024.0, 'T': 1024.0**2}
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def find_benchmark_logs(outdir):
+    """Yield benchmark logs below outdir (skipping hidden directories
+    like .snakemake)
+    """
+    for root, dirs, files in os.walk(outdir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for f in files:
+            if f.endswith(BENCHMARK_SUFFIX):
+                yield os.path.join(root, f)
+
+
+def rule_and_target(benchmark_log):
+    """Return rule name and target (i.e. output) encoded in name of
+    benchmark log
+
+    >>> rule_and_target("out/s1.bam.bwa_mem.benchmark.log")
+    ('bwa_mem', 'out/s1.bam')
+    """
+    assert benchmark_log.endswith(BENCHMARK_SUFFIX)
+    target, rule = benchmark_log[:-len(BENCHMARK_SUFFIX)].rsplit(".", 1)
+    return rule, target
+
+
+def parse_benchmark_log(benchmark_log):
+    """Return list of dicts (one per repeat) with values for METRICS
+    found in benchmark_log. Missing values are None
+    """
+    records = []
+    with open(benchmark_log) as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+        for line in fh:
+            values = line.rstrip("\n").split("\t")
+            if len(values) != len(header):
+                continue
+            record = dict((m, None) for m in METRICS)
+            for k, v in zip(header, values):
+                if k in record:
+                    try:
+                        record[k] = float(v)
+                    except ValueError:
+                        # e.g. NA or '-'
+                        pass
+            records.append(record)
+    return records
+
+
+def parse_snakemake_log(snakemake_log):
+    """Return dict of benchmark log path to dict with wildcards and
+    threads of the job writing it, as listed in snakemake_log
+    """
+    jobs = dict()
+    job = None
+    with open(snakemake_log) as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            match = JOB_START_RE.match(line)
+            if match:
+                job = {'rule': match.group(1)}
+                continue
+            if job is None:
+                continue
+            if not line.startswith((" ", "\t")) or ":" not in line:
+                if job.get('benchmark'):
+                    jobs[job['benchmark']] = job
+                job = None
+                continue
+            key, value = line.strip().split(":", 1)
+            job[key] = value.strip()
+    if job and job.get('benchmark'):
+        jobs[job['benchmark']] = job
+    return jobs
+
+
+def analysis_info(outdir):
+    """Return pipeline name and version of analysis in outdir"""
+    try:
+        with open(os.path.join(outdir, "conf.yaml")) as fh:
+            cfg = yaml.safe_load(fh)
+        elm = cfg.get('ELM', dict())
+        return elm.get('pipeline_name'), elm.get('pipeline_version')
+    except (OSError, AttributeError, yaml.YAMLError):
+        return None, None
+
+
+def size_to_mb(size):
+    """Convert qacct size (e.g. 1.5G) to MB
+
+    >>> size_to_mb("1.500G")
+    1536.0
+    >>> size_to_mb("512")
+    0.00048828125
+    """
+    size = size.strip()
+    if size and size[-1].upper() in SIZE_UNITS_MB:
+        return float(size[:-1]) * SIZE_UNITS_MB[size[-1].upper()]
+    return float(size) * SIZE_UNITS_MB['B']
+
+
+def parse_qacct(acct_file):
+    """Return list of job records (dicts with rule, jobnumber, wall_s,
+    maxvmem_mb, slots and failed) in output of qacct -j. Records of jobs
+    not submitted by Snakemake are skipped
+    """
+    records = []
+    raw = None
+    with open(acct_file) as fh:
+        lines = fh.read().splitlines()
+    for line in lines + ["="]:
+        if line.startswith("="):
+            if raw:
+                match = JOBNAME_RE.search(raw.get('jobname', ''))
+                if match:
+                    records.append({
+                        'rule': match.group(1),
+                        'jobnumber': int(raw['jobnumber']) if 'jobnumber' in raw else None,
+                        'wall_s': float(raw['ru_wallclock'].rstrip('s')) if 'ru_wallclock' in raw else None,
+                        'maxvmem_mb': size_to_mb(raw['maxvmem']) if 'maxvmem' in raw else None,
+                        'slots': int(raw['slots']) if 'slots' in raw else None,
+                        'failed': int(raw.get('failed', '0').split()[0]) or int(raw.get('exit_status', '0').split()[0])})
+            raw = dict()
+            continue
+        if raw is not None and line.strip():
+            key, _, value = line.partition(" ")
+            raw[key] = value.strip()
+    return records
+
+
+def analysis_input_bytes(outdir):
+    """Return size of largest sample's input of analysis in outdir or
+    None if unknown
+    """
+    try:
+        with open(os.path.join(outdir, "conf.yaml")) as fh:
+            cfg = yaml.safe_load(fh)
+        return max_sample_input_bytes(cfg['samples'], cfg['readunits'])
+    except (OSError, KeyError, TypeError, yaml.YAMLError):
+        return None
+
+
+def percentile(values, pct):
+    """Percentile of sorted values (nearest rank)
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 90)
+    4
+    """
+    if not values:
+        return None
+    k = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+def version_key(version):
+    """Sort key for version strings, comparing numbers numerically
+
+    >>> sorted(["1.10", "1.9", "1.9-rc1"], key=version_key)
+    ['1.9', '1.9-rc1', '1.10']
+    """
+    return [(0, int(p), "") if p.isdigit() else (1, 0, p)
+            for p in re.findall(r'\d+|[^\d.\-_]+', version)]
+
+
+class BenchmarkStore(object):
+    """SQLite store of benchmark logs. Use ':memory:' as dbfile for a
+    temporary store
+    """
+
+    def __init__(self, dbfile):
+        self.conn = sqlite3.connect(dbfile)
+        self.conn.executescript(SCHEMA)
+
+
+    def close(self):
+        """close database"""
+        self.conn.close()
+
+
+    def add_analysis(self, outdir, snakemake_log=None):
+        """Collect all benchmark logs and accounting records of analysis
+        in outdir, replacing previously collected ones. Wildcards and
+        threads are taken from snakemake_log (default:
+        logs/snakemake.log in outdir) if it exists. Returns number of
+        stored benchmark records
+        """
+        outdir = os.path.abspath(outdir)
+        if snakemake_log is None:
+            snakemake_log = os.path.join(outdir, "logs", "snakemake.log")
+        jobs = dict()
+        if os.path.exists(snakemake_log):
+            jobs = parse_snakemake_log(snakemake_log)
+        else:
+            logger.debug("No snakemake log found for %s", outdir)
+
+        rows = []
+        for log in find_benchmark_logs(outdir):
+            rule, target = rule_and_target(os.path.relpath(log, outdir))
+            job = jobs.get(os.path.relpath(log, outdir), dict())
+            threads = job.get('threads')
+            try:
+                records = parse_benchmark_log(log)
+            except OSError as e:
+                logger.warning("Skipping %s: %s", log, e)
+                continue
+            for record in records:
+                rows.append([rule, target, job.get('wildcards'),
+                             int(threads) if threads else None] +
+                            [record[m] for m in METRICS])
+
+        acct_records = []
+        for root, _, files in os.walk(os.path.join(outdir, "logs")):
+            for f in files:
+                if f.endswith(".acct"):
+                    acct_records.extend(parse_qacct(os.path.join(root, f)))
+
+        pipeline_name, pipeline_version = analysis_info(outdir)
+        input_bytes = analysis_input_bytes(outdir)
+        with self.conn:
+            cur = self.conn.execute("SELECT id FROM analyses WHERE outdir = ?", (outdir,))
+            row = cur.fetchone()
+            if row:
+                analysis_id = row[0]
+                self.conn.execute("DELETE FROM benchmarks WHERE analysis_id = ?", (analysis_id,))
+                self.conn.execute("DELETE FROM accounting WHERE analysis_id = ?", (analysis_id,))
+                self.conn.execute(
+                    "UPDATE analyses SET pipeline_name = ?, pipeline_version = ?, input_bytes = ?,"
+                    " collected = ? WHERE id = ?",
+                    (pipeline_name, pipeline_version, input_bytes,
+                     datetime.now().isoformat(), analysis_id))
+            else:
+                cur = self.conn.execute(
+                    "INSERT INTO analyses (outdir, pipeline_name, pipeline_version, input_bytes,"
+                    " collected) VALUES (?, ?, ?, ?, ?)",
+                    (outdir, pipeline_name, pipeline_version, input_bytes,
+                     datetime.now().isoformat()))
+                analysis_id = cur.lastrowid
+            self.conn.executemany(
+                "INSERT INTO benchmarks (analysis_id, rule, target, wildcards, threads, {})"
+                " VALUES ({})".format(", ".join(METRICS), ", ".join(["?"] * (len(METRICS) + 5))),
+                ([analysis_id] + row for row in rows))
+            self.conn.executemany(
+                "INSERT INTO accounting (analysis_id, rule, jobnumber, wall_s, maxvmem_mb, slots,"
+                " failed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((analysis_id, r['rule'], r['jobnumber'], r['wall_s'], r['maxvmem_mb'],
+                  r['slots'], r['failed']) for r in acct_records))
+        return len(rows)
+
+
+    def _values(self, column, pipeline=None, group_by='rule'):
+        """Return dict of group to sorted non-null values of column"""
+        sql = ("SELECT b.{group}, b.{col} FROM benchmarks b"
+               " JOIN analyses a ON a.id = b.analysis_id"
+               " WHERE b.{col} IS NOT NULL").format(group=group_by, col=column)
+        params = []
+        if pipeline:
+            sql += " AND a.pipeline_name = ?"
+            params.append(pipeline)
+        values = dict()
+        for group, value in self.conn.execute(sql, params):
+            values.setdefault(group, []).append(value)
+        for v in values.values():
+            v.sort()
+        return values
+
+
+    def rule_stats(self, pipeline=None):
+        """Return list of per rule dicts with number of jobs and
+        median, 90th percentile and maximum of wall time (s) and max RSS
+        (MB), sorted by rule
+        """
+        walltimes = self._values('s', pipeline)
+        rss = self._values('max_rss', pipeline)
+        stats = []
+        for rule in sorted(walltimes):
+            s = walltimes[rule]
+            r = rss.get(rule, [])
+            stats.append({'rule': rule, 'jobs': len(s),
+                          's_median': statistics.median(s),
+                          's_p90': percentile(s, 90),
+                          's_max': s[-1],
+                          'rss_median': statistics.median(r) if r else None,
+                          'rss_max': r[-1] if r else None})
+        return stats
+
+
+    def top_rules(self, n=10, pipeline=None):
+        """Return n most expensive rules as list of dicts with number of
+        jobs, total wall time (h) and total core time (h, wall time times
+        threads, assuming one thread if unknown), sorted by core time
+        """
+        sql = ("SELECT b.rule, COUNT(*), SUM(b.s), SUM(b.s * COALESCE(b.threads, 1)),"
+               " MAX(b.max_rss) FROM benchmarks b"
+               " JOIN analyses a ON a.id = b.analysis_id WHERE b.s IS NOT NULL")
+        params = []
+        if pipeline:
+            sql += " AND a.pipeline_name = ?"
+            params.append(pipeline)
+        sql += " GROUP BY b.rule ORDER BY 4 DESC LIMIT ?"
+        params.append(n)
+        return [{'rule': rule, 'jobs': jobs, 'wall_h': wall / 3600.0,
+                 'core_h': core / 3600.0, 'rss_max': rss}
+                for rule, jobs, wall, core, rss in self.conn.execute(sql, params)]
+
+
+    def version_regressions(self, pipeline=None, min_ratio=1.2, min_jobs=3):
+        """Compare median wall time per rule between consecutive pipeline
+        versions. Returns list of dicts for rules where the ratio is at
+        least min_ratio, with at least min_jobs jobs in both versions
+        """
+        sql = ("SELECT a.pipeline_name, a.pipeline_version, b.rule, b.s"
+               " FROM benchmarks b JOIN analyses a ON a.id = b.analysis_id"
+               " WHERE b.s IS NOT NULL AND a.pipeline_version IS NOT NULL")
+        params = []
+        if pipeline:
+            sql += " AND a.pipeline_name = ?"
+            params.append(pipeline)
+        values = dict()# (pipeline, rule) -> version -> walltimes
+        for name, version, rule, s in self.conn.execute(sql, params):
+            values.setdefault((name, rule), dict()).setdefault(str(version), []).append(s)
+
+        regressions = []
+        for (name, rule), per_version in sorted(values.items(), key=lambda x: (str(x[0][0]), x[0][1])):
+            versions = sorted(per_version, key=version_key)
+            for old, new in zip(versions, versions[1:]):
+                if len(per_version[old]) < min_jobs or len(per_version[new]) < min_jobs:
+                    continue
+                old_median = statistics.median(per_version[old])
+                new_median = statistics.median(per_version[new])
+                if old_median > 0 and new_median / old_median >= min_ratio:
+                    regressions.append({'pipeline': name, 'rule': rule,
+                                        'old_version': old, 'new_version': new,
+                                        'old_median_s': old_median,
+                                        'new_median_s': new_median,
+                                        'ratio': new_median / old_median})
+        return regressions
+
+
+def format_table(header, rows):
+    """Format rows as reStructuredText simple table
+
+    >>> print(format_table(['a', 'bb'], [[1, 'x']]))
+    =  ==
+    a  bb
+    =  ==
+    1  x
+    =  ==
+    """
+    rows = [[str(v) for v in row] for row in rows]
+    widths = [max([len(h)] + [len(row[i]) for row in rows]) for i, h in enumerate(header)]
+    sep = "  ".join("=" * w for w in widths)
+    lines = [sep, "  ".join(h.ljust(w) for h, w in zip(header, widths)).rstrip(), sep]
+    lines.extend("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows)
+    lines.append(sep)
+    return "\n".join(lines)
+
+
+def rst_performance_section(outdir, top_n=10):
+    """Return performance section (reStructuredText) for report of
+    analysis in outdir, listing the top_n most expensive rules
+    """
+    store = BenchmarkStore(":memory:")
+    try:
+        store.add_analysis(outdir)
+        top = store.top_rules(top_n)
+    finally:
+        store.close()
+    text = "\nPerformance\n-----------\n\n"
+    if not top:
+        return text + "No benchmark logs found\n"
+    rows = [[t['rule'], t['jobs'], "{:.2f}".format(t['wall_h']), "{:.2f}".format(t['core_h']),
+             "{:.0f}".format(t['rss_max']) if t['rss_max'] is not None else "NA"]
+            for t in top]
+    text += "Most expensive rules (core hours assume one thread where unknown):\n\n"
+    text += format_table(["Rule", "Jobs", "Wall (h)", "Core (h)", "Max RSS (MB)"], rows)
+    return text + "\n"
@@ -1,21 +1,33 @@
 #!/usr/bin/env python3
 """Imports and parse rest services
+
+Config files are only parsed on first access of the corresponding
+module attribute (e.g. `from config import site_cfg`) or get_cfg()
+call and the parsed result is cached on disk keyed by file
+modification time, so that repeated (cron) invocations skip YAML
+parsing altogether.
 """
 
 # standard library imports
 import os
 import sys
+import types
 import logging
 
 # third party imports
 import yaml
 
 #--- project specific imports
+#
+from utils import read_cache
+from utils import write_cache
+from utils import file_cache_key
+
 #NOVOGENE_CFG_FILE
 # add lib dir for this pipeline installation to PYTHONPATH
 ETC_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "etc"))
-    
+
 SITE_CFG_FILE = os.path.join(ETC_PATH, 'site.yaml')
 REST_CFG_FILE = os.path.join(ETC_PATH, 'rest.yaml')
 MONGO_CFG_FILE = os.path.join(ETC_PATH, 'mongo.yaml')
@@ -24,6 +36,28 @@ BCL2FASTQ_CFG_FILE = os.path.join(ETC_PATH, 'bcl2fastq.yaml')
 LEGACY_MAPPER_CFG_FILE = os.path.join(ETC_PATH, 'legacy_wrapper.yaml')
 NOVOGENE_CFG_FILE = os.path.join(ETC_PATH, 'novogene.yaml')
 
+# attribute name to config file mapping. attributes are resolved
+# lazily, see get_cfg()
+CFG_FILES = {
+    'site_cfg': SITE_CFG_FILE,
+    'rest_services': REST_CFG_FILE,
+    'mongo_conns': MONGO_CFG_FILE,
+    'bcl2fastq_qc_conf': BCL2FASTQQC_CFG_FILE,
+    'bcl2fastq_conf': BCL2FASTQ_CFG_FILE,
+    'legacy_mapper': LEGACY_MAPPER_CFG_FILE,
+    'novogene_conf': NOVOGENE_CFG_FILE,
+}
+
+# declared for static analysis (e.g. pylint's no-name-in-module)
+# only. not assigned, so that access goes to _LazyCfgModule.__getattr__
+site_cfg: dict
+rest_services: dict
+mongo_conns: dict
+bcl2fastq_qc_conf: dict
+bcl2fastq_conf: dict
+legacy_mapper: dict
+novogene_conf: dict
+
 # global logger
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
@@ -31,51 +65,56 @@ handler.setFormatter(logging.Formatter(
     '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
 logger.addHandler(handler)
 
-with open(SITE_CFG_FILE, 'r') as stream:
-    try:
-        site_cfg = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", SITE_CFG_FILE)
-        raise
+_loaded_cfgs = dict()
 
-with open(REST_CFG_FILE, 'r') as stream:
-    try:
-        rest_services = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error loading %s", REST_CFG_FILE)
-        raise
-    
-with open(BCL2FASTQQC_CFG_FILE, 'r') as stream:
-    try:
-        bcl2fastq_qc_conf = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", BCL2FASTQQC_CFG_FILE)
-        raise
 
-with open(BCL2FASTQ_CFG_FILE, 'r') as stream:
-    try:
-        bcl2fastq_conf = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", BCL2FASTQ_CFG_FILE)
-        raise
-        
-with open(MONGO_CFG_FILE, 'r') as stream:
-    try:
-        mongo_conns = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", MONGO_CFG_FILE)
-        raise
+def load_cfgfile(cfgfile, use_cache=True):
+    """Parse given YAML config file. Parsed content is cached on disk
+    and reused as long as the file doesn't change
+    """
 
-with open(LEGACY_MAPPER_CFG_FILE, 'r') as stream:
     try:
-        legacy_mapper = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", LEGACY_MAPPER_CFG_FILE)
+        key = file_cache_key(cfgfile)
+    except OSError:
+        logger.fatal("Error in loading %s", cfgfile)
         raise
+    cache_name = "config:" + key[0]
+    if use_cache:
+        cfg = read_cache(cache_name, key)
+        if cfg is not None:
+            return cfg
 
-with open(NOVOGENE_CFG_FILE, 'r') as stream:
-    try:
-        novogene_conf = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", NOVOGENE_CFG_FILE)
-        raise
+    with open(cfgfile, 'r') as stream:
+        try:
+            cfg = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            logger.fatal("Error in loading %s", cfgfile)
+            raise
+    if use_cache and cfg is not None:
+        write_cache(cache_name, key, cfg)
+    return cfg
+
+
+def get_cfg(name):
+    """Return parsed config for name (key of CFG_FILES), which is parsed
+    on first access only
+    """
+    if name not in CFG_FILES:
+        raise KeyError(name)
+    if name not in _loaded_cfgs:
+        _loaded_cfgs[name] = load_cfgfile(CFG_FILES[name])
+    return _loaded_cfgs[name]
+
+
+class _LazyCfgModule(types.ModuleType):
+    """Module type resolving config attributes via get_cfg(). Used
+    instead of a module level __getattr__, which needs Python 3.7
+    """
+
+    def __getattr__(self, name):
+        if name not in CFG_FILES:
+            raise AttributeError("module {} has no attribute {}".format(self.__name__, name))
+        return get_cfg(name)
+
+
+sys.modules[__name__].__class__ = _LazyCfgModule
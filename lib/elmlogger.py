@@ -8,8 +8,14 @@ import socket
 from datetime import datetime
 import subprocess
 import json
+import time
+import logging
+import threading
 #from collections import OrderedDict
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 
 # third party imports
 #
@@ -28,6 +34,167 @@ ElmUnit = namedtuple('ElmUnit', [
     'library_file_size'])
 
 
+# threads used for walking directories in disk_usages()
+DU_THREADS = 8
+
+# directory path to mtime (ns), disk usage of directory itself plus
+# non-directory entries (except hard links), hard links and list of
+# subdirectories. reused as long as the directory's mtime is
+# unchanged. note: appending to existing files doesn't change mtime,
+# but library files are written once
+_DIR_CACHE = dict()
+_DIR_CACHE_LOCK = threading.Lock()
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def _scan_dir(path):
+    """return disk usage of directory path itself and its non-directory
+    entries (i.e. not following symlinks), list of hard linked entries
+    (device, inode and usage), which are counted only once like du
+    does, and list of subdirectories. cached by mtime (see _DIR_CACHE)
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _DIR_CACHE_LOCK:
+        cached = _DIR_CACHE.get(path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1:]
+
+    usage = os.lstat(path).st_blocks * 512
+    hardlinks = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_nlink > 1:
+                    hardlinks.append((stat.st_dev, stat.st_ino, stat.st_blocks * 512))
+                else:
+                    usage += stat.st_blocks * 512
+    with _DIR_CACHE_LOCK:
+        _DIR_CACHE[path] = (mtime_ns, usage, hardlinks, subdirs)
+    return usage, hardlinks, subdirs
+
+
+def _s3_usage(path):
+    """disk usage of s3 path via aws s3 ls. -1 on error"""
+    cmd = ['aws', 's3', 'ls', '--summarize', path]
+    try:
+        res = subprocess.check_output(cmd)
+    except subprocess.CalledProcessError:
+        return -1
+    total_line = res.decode().splitlines()[-1]
+    if not "Total Size:" in total_line:
+        return -1
+    return int(total_line.split()[-1])
+
+
+def dedup_paths(paths):
+    """normalize paths and remove duplicates and paths contained in
+    others
+
+    >>> dedup_paths(['/a/b', '/a/', '/a/b/c', '/ab', 's3://x/y', 's3://x/y'])
+    ['/a', '/ab', 's3://x/y']
+    """
+    kept = []
+    for p in sorted(set(p if p.startswith("s3://") else os.path.abspath(p)
+                        for p in paths)):
+        if kept and (p == kept[-1] or p.startswith(kept[-1].rstrip("/") + "/")):
+            continue
+        kept.append(p)
+    return kept
+
+
+def path_usages(paths, threads=DU_THREADS):
+    """disk usage (in bytes as reported by du, i.e. allocated blocks,
+    not following symlinks) for each of the given paths, which can be
+    files, directories or s3 paths. all directories are walked
+    concurrently by a pool of threads. returns dict of path to usage or
+    -1 if path doesn't exist or can't be read
+    """
+    usages = dict()
+    seen_inodes = dict()
+    started = dict()
+    outstanding = dict()
+    futures = dict()
+
+    def submit(func, path, root):
+        """submit func(path) as part of the walk of root"""
+        outstanding[root] += 1
+        futures[executor.submit(func, path)] = root
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for p in paths:
+            usages[p] = 0
+            seen_inodes[p] = set()
+            started[p] = time.time()
+            outstanding[p] = 0
+            if p.startswith("s3://"):
+                submit(_s3_usage, p, p)
+            elif os.path.isdir(p) and not os.path.islink(p):
+                submit(_scan_dir, p, p)
+            elif os.path.lexists(p):
+                submit(lambda f: os.lstat(f).st_blocks * 512, p, p)
+            else:
+                usages[p] = -1
+
+        while futures:
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                root = futures.pop(future)
+                outstanding[root] -= 1
+                try:
+                    res = future.result()
+                except OSError as e:
+                    logger.warning("Disk usage for %s failed: %s", root, e)
+                    usages[root] = -1
+                    res = None
+                if isinstance(res, tuple):
+                    usage, hardlinks, subdirs = res
+                    for dev, ino, link_usage in hardlinks:
+                        if (dev, ino) not in seen_inodes[root]:
+                            seen_inodes[root].add((dev, ino))
+                            usage += link_usage
+                    for d in subdirs:
+                        submit(_scan_dir, d, root)
+                else:
+                    usage = res
+                if usages[root] == -1 or usage is None or usage < 0:
+                    usages[root] = -1
+                else:
+                    usages[root] += usage
+                if outstanding[root] == 0:
+                    logger.debug("Disk usage of %s: %d bytes in %.3f s", root,
+                                 usages[root], time.time() - started[root])
+    return usages
+
+
+def disk_usages(path_lists, threads=DU_THREADS):
+    """disk usage for each list of paths in path_lists, equivalent to du
+    -sc. identical and overlapping paths are only counted once and all
+    paths are only computed once, even if listed in several
+    lists. returns list of usages, -1 for empty lists and lists with
+    non-existing paths
+    """
+    path_lists = [dedup_paths(paths) for paths in path_lists]
+    usages = path_usages(sorted(set(p for paths in path_lists for p in paths)), threads)
+    totals = []
+    for paths in path_lists:
+        if not paths or any(usages[p] == -1 for p in paths):
+            totals.append(-1)
+        else:
+            totals.append(sum(usages[p] for p in paths))
+    return totals
+
+
 class ElmLogging(object):
     """
     NOTE:
@@ -43,39 +210,9 @@ class ElmLogging(object):
 
     @staticmethod
     def disk_usage(paths):
-        """disk usage via du. return -1 if not existant. works on files as well"""
+        """disk usage as du -sc. return -1 if not existant. works on files as well"""
         assert isinstance(paths, list)
-        if not paths:
-            return -1
-
-        size = 0
-
-        for p in paths:
-            if p.startswith("s3://"):
-                cmd = ['aws', 's3', 'ls', '--summarize', p]
-                try:
-                    res = subprocess.check_output(cmd)
-                except subprocess.CalledProcessError:
-                    return -1
-    
-                total_line = res.decode().splitlines()[-1]
-                if not "Total Size:" in total_line:
-                    return -1
-                size += int(total_line.split()[-1])
-
-            else:
-                cmd = 'DU_BLOCK_SIZE=1 du -sc ' + p
-                try:
-                    res = subprocess.check_output(cmd, shell=True)
-                except subprocess.CalledProcessError:
-                    return -1
-    
-                total_line = res.decode().splitlines()[-1]
-                if not total_line.endswith("total"):
-                    return -1
-                size += int(total_line.split()[0])
-
-        return size
+        return disk_usages([paths])[0]
 
 
     def __init__(self,
@@ -157,7 +294,11 @@ class ElmLogging(object):
         else:
             # troubleshooting
             self.fields['status_id'] = 7
-        # update library_file_size per elm unit based on library_file_size
-        self.elm_units = [eu._replace(library_file_size=self.disk_usage(eu.library_files))
-                          for eu in self.elm_units]
+        # update library_file_size per elm unit based on library_files.
+        # computed in one go, since units often share paths (e.g. lanes of one MUX)
+        for eu in self.elm_units:
+            assert isinstance(eu.library_files, list)
+        sizes = disk_usages([eu.library_files for eu in self.elm_units])
+        self.elm_units = [eu._replace(library_file_size=size)
+                          for eu, size in zip(self.elm_units, sizes)]
         self.write_event()
@@ -0,0 +1,254 @@
+"""Single pass FastQ scanner
+
+Reads each (gzipped) FastQ file once and in that pass verifies all
+gzip members (CRC and size), computes the MD5 of the file as stored,
+counts reads and bases and builds read length and quality histograms.
+Results are written to a small JSON sidecar next to the FastQ file
+(see SIDECAR_EXT), which is reused as long as the FastQ file doesn't
+change, so that downstream rules and tools don't need to read
+multi-GB files again.
+"""
+
+#--- standard library imports
+#
+import os
+import json
+import zlib
+import hashlib
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+SIDECAR_EXT = ".scan.json"
+
+# increase whenever the result format changes. older sidecars are ignored
+SCAN_VERSION = 1
+
+# read size for the (compressed) input
+BUFSIZE = 4 * 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# size of data used to determine the initial set of quality chars
+QUAL_SAMPLE_SIZE = 65536
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def _decompressed_chunks(fh, md5, stats):
+    """Yield decompressed chunks of gzip file handle fh, updating md5
+    with raw data read and counting gzip members in stats. Raises
+    ValueError for corrupt or truncated files
+    """
+    dec = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    fed = False
+    while True:
+        raw = fh.read(BUFSIZE)
+        if not raw:
+            break
+        md5.update(raw)
+        while raw:
+            fed = True
+            try:
+                yield dec.decompress(raw)
+            except zlib.error as e:
+                raise ValueError("corrupt gzip data in member {}: {}".format(
+                    stats['gzip_members'] + 1, e))
+            if dec.eof:
+                stats['gzip_members'] += 1
+                raw = dec.unused_data
+                dec = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                fed = False
+            else:
+                raw = b''
+    if fed:
+        raise ValueError("truncated gzip member {}".format(stats['gzip_members'] + 1))
+
+
+def _plain_chunks(fh, md5):
+    """Yield chunks of uncompressed file handle fh, updating md5"""
+    while True:
+        raw = fh.read(BUFSIZE)
+        if not raw:
+            break
+        md5.update(raw)
+        yield raw
+
+
+def _count_quals(quals, qual_hist):
+    """add counts of quality chars in list of quality lines to qual_hist
+    and return number of quality values. Chars seen before (few for
+    binned qualities) are counted by deleting them one by one, which is
+    much faster than bytes.count. Anything left is counted per byte
+    """
+    joined = b''.join(quals)
+    remaining = joined
+    for c in [c for c, _ in qual_hist.most_common()] or set(joined[:QUAL_SAMPLE_SIZE]):
+        shorter = remaining.translate(None, bytes([c]))
+        qual_hist[c] += len(remaining) - len(shorter)
+        remaining = shorter
+    if remaining:
+        qual_hist.update(remaining)
+    return len(joined)
+
+
+def scan_fastq(fastq):
+    """Scan fastq (gzipped or not) and return dict with file size,
+    mtime, md5, number of gzip members (None if not gzipped), number of
+    reads and bases, read length histogram and quality histogram (Phred
+    scores assuming offset 33). Raises ValueError if file is corrupt or
+    not a valid FastQ
+    """
+    stat = os.stat(fastq)
+    md5 = hashlib.md5()
+    len_hist = Counter()
+    qual_hist = Counter()
+    num_lines = 0
+    num_quals = 0
+    pending = b''
+
+    with open(fastq, 'rb') as fh:
+        gzipped = fh.read(2) == GZIP_MAGIC
+        fh.seek(0)
+        stats = {'gzip_members': 0}
+        if gzipped:
+            chunks = _decompressed_chunks(fh, md5, stats)
+        else:
+            chunks = _plain_chunks(fh, md5)
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            phase = num_lines % 4
+            headers = lines[(4 - phase) % 4::4]
+            if not all(h[:1] == b'@' for h in headers):
+                raise ValueError("invalid FastQ record after line {}".format(num_lines))
+            len_hist.update(map(len, lines[(5 - phase) % 4::4]))
+            num_quals += _count_quals(lines[(7 - phase) % 4::4], qual_hist)
+            num_lines += len(lines)
+
+    if pending:
+        # no newline at end of file
+        phase = num_lines % 4
+        if phase == 1:
+            len_hist[len(pending)] += 1
+        elif phase == 3:
+            num_quals += _count_quals([pending], qual_hist)
+        num_lines += 1
+    if num_lines % 4:
+        raise ValueError("incomplete last FastQ record ({} lines)".format(num_lines))
+    num_bases = sum(l * n for l, n in len_hist.items())
+    if num_quals != num_bases:
+        raise ValueError("number of bases ({}) and qualities ({}) differ".format(
+            num_bases, num_quals))
+
+    return {'scan_version': SCAN_VERSION,
+            'path': os.path.abspath(fastq),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'md5': md5.hexdigest(),
+            'gzip_members': stats['gzip_members'] if gzipped else None,
+            'reads': num_lines // 4,
+            'bases': num_bases,
+            'read_lengths': dict((str(l), n) for l, n in sorted(len_hist.items())),
+            'qualities': dict((str(q - 33), n) for q, n in sorted(qual_hist.items()))}
+
+
+def sidecar_for_fastq(fastq):
+    """Return name of sidecar for fastq"""
+    return fastq + SIDECAR_EXT
+
+
+def read_sidecar(fastq):
+    """Return scan result stored in sidecar of fastq or None if there is
+    none or it's out of date
+    """
+    sidecar = sidecar_for_fastq(fastq)
+    try:
+        with open(sidecar) as fh:
+            result = json.load(fh)
+        stat = os.stat(fastq)
+    except (OSError, ValueError):
+        return None
+    if result.get('scan_version') != SCAN_VERSION or \
+       result.get('size') != stat.st_size or \
+       result.get('mtime_ns') != stat.st_mtime_ns:
+        logger.debug("Ignoring outdated sidecar %s", sidecar)
+        return None
+    return result
+
+
+def write_sidecar(fastq, result):
+    """Write scan result to sidecar of fastq"""
+    sidecar = sidecar_for_fastq(fastq)
+    tmp = sidecar + ".tmp"
+    with open(tmp, 'w') as fh:
+        json.dump(result, fh, indent=1)
+    os.rename(tmp, sidecar)
+
+
+def _scan_one(fastq, use_sidecar=True, write=True):
+    """Scan fastq unless an up to date sidecar exists. Returns result
+    and error message (one of both is None)
+    """
+    if use_sidecar:
+        result = read_sidecar(fastq)
+        if result:
+            return result, None
+    try:
+        result = scan_fastq(fastq)
+    except (OSError, ValueError) as e:
+        return None, str(e)
+    if write:
+        try:
+            write_sidecar(fastq, result)
+        except OSError as e:
+            logger.warning("Couldn't write sidecar for %s: %s", fastq, e)
+    return result, None
+
+
+def scan_fastqs(fastqs, processes=1, use_sidecar=True, write=True):
+    """Scan fastqs using given number of processes. Up to date sidecars
+    are used instead of rescanning if use_sidecar is set and new
+    results are written to sidecars if write is set. Returns dict of
+    results and dict of errors, both keyed by fastq
+    """
+    results = dict()
+    errors = dict()
+    if processes > 1 and len(fastqs) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            outcomes = executor.map(_scan_one, fastqs, [use_sidecar] * len(fastqs),
+                                    [write] * len(fastqs))
+            outcomes = list(outcomes)
+    else:
+        outcomes = [_scan_one(f, use_sidecar, write) for f in fastqs]
+    for fastq, (result, error) in zip(fastqs, outcomes):
+        if error:
+            logger.error("%s: %s", fastq, error)
+            errors[fastq] = error
+        else:
+            results[fastq] = result
+    return results, errors
@@ -0,0 +1,214 @@
+"""Indexed log bundles
+
+A bundle is a gzipped tar file, in which every tar member (header plus
+data) is compressed as a separate gzip member. Concatenated gzip
+members form a valid gzip stream, so bundles can be read with plain tar
+(tar tzf/xzf) and tarfile, but members can be compressed in parallel
+and, with help of an index (see INDEX_EXT) storing the offset of each
+member, read individually without decompressing the whole bundle.
+"""
+
+#--- standard library imports
+#
+import os
+import grp
+import pwd
+import gzip
+import json
+import shutil
+import logging
+import tarfile
+import tempfile
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+INDEX_EXT = ".index.json"
+
+# increase whenever the index format changes
+INDEX_VERSION = 1
+
+COMPRESSLEVEL = 6
+
+# zlib releases the GIL, so threads compress in parallel
+DEFAULT_THREADS = min(8, os.cpu_count() or 1)
+
+# logs are read in chunks of this size. compressed members are kept in
+# memory up to SPOOL_MAX_SIZE and spooled to a temporary file beyond
+# that, i.e. write_bundle() needs at most 2 * threads * SPOOL_MAX_SIZE
+# memory for pending members
+CHUNK_SIZE = 1024 * 1024
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def index_for_bundle(bundle):
+    """Return name of index for bundle"""
+    return bundle + INDEX_EXT
+
+
+def _owner_names(stat):
+    """Return user and group name for stat or empty strings if unknown"""
+    try:
+        uname = pwd.getpwuid(stat.st_uid).pw_name
+    except KeyError:
+        uname = ""
+    try:
+        gname = grp.getgrgid(stat.st_gid).gr_name
+    except KeyError:
+        gname = ""
+    return uname, gname
+
+
+def _compressed_member(path, arcname, compresslevel):
+    """Return gzip compressed tar member (header and padded data) for
+    regular file path stored as arcname as (spooled) temporary file
+    positioned at its start, the size of the header and the size of
+    the data. The file is streamed, not read into memory
+    """
+    stat = os.stat(path)
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.st_mode & 0o7777
+    tarinfo.uid = stat.st_uid
+    tarinfo.gid = stat.st_gid
+    tarinfo.uname, tarinfo.gname = _owner_names(stat)
+    tarinfo.mtime = int(stat.st_mtime)
+    tarinfo.size = stat.st_size
+    header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, "utf-8", "surrogateescape")
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with gzip.GzipFile(filename="", mode='wb', fileobj=spool,
+                       compresslevel=compresslevel, mtime=0) as gzfh, \
+         open(path, 'rb') as fh:
+        gzfh.write(header)
+        # like tarfile, only store as much as the header says
+        remaining = tarinfo.size
+        while remaining:
+            chunk = fh.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                spool.close()
+                raise OSError("{} changed while bundling".format(path))
+            gzfh.write(chunk)
+            remaining -= len(chunk)
+        gzfh.write(b"\0" * (-tarinfo.size % tarfile.BLOCKSIZE))
+    spool.seek(0)
+    return spool, len(header), tarinfo.size
+
+
+def write_bundle(bundle, files, threads=DEFAULT_THREADS, compresslevel=COMPRESSLEVEL):
+    """Write files (paths are used as member names) to bundle and its
+    index using given number of threads. Members are written in input
+    order. An existing bundle is replaced once the new one is complete.
+    Returns index (dict of member name to offset, compressed length,
+    header size and size)
+    """
+    members = OrderedDict()
+    offset = 0
+    tmp_bundle = bundle + ".tmp"
+    with open(tmp_bundle, 'wb') as fh, ThreadPoolExecutor(max_workers=threads) as executor:
+        # only keep a limited number of compressed members in memory
+        pending = deque()
+        files = iter(files)
+        while True:
+            while len(pending) < 2 * threads:
+                f = next(files, None)
+                if f is None:
+                    break
+                pending.append((f, executor.submit(_compressed_member, f, f, compresslevel)))
+            if not pending:
+                break
+            f, future = pending.popleft()
+            spool, header_size, size = future.result()
+            with spool:
+                shutil.copyfileobj(spool, fh, CHUNK_SIZE)
+                length = spool.tell()
+            members[f] = {'offset': offset, 'length': length,
+                          'header_size': header_size, 'size': size}
+            offset += length
+        # end of archive: two empty blocks
+        fh.write(gzip.compress(b"\0" * 2 * tarfile.BLOCKSIZE, compresslevel, mtime=0))
+
+    index = {'version': INDEX_VERSION,
+             'bundle_size': os.path.getsize(tmp_bundle),
+             'members': members}
+    index_file = index_for_bundle(bundle)
+    with open(index_file + ".tmp", 'w') as fh:
+        json.dump(index, fh)
+    # an old index doesn't match the new bundle's size, i.e. is ignored
+    # until replaced as well
+    os.replace(tmp_bundle, bundle)
+    os.replace(index_file + ".tmp", index_file)
+    logger.debug("Wrote %d members to %s", len(members), bundle)
+    return members
+
+
+def read_index(bundle):
+    """Return members in index of bundle or None if there is no usable
+    index
+    """
+    try:
+        with open(index_for_bundle(bundle)) as fh:
+            index = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or \
+       index.get('bundle_size') != os.path.getsize(bundle):
+        logger.warning("Ignoring outdated index for %s", bundle)
+        return None
+    return index['members']
+
+
+def list_members(bundle):
+    """Return names of (file) members in bundle. Falls back to reading
+    the whole bundle if it has no index (e.g. old style log bundles)
+    """
+    members = read_index(bundle)
+    if members is not None:
+        return list(members.keys())
+    with tarfile.open(bundle, "r:gz") as tarfh:
+        return [m.name for m in tarfh.getmembers() if m.isfile()]
+
+
+def read_member(bundle, name):
+    """Return content (bytes) of member name in bundle. Using the index
+    only the member itself is read and decompressed. Falls back to
+    scanning the bundle if it has no index. Raises KeyError if name is
+    not in bundle
+    """
+    members = read_index(bundle)
+    if members is None:
+        with tarfile.open(bundle, "r:gz") as tarfh:
+            fh = tarfh.extractfile(name)
+            if fh is None:
+                raise KeyError(name)
+            return fh.read()
+
+    entry = members[name]
+    with open(bundle, 'rb') as fh:
+        fh.seek(entry['offset'])
+        member = gzip.decompress(fh.read(entry['length']))
+    start = entry['header_size']
+    return member[start:start + entry['size']]
+
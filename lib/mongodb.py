@@ -4,10 +4,14 @@
 #--- standard library imports
 #
 import logging
+import atexit
+import threading
+from collections import defaultdict
 
 #--- third-party imports
 #
 import pymongo
+import pymongo.monitoring
 
 #--- project specific imports
 #
@@ -30,20 +34,288 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
+# default MongoClient options. can be overwritten with a
+# 'client_options' dict in mongo.yaml
+CLIENT_OPTIONS = {
+    'maxPoolSize': 10,
+    'connectTimeoutMS': 20000,
+    'serverSelectionTimeoutMS': 30000,
+    'socketTimeoutMS': 300000,
+}
+
+
+class LatencyListener(pymongo.monitoring.CommandListener):
+    """Collects number of calls and total latency per command (e.g.
+    find, update, insert) and server
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.total_sec = defaultdict(float)
+
+
+    def _record(self, event):
+        """record completed command"""
+        key = (event.command_name, "{}:{}".format(*event.connection_id))
+        with self.lock:
+            self.counts[key] += 1
+            self.total_sec[key] += event.duration_micros / 1e6
+
+
+    def started(self, event):
+        pass
+
+
+    def succeeded(self, event):
+        self._record(event)
+
+
+    def failed(self, event):
+        self._record(event)
+
+
+    def stats(self):
+        """returns dict of (command, server) -> (count, total seconds)"""
+        with self.lock:
+            return dict((k, (self.counts[k], self.total_sec[k])) for k in self.counts)
+
+
+# one listener for all clients
+LATENCIES = LatencyListener()
+
+# process-wide clients keyed by server, created lazily by mongodb_conn()
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+
 def mongodb_conn(use_test_server=False):
-    """Return connection to MongoDB server"""
+    """Return connection to MongoDB server. Connections are pooled,
+    i.e. the same (thread-safe) client is returned for repeated calls
+    in one process. Clients are closed at exit, so callers don't need
+    to (and shouldn't) close them
+    """
     if use_test_server:
         logger.info("Using test MongoDB server")
-        constr = mongo_conns['test']
+        server = 'test'
     else:
         logger.info("Using production MongoDB server")
-        constr = mongo_conns['production']
-
-    try:
-        connection = pymongo.MongoClient(constr)
-    except pymongo.errors.ConnectionFailure:
-        logger.fatal("Could not connect to the MongoDB server")
-        return None
-    logger.debug("Database connection established")
+        server = 'production'
+
+    with _CLIENTS_LOCK:
+        connection = _CLIENTS.get(server)
+        if connection is not None:
+            return connection
+
+        constr = mongo_conns[server]
+        options = dict(CLIENT_OPTIONS)
+        options.update(mongo_conns.get('client_options', {}))
+        try:
+            connection = pymongo.MongoClient(
+                constr, event_listeners=[LATENCIES], **options)
+        except pymongo.errors.ConnectionFailure:
+            logger.fatal("Could not connect to the MongoDB server")
+            return None
+        logger.debug("Database connection established")
+        _CLIENTS[server] = connection
     return connection
 
+
+def close_connections():
+    """Close all pooled connections and log per-operation latencies
+    """
+    with _CLIENTS_LOCK:
+        for connection in _CLIENTS.values():
+            connection.close()
+        _CLIENTS.clear()
+    for (command, server), (count, total_sec) in sorted(LATENCIES.stats().items()):
+        logger.debug("MongoDB %s on %s: %d calls, %.3f s total, %.1f ms avg",
+                     command, server, count, total_sec, 1000.0 * total_sec / count)
+
+
+atexit.register(close_connections)
+
+
+# indexes needed by the cron jobs' queries, per collection
+INDEXES = {
+    'pipeline_runs': [
+        [("ctime", pymongo.ASCENDING), ("site", pymongo.ASCENDING)],
+        [("run.status", pymongo.ASCENDING), ("ctime", pymongo.ASCENDING)],
+    ],
+    'runcomplete': [
+        [("run", pymongo.ASCENDING), ("analysis.analysis_id", pymongo.ASCENDING)],
+        [("timestamp", pymongo.ASCENDING)],
+    ],
+    'accountinglogs': [
+        [("jobs.owner", pymongo.ASCENDING), ("jobs.jobNo", pymongo.ASCENDING)],
+        [("jobs.submissionTime", pymongo.ASCENDING)],
+    ],
+}
+
+
+def ensure_indexes(db, indexes=None):
+    """Create indexes (see INDEXES) in db (e.g. connection.gisds) unless
+    they already exist. Existing indexes are listed first, so that once
+    all are present this costs one listIndexes per collection and no
+    createIndexes. Returns False if any is still missing afterwards
+    """
+
+    if indexes is None:
+        indexes = INDEXES
+    all_present = True
+    for colname, index_keys in indexes.items():
+        col = db[colname]
+        existing = [[tuple(k) for k in info['key']]
+                    for info in col.index_information().values()]
+        missing = [keys for keys in index_keys if keys not in existing]
+        if not missing:
+            continue
+        for keys in missing:
+            logger.info("Creating index %s on %s", keys, colname)
+            col.create_index(keys)
+        existing = [[tuple(k) for k in info['key']]
+                    for info in col.index_information().values()]
+        for keys in missing:
+            if keys not in existing:
+                logger.warning("Missing index %s on %s", keys, colname)
+                all_present = False
+    return all_present
+
+
+class BulkWriter(object):
+    """Accumulates write operations for one collection and sends them
+    with bulk_write in ordered batches, i.e. one round trip per batch
+    instead of one per operation. Use as context manager or call
+    flush() explicitly
+    """
+
+    def __init__(self, collection, batch_size=1000, dryrun=False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.dryrun = dryrun
+        self.ops = []
+        self.num_round_trips = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+    def _add(self, op):
+        """queue op and flush if batch is full"""
+        self.ops.append(op)
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+
+    def update_one(self, filter_, update):
+        """queue update_one"""
+        self._add(pymongo.UpdateOne(filter_, update))
+
+
+    def update_many(self, filter_, update):
+        """queue update_many"""
+        self._add(pymongo.UpdateMany(filter_, update))
+
+
+    def insert_one(self, document):
+        """queue insert_one"""
+        self._add(pymongo.InsertOne(document))
+
+
+    def delete_many(self, filter_):
+        """queue delete_many"""
+        self._add(pymongo.DeleteMany(filter_))
+
+
+    def flush(self):
+        """send all queued operations. returns pymongo's BulkWriteResult
+        or None if nothing was sent. raises BulkWriteError (an
+        OperationFailure) on errors, in which case (ordered) processing
+        stopped at the failing operation
+        """
+
+        if not self.ops:
+            return None
+        ops, self.ops = self.ops, []
+        if self.dryrun:
+            logger.info("Skipping %d DB operations on %s due to dryrun option",
+                        len(ops), self.collection.name)
+            return None
+        res = self.collection.bulk_write(ops, ordered=True)
+        self.num_round_trips += 1
+        logger.debug("Bulk write of %d operations on %s: %d matched, %d modified, %d inserted",
+                     len(ops), self.collection.name, res.matched_count,
+                     res.modified_count, res.inserted_count)
+        num_updates = sum(1 for op in ops if isinstance(op, pymongo.UpdateOne))
+        if num_updates and res.matched_count < num_updates:
+            logger.warning("Only %d of %d updates on %s matched a document",
+                           res.matched_count, num_updates, self.collection.name)
+        return res
+
+
+
+def runcomplete_set_run_status(db, run_number, analysis_id, status, out_dir,
+                               end_time=None, user_name="userrig"):
+    """Set status of a bcl2fastq analysis in runcomplete collection
+    (db). STARTED and SEQRUNFAILED add a new analysis entry, SUCCESS and
+    FAILED replace an existing one, for which end_time is required.
+    Raises pymongo.errors.OperationFailure or AssertionError on failure
+    """
+
+    if status in ["STARTED", "SEQRUNFAILED"]:
+        res = db.update_one({"run": run_number},
+                            {"$push":
+                             {"analysis": {
+                                 "analysis_id" : analysis_id,
+                                 "user_name" : user_name,
+                                 "out_dir" : out_dir,
+                                 "Status" :  status,
+                             }}})
+    elif status in ["SUCCESS", "FAILED"]:
+        assert end_time
+        res = db.update_one({"run": run_number, 'analysis.analysis_id' : analysis_id},
+                            {"$set":
+                             {"analysis.$": {
+                                 "analysis_id" : analysis_id,
+                                 "end_time" : end_time,
+                                 "user_name" : user_name,
+                                 "out_dir" : out_dir,
+                                 "Status" :  status,
+                             }}})
+    else:
+        raise ValueError(status)
+    assert res.modified_count == 1, (
+        "Modified {} documents instead of 1".format(res.modified_count))
+
+
+def runcomplete_add_mux_status(db, run_number, analysis_id, mux_id, mux_dir, status):
+    """Add per MUX status (SUCCESS, FAILED or NOARCHIVE) to analysis in
+    runcomplete collection (db). Raises
+    pymongo.errors.OperationFailure on failure
+    """
+
+    mux_status = {"mux_id" : mux_id,
+                  "mux_dir" : mux_dir,
+                  "Status" : status}
+    if status == "SUCCESS":
+        mux_status.update({"StatsSubmission" : "TODO",
+                           "ArchiveSubmission" : "TODO",
+                           "DownstreamSubmission" : "TODO",
+                           "email_sent" : False})
+    elif status == "FAILED":
+        mux_status.update({"email_sent" : False})
+    elif status == "NOARCHIVE":
+        mux_status.update({"StatsSubmission" : "NOARCHIVE",
+                           "ArchiveSubmission" : "NOARCHIVE",
+                           "DownstreamSubmission" : "TODO",
+                           "email_sent" : True})
+    else:
+        raise ValueError(status)
+    db.update_one({"run": run_number, 'analysis.analysis_id' : analysis_id},
+                  {"$push": {"analysis.$.per_mux_status": mux_status}})
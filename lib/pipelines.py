@@ -16,12 +16,14 @@ import time
 from datetime import datetime
 from datetime import timedelta
 import calendar
-import json
-import tarfile
+import hashlib
 import glob
+import fnmatch
 #import argparse
 import copy
 from collections import deque
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 
 #--- third-party imports
 #
@@ -36,6 +38,14 @@ from config import rest_services
 from utils import generate_timestamp
 from utils import chroms_and_lens_from_fasta
 from utils import bed_and_fa_are_compat
+from utils import read_cache
+from utils import write_cache
+from utils import file_cache_key
+from rest import lib_details
+from readunits import max_sample_input_bytes
+from resourcefit import recommend_cluster_cfg
+from logbundle import write_bundle
+from logbundle import INDEX_EXT
 import configargparse
 
 
@@ -78,6 +88,20 @@ WORKFLOW_COMPLETION_FLAGFILE = "WORKFLOW_COMPLETE"
 
 DOWNSTREAM_OUTDIR_TEMPLATE = "{basedir}/{user}/{pipelinename}-version-{pipelineversion}/{timestamp}"
 
+# email addresses returned by user_mail_mapper are cached for this long
+USER_MAIL_CACHE_TTL_SEC = 7 * 24 * 60 * 60
+# don't let a slow user_mail_mapper block pipeline setup
+USER_MAIL_MAPPER_TIMEOUT_SEC = 5
+
+# in-process memos shared by all PipelineHandler instances (see
+# PipelineHandler.setup_many): parsed and RPD substituted configs
+# keyed by content hash and number of chromosomes keyed by fai stats
+_PARSED_CFG_MEMO = dict()
+_NUM_CHROMS_MEMO = dict()
+# pipeline wrapper modules loaded by run_wrapper(), keyed by path, with
+# the yaml.Dumper.ignore_aliases they set on import
+_WRAPPER_MODULES = dict()
+
 
 def snakemake_log_status(log):
     """
@@ -161,6 +185,11 @@ class PipelineHandler(object):
     # note, this includes waiting for jobs in q
     MASTER_WALLTIME_H = 96
 
+    # if set, submit() only queues instances, which are then submitted
+    # by submit_queued(). see setup_many()
+    queue_submissions = False
+    queued_submissions = []
+
     def __init__(self, pipeline_name, pipeline_subdir,
                  def_args,
                  cfg_dict,
@@ -193,6 +222,7 @@ class PipelineHandler(object):
 
         self.cfg_dict = copy.deepcopy(cfg_dict)
         self.cfg_dict['mail_on_completion'] = not def_args.no_mail
+        # if not given, set to self.toaddr below
         self.cfg_dict['mail_address'] = def_args.mail_address
         if def_args.name:
             self.cfg_dict['analysis_name'] = def_args.name
@@ -270,6 +300,8 @@ class PipelineHandler(object):
         # but it's very likely the current user, who needs to be notified
         # on qsub kills etc
         self.toaddr = email_for_user()
+        if not self.cfg_dict['mail_address']:
+            self.cfg_dict['mail_address'] = self.toaddr
 
         log_path = os.path.abspath(os.path.join(self.outdir, self.masterlog))
         self.elm_data = {'pipeline_name': self.pipeline_name,
@@ -317,9 +349,29 @@ class PipelineHandler(object):
 
 
     def write_cluster_cfg(self):
-        """writes site dependend cluster config
+        """writes site dependend cluster config. if a resource model is
+        given (extra config value resource_model, see
+        tools/resource_recommend.py), memory and walltime of modelled
+        rules are set according to the input size of this analysis
         """
-        shutil.copyfile(self.cluster_cfgfile, self.cluster_cfgfile_out)
+        model_file = self.cfg_dict.get('resource_model')
+        if not model_file:
+            shutil.copyfile(self.cluster_cfgfile, self.cluster_cfgfile_out)
+            return
+
+        with open(model_file) as fh:
+            models = yaml.safe_load(fh)
+        with open(self.cluster_cfgfile) as fh:
+            cluster_cfg = yaml.safe_load(fh)
+        input_bytes = None
+        if self.cfg_dict.get('samples') and self.cfg_dict.get('readunits'):
+            input_bytes = max_sample_input_bytes(
+                self.cfg_dict['samples'], self.cfg_dict['readunits'])
+        logger.info("Setting cluster resources for input size %s from %s",
+                    input_bytes, model_file)
+        with open(self.cluster_cfgfile_out, 'w') as fh:
+            yaml.dump(recommend_cluster_cfg(models, cluster_cfg, input_bytes), fh,
+                      default_flow_style=False)
 
 
     def write_run_template(self):
@@ -354,22 +406,21 @@ class PipelineHandler(object):
                                 ('modules', self.modules_cfgfile)]:
             if not cfgfile:
                 continue
-            with open(cfgfile) as fh:
+            with open(cfgfile, 'rb') as fh:
+                raw = fh.read()
+            # parse each distinct config only once per process
+            memo_key = (hashlib.md5(raw).hexdigest(), tuple(sorted(rpd_vars.items())))
+            if memo_key not in _PARSED_CFG_MEMO:
                 try:
-                    d = yaml.safe_load(fh)
-                    if not d:
-                        # allow empty files
-                        continue
-                    cfg = dict(d)
+                    d = yaml.safe_load(raw)
                 except:
                     logger.fatal("Loading %s failed", cfgfile)
                     raise
-            # to replace rpd vars the trick is to traverse
-            # dictionary fully and replace all instances
-            dump = json.dumps(cfg)
-            for k, v in rpd_vars.items():
-                dump = dump.replace("${}".format(k), v)
-            cfg = dict(json.loads(dump))
+                _PARSED_CFG_MEMO[memo_key] = substitute_rpd_vars(dict(d), rpd_vars) if d else None
+            if not _PARSED_CFG_MEMO[memo_key]:
+                # allow empty files
+                continue
+            cfg = copy.deepcopy(_PARSED_CFG_MEMO[memo_key])
             if cfgkey == 'global':
                 merged_cfg.update(cfg)
             else:
@@ -381,8 +432,7 @@ class PipelineHandler(object):
             reffa = merged_cfg['references'].get('genome')
             if reffa:
                 assert 'num_chroms' not in merged_cfg['references']
-                merged_cfg['references']['num_chroms'] = len(list(
-                    chroms_and_lens_from_fasta(reffa)))
+                merged_cfg['references']['num_chroms'] = num_chroms_in_fasta(reffa)
 
         return merged_cfg
 
@@ -428,8 +478,8 @@ class PipelineHandler(object):
         self.write_run_template()
 
 
-    def submit(self, no_run=False):
-        """submit pipeline run
+    def submission_cmd(self):
+        """return (shell) command that submits the pipeline run
         """
 
         if self.master_q:
@@ -446,31 +496,164 @@ class PipelineHandler(object):
             cmd = "cd {} && {} {} {} >> {}".format(
                 os.path.dirname(self.run_out), site_cfg['master_submission_cmd'],
                 master_q_arg, os.path.basename(self.run_out), self.submissionlog)
+        return cmd
+
 
+    def submit(self, no_run=False):
+        """submit pipeline run (or queue it for submission if
+        queue_submissions is set)
+        """
+
+        cmd = self.submission_cmd()
         if no_run:
             logger.warning("Skipping pipeline run on request. Once ready, use: %s", cmd)
             logger.warning("Once ready submit with: %s", cmd)
+        elif PipelineHandler.queue_submissions:
+            logger.info("Queueing pipeline submission: %s", cmd)
+            PipelineHandler.queued_submissions.append(self)
         else:
-            logger.info("Starting pipeline: %s", cmd)
-            #os.chdir(os.path.dirname(run_out))
+            self._run_submission(cmd)
+
+
+    def _run_submission(self, cmd):
+        """execute submission command. raises CalledProcessError on failure
+        """
+
+        logger.info("Starting pipeline: %s", cmd)
+        #os.chdir(os.path.dirname(run_out))
+        try:
+            res = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            # if cluster has not compute nodes (e.g. AWS
+            # autoscaling to 0), UGE will throw an error, but job
+            # still gets submitted
+            if 'job is not allowed to run in any queue' in e.output.decode():
+                logger.warning("Looks like cluster cooled down (no compute nodes available)."
+                               " Job is submitted nevertheless and should start soon.")
+            else:
+                raise
+
+        submission_log_abs = os.path.abspath(os.path.join(
+            self.outdir, self.submissionlog))
+        master_log_abs = os.path.abspath(os.path.join(
+            self.outdir, self.masterlog))
+        logger.debug("For submission details see %s", submission_log_abs)
+        logger.info("The (master) logfile is %s", master_log_abs)
+
+
+    @staticmethod
+    def submit_queued(max_parallel=8):
+        """submit all queued instances, max_parallel at a time. returns
+        list of (instance, success) tuples
+        """
+
+        def submit_one(pipeline_handler):
+            """submit and return success"""
             try:
-                res = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+                pipeline_handler._run_submission(pipeline_handler.submission_cmd())
             except subprocess.CalledProcessError as e:
-                # if cluster has not compute nodes (e.g. AWS
-                # autoscaling to 0), UGE will throw an error, but job
-                # still gets submitted
-                if 'job is not allowed to run in any queue' in e.output.decode():
-                    logger.warning("Looks like cluster cooled down (no compute nodes available)."
-                                   " Job is submitted nevertheless and should start soon.")
-                else:
-                    raise
+                logger.fatal("Submission for %s failed with return code %s: %s",
+                             pipeline_handler.outdir, e.returncode, e.output.decode())
+                return False
+            return True
+
+        queued = PipelineHandler.queued_submissions
+        PipelineHandler.queued_submissions = []
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            return list(zip(queued, executor.map(submit_one, queued)))
+
+
+    @staticmethod
+    def setup_many(records, max_parallel_submissions=8):
+        """Set up many analyses in one process and submit them
+        pipelined. records is a list of (pipeline_script, args) tuples,
+        i.e. pipeline wrapper and its command line arguments (see
+        run_wrapper()). Configs and reference metadata are parsed only
+        once and shared across all analyses. Returns list of success
+        status per record
+
+        Only wrappers of this installation are run in-process. In
+        production, with versioned installations under one root
+        (<root>/<version>/<pipeline>), that means only records of the
+        version this is called from benefit. Others run as subprocess
+        of their own installation, so call this from the installation
+        matching the pipeline version of most records
+        """
+
+        status = [False] * len(records)
+        record_for_handler = dict()
+        PipelineHandler.queue_submissions = True
+        try:
+            for i, (pipeline_script, args) in enumerate(records):
+                num_queued = len(PipelineHandler.queued_submissions)
+                status[i] = run_wrapper(pipeline_script, args)
+                for pipeline_handler in PipelineHandler.queued_submissions[num_queued:]:
+                    record_for_handler[id(pipeline_handler)] = i
+        finally:
+            PipelineHandler.queue_submissions = False
+
+        for pipeline_handler, success in PipelineHandler.submit_queued(
+                max_parallel_submissions):
+            i = record_for_handler[id(pipeline_handler)]
+            status[i] = status[i] and success
+        return status
+
+
+def run_wrapper(pipeline_script, args):
+    """Run pipeline wrapper script with given list of arguments and
+    return success status. Wrappers belonging to this installation are
+    run in-process by calling their main(), so that imported modules,
+    parsed configs etc. are reused. Wrappers of other installations
+    (e.g. other production versions) are run as subprocess, since they
+    need their own lib. Paths are compared after resolving symlinks,
+    i.e. a wrapper called via a symlinked version directory (e.g.
+    'current') still runs in-process if it resolves to this installation
+
+    Wrappers derive their directories from __file__, so they are
+    imported only once per process. Their module level setting of
+    yaml.Dumper.ignore_aliases is applied for the duration of main()
+    only
+    """
 
-            submission_log_abs = os.path.abspath(os.path.join(
-                self.outdir, self.submissionlog))
-            master_log_abs = os.path.abspath(os.path.join(
-                self.outdir, self.masterlog))
-            logger.debug("For submission details see %s", submission_log_abs)
-            logger.info("The (master) logfile is %s", master_log_abs)
+    script = os.path.realpath(pipeline_script)
+    rootdir = os.path.realpath(PIPELINE_ROOTDIR)
+    if not script.startswith(rootdir + os.sep):
+        cmd = [pipeline_script] + list(args)
+        logger.info("Running %s as subprocess, since it's not part of this installation (%s)",
+                    pipeline_script, rootdir)
+        try:
+            _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            logger.fatal("The following command failed with return code %s: %s",
+                         e.returncode, ' '.join(cmd))
+            logger.fatal("Output: %s", e.output.decode())
+            return False
+        return True
+
+    # wrappers parse arguments from sys.argv
+    orig_argv = sys.argv
+    orig_ignore_aliases = yaml.Dumper.ignore_aliases
+    sys.argv = [script] + list(args)
+    try:
+        if script not in _WRAPPER_MODULES:
+            spec = importlib.util.spec_from_file_location(
+                "pipeline_wrapper_{}".format(len(_WRAPPER_MODULES)), script)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _WRAPPER_MODULES[script] = (module, yaml.Dumper.ignore_aliases)
+        module, yaml.Dumper.ignore_aliases = _WRAPPER_MODULES[script]
+        module.main()
+    except SystemExit as e:
+        if e.code:
+            logger.fatal("%s failed with exit status %s", pipeline_script, e.code)
+            return False
+    except Exception:# pylint: disable=broad-except
+        logger.exception("%s failed", pipeline_script)
+        return False
+    finally:
+        sys.argv = orig_argv
+        yaml.Dumper.ignore_aliases = orig_ignore_aliases
+    return True
 
 
 def default_argparser(cfg_dir,
@@ -504,9 +687,11 @@ def default_argparser(cfg_dir,
                         help="Output directory (must not exist)")
 
     rep_group = parser.add_argument_group('Reporting')
-    default = email_for_user()
-    rep_group.add_argument('--mail', dest='mail_address', default=default,
-                           help="Send completion emails to this address (default: {})".format(default))
+    # default resolved in PipelineHandler, i.e. only when needed, since
+    # it might require a call to the user mail mapper
+    rep_group.add_argument('--mail', dest='mail_address',
+                           help="Send completion emails to this address"
+                           " (default: email address of current user)")
     rep_group.add_argument('--name',
                            help="Give this analysis run a name (used in email and report)")
     rep_group.add_argument('--no-mail', action='store_true',
@@ -554,27 +739,59 @@ def default_argparser(cfg_dir,
     return parser
 
 
-def get_pipeline_version(nospace=False):
-    """determine pipeline version as defined by updir file
+def _pipeline_version_cache_key():
+    """returns a key that changes whenever VERSION or the checked out git
+    commit of this installation changes. derived from file stats only,
+    i.e. without calling git. returns None if no reliable key can be
+    derived (e.g. .git is not a directory)
     """
     version_file = os.path.abspath(os.path.join(PIPELINE_ROOTDIR, "VERSION"))
-    with open(version_file) as fh:
-        version = fh.readline().strip()
-    cwd = os.getcwd()
-    os.chdir(PIPELINE_ROOTDIR)
-    if os.path.exists(".git"):
-        commit = None
-        cmd = ['git', 'rev-parse', '--short', 'HEAD']
-        try:
-            res = subprocess.check_output(cmd)
-            commit = res.decode().strip()
-        except (subprocess.CalledProcessError, OSError) as _:
-            pass
-        if commit:
-            version = "{} {}".format(version, commit)
+    key = [file_cache_key(version_file)]
+    git_dir = os.path.abspath(os.path.join(PIPELINE_ROOTDIR, ".git"))
+    if os.path.exists(git_dir):
+        if not os.path.isdir(git_dir):
+            return None
+        head_file = os.path.join(git_dir, "HEAD")
+        with open(head_file) as fh:
+            head = fh.read().strip()
+        key.append(head)
+        if head.startswith("ref:"):
+            for f in [os.path.join(git_dir, head[4:].strip()),
+                      os.path.join(git_dir, "packed-refs")]:
+                if os.path.exists(f):
+                    key.append(file_cache_key(f))
+    return tuple(key)
+
+
+def get_pipeline_version(nospace=False):
+    """determine pipeline version as defined by updir file. result is
+    cached per installation until VERSION or git HEAD change
+    """
+    cache_name = "pipeline_version:" + os.path.abspath(PIPELINE_ROOTDIR)
+    cache_key = _pipeline_version_cache_key()
+    version = None
+    if cache_key:
+        version = read_cache(cache_name, cache_key)
+
+    if version is None:
+        version_file = os.path.abspath(os.path.join(PIPELINE_ROOTDIR, "VERSION"))
+        with open(version_file) as fh:
+            version = fh.readline().strip()
+        if os.path.exists(os.path.join(PIPELINE_ROOTDIR, ".git")):
+            commit = None
+            cmd = ['git', 'rev-parse', '--short', 'HEAD']
+            try:
+                res = subprocess.check_output(cmd, cwd=PIPELINE_ROOTDIR)
+                commit = res.decode().strip()
+            except (subprocess.CalledProcessError, OSError) as _:
+                pass
+            if commit:
+                version = "{} {}".format(version, commit)
+        if cache_key:
+            write_cache(cache_name, cache_key, version)
+
     if nospace:
         version = version.replace(" ", "-")
-    os.chdir(cwd)
     return version
 
 
@@ -611,10 +828,23 @@ def get_init_call():
     return cmd
 
 
-def get_rpd_vars():
-    """Read RPD variables set by calling and parsing output from init
+def get_rpd_vars(use_cache=True):
+    """Read RPD variables set by calling and parsing output from
+    init. Results are cached, keyed by the init script's mtime and
+    content hash, so that the init script is only sourced if it changed
     """
 
+    init = site_cfg['init']
+    cache_name = "rpd_vars:" + os.path.abspath(init)
+    cache_key = None
+    if use_cache and os.path.isfile(init):
+        with open(init, 'rb') as fh:
+            init_md5 = hashlib.md5(fh.read()).hexdigest()
+        cache_key = (file_cache_key(init), init_md5, is_devel_version())
+        rpd_vars = read_cache(cache_name, cache_key)
+        if rpd_vars is not None:
+            return rpd_vars
+
     cmd = get_init_call()
     cmd = ' '.join(cmd) + ' && set | grep "^RPD_"'
     try:
@@ -630,9 +860,41 @@ def get_rpd_vars():
             #logger.debug("line = {}".format(line))
             k, v = line.split('=')
             rpd_vars[k.strip()] = v.strip()
+    if cache_key:
+        write_cache(cache_name, cache_key, rpd_vars)
     return rpd_vars
 
 
+def substitute_rpd_vars(cfg, rpd_vars):
+    """Replace all instances of $RPD_* variables in keys and values of
+    (nested) config dicts and lists. Returns a new object
+    """
+
+    if isinstance(cfg, str):
+        for k, v in rpd_vars.items():
+            cfg = cfg.replace("${}".format(k), v)
+        return cfg
+    elif isinstance(cfg, dict):
+        return dict((substitute_rpd_vars(k, rpd_vars), substitute_rpd_vars(v, rpd_vars))
+                    for k, v in cfg.items())
+    elif isinstance(cfg, list):
+        return [substitute_rpd_vars(v, rpd_vars) for v in cfg]
+    else:
+        return cfg
+
+
+def num_chroms_in_fasta(fasta):
+    """return number of sequences in (indexed) fasta. memoized per
+    process, keyed by fai stats
+    """
+    fai = fasta + ".fai"
+    assert os.path.exists(fai), ("{} not indexed".format(fasta))
+    memo_key = file_cache_key(fai)
+    if memo_key not in _NUM_CHROMS_MEMO:
+        _NUM_CHROMS_MEMO[memo_key] = len(list(chroms_and_lens_from_fasta(fasta)))
+    return _NUM_CHROMS_MEMO[memo_key]
+
+
 def isoformat_to_epoch_time(ts):
     """
     Converts ISO8601 format (analysis_id) into epoch time
@@ -711,8 +973,8 @@ def user_mail_mapper(user_name):
         user_email = rest_services['user_mail_mapper']['production'] + user_name
         
     try:
-        response = requests.get(user_email)
-    except requests.exceptions.ConnectionError:
+        response = requests.get(user_email, timeout=USER_MAIL_MAPPER_TIMEOUT_SEC)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         logger.warning("Couldn't connect to user_mail_mapper")
         return None
     
@@ -725,16 +987,26 @@ def user_mail_mapper(user_name):
     return rest_data.get('userEmail')
 
 
-def email_for_user():
-    """get email for user (naive)
+def email_for_user(use_cache=True):
+    """get email for user (naive). mapper results are cached on disk
+    for USER_MAIL_CACHE_TTL_SEC
     """
     user_name = getuser()
     if user_name == "userrig":
-        toaddr = "rpd@gis.a-star.edu.sg"
+        return "rpd@gis.a-star.edu.sg"
+
+    cache_name = "user_mail:" + user_name
+    if use_cache:
+        toaddr = read_cache(cache_name, user_name,
+                            max_age_sec=USER_MAIL_CACHE_TTL_SEC)
+        if toaddr:
+            return toaddr
+    toaddr = user_mail_mapper(user_name)
+    if toaddr is None:
+        # not cached, so that mapper is asked again next time
+        toaddr = "{}@gis.a-star.edu.sg".format(user_name)
     else:
-        toaddr = user_mail_mapper(user_name)
-        if toaddr is None:
-            toaddr = "{}@gis.a-star.edu.sg".format(user_name)
+        write_cache(cache_name, user_name, toaddr)
     return toaddr
 
 
@@ -879,14 +1151,7 @@ def mux_to_lib(mux_id, testing=False):
     """returns the component libraries for MUX
     """
     lib_list = []
-    if not testing:
-        rest_url = rest_services['lib_details']['production'].replace("lib_id", mux_id)
-    else:
-        rest_url = rest_services['lib_details']['testing'].replace("lib_id", mux_id)
-    response = requests.get(rest_url)
-    if response.status_code != requests.codes.ok:
-        response.raise_for_status()
-    rest_data = response.json()
+    rest_data = lib_details(mux_id, testing)
     if 'plexes' not in rest_data:
         logger.fatal("FATAL: plexes info for %s is not available in ELM \n", mux_id)
         sys.exit(1)
@@ -900,6 +1165,11 @@ def bundle_and_clean_logs(pipeline_outdir, result_outdir="out/",
     """bundle log files in pipeline_outdir+result_outdir and
     pipeline_outdir+log_dir to pipeline_outdir+logs.tar.gz and remove
 
+    The bundle is written with logbundle.write_bundle, i.e. compressed
+    in parallel and indexed, so that single logs can be read with
+    logbundle.read_member (or tools/log_bundle.py). It's still a valid
+    tar.gz
+
     See http://stackoverflow.com/questions/40602894/access-to-log-files for potential alternatives
     """
 
@@ -921,14 +1191,17 @@ def bundle_and_clean_logs(pipeline_outdir, result_outdir="out/",
     logfiles = glob.glob(os.path.join(result_outdir, "**/*.log"), recursive=True)
     # (cluster) log directory
     logfiles.extend(glob.glob(os.path.join(log_dir, "*")))
-    # paranoid cleaning and some exclusion
+    # paranoid cleaning and some exclusion, including the bundle
+    # itself, older bundles and their (temporary) indices
     logfiles = [f for f in logfiles if os.path.isfile(f)
-                and not f.endswith("snakemake.log")]
-
-    with tarfile.open(bundle, "w:gz") as tarfh:
-        for f in logfiles:
-            tarfh.add(f)
-            os.unlink(f)
+                and not f.endswith("snakemake.log")
+                and not f.endswith(INDEX_EXT)
+                and not fnmatch.fnmatch(os.path.basename(f), "logs*.tar.gz*")]
+
+    # only remove logs once they are all safely bundled
+    write_bundle(bundle, logfiles)
+    for f in logfiles:
+        os.unlink(f)
 
     os.chdir(orig_dir)
 
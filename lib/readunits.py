@@ -13,6 +13,7 @@ http://gatkforums.broadinstitute.org/gatk/discussion/6472/read-groups
 import logging
 from collections import namedtuple
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import zip_longest
 import hashlib
 import os
@@ -37,6 +38,12 @@ __license__ = "The MIT License (MIT)"
 ReadUnit = namedtuple('ReadUnit',
                       ['run_id', 'flowcell_id', 'library_id', 'lane_id', 'rg_id', 'fq1', 'fq2'])
 
+ReadGroup = namedtuple('ReadGroup',
+                       ['rg_id', 'lib_id', 'pu_id', 'sample'])
+
+UnitIndex = namedtuple('UnitIndex',
+                       ['sample_for_unit', 'units_for_sample', 'read_groups'])
+
 
 # global logger
 logger = logging.getLogger(__name__)
@@ -49,6 +56,68 @@ logger.addHandler(handler)
 yaml.Dumper.ignore_aliases = lambda *args: True
 
 
+# threads used for stat'ing input files. stats are mostly waiting for
+# the (network) filesystem, so this can exceed the number of cores
+STAT_THREADS = 16
+
+# id of config to samples and readunits (kept to detect changes), their
+# sizes and UnitIndex. see unit_index()
+_UNIT_INDEXES = dict()
+
+# absolute path of input file to (size, mtime) as recorded by
+# stat_files(), so that later steps (e.g. max_sample_input_bytes())
+# don't have to stat again
+_FILE_STATS = dict()
+
+
+def is_remote(path):
+    """input files on s3 are not checked locally"""
+    return path.startswith("s3://")
+
+
+def stat_files(paths, threads=STAT_THREADS, record_stats=True):
+    """stat local paths concurrently using a pool of threads. returns dict
+    of path to os.stat_result or None if path doesn't exist (or can't be
+    accessed). if record_stats is set, size and mtime of existing files
+    are remembered (see file_stats())
+    """
+
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    paths = sorted(set(paths))
+    if len(paths) < 2:
+        stats = dict((p, _stat(p)) for p in paths)
+    else:
+        with ThreadPoolExecutor(max_workers=min(threads, len(paths))) as executor:
+            stats = dict(zip(paths, executor.map(_stat, paths)))
+    if record_stats:
+        for p, stat in stats.items():
+            if stat:
+                _FILE_STATS[os.path.abspath(p)] = (stat.st_size, stat.st_mtime)
+    return stats
+
+
+def file_stats(path):
+    """return (size, mtime) of path as recorded by stat_files() or None
+    if unknown
+    """
+    return _FILE_STATS.get(os.path.abspath(path))
+
+
+def missing_input_files(paths, threads=STAT_THREADS, record_stats=True):
+    """return sorted list of non-existing files among paths. remote paths
+    and None are ignored. all others are stat'ed concurrently (see
+    stat_files())
+    """
+    local_paths = [p for p in paths if p and not is_remote(p)]
+    stats = stat_files(local_paths, threads, record_stats)
+    return sorted(p for p, stat in stats.items() if stat is None)
+
+
 def gen_rg_lib_id(unit):
     """generate read group lib id from readunit"""
     if unit['library_id']:
@@ -57,13 +126,56 @@ def gen_rg_lib_id(unit):
         return "LIB-DUMMY"
 
 
+def unit_index(config):
+    """Return UnitIndex for config, i.e. dicts of readunit key to sample
+    and ReadGroup and of sample to readunit keys. Rule params are
+    evaluated once per job during DAG construction, so the index is
+    built only once per config and rebuilt only if samples or readunits
+    were replaced or changed in size
+    """
+    samples = config["samples"]
+    readunits = config["readunits"]
+    sizes = (len(samples), len(readunits))
+    cached = _UNIT_INDEXES.get(id(config))
+    if cached and cached[0] is samples and cached[1] is readunits and cached[2] == sizes:
+        return cached[3]
+
+    sample_for_unit = dict()
+    units_for_sample = dict()
+    for samplename, sample_rus in samples.items():
+        units_for_sample[samplename] = list(sample_rus)
+        for ru_key in sample_rus:
+            # first sample wins, as in the former linear search
+            sample_for_unit.setdefault(ru_key, samplename)
+    read_groups = dict()
+    for ru_key, unit in readunits.items():
+        read_groups[ru_key] = ReadGroup(unit['rg_id'], gen_rg_lib_id(unit),
+                                        gen_rg_pu_id(unit), sample_for_unit.get(ru_key))
+    index = UnitIndex(sample_for_unit, units_for_sample, read_groups)
+    _UNIT_INDEXES[id(config)] = (samples, readunits, sizes, index)
+    return index
+
+
 def get_sample_for_unit(unitname, config):
-    """FIXME:add-doc
+    """Return name of sample readunit unitname belongs to. Raises
+    ValueError if not part of any sample
     """
-    for samplename, readunits in config["samples"].items():
-        if unitname in readunits:
-            return samplename
-    raise ValueError(unitname)
+    try:
+        return unit_index(config).sample_for_unit[unitname]
+    except KeyError:
+        raise ValueError(unitname)
+
+
+def get_units_for_sample(samplename, config):
+    """Return list of readunit keys of sample samplename"""
+    return unit_index(config).units_for_sample[samplename]
+
+
+def get_read_group_for_unit(unitname, config):
+    """Return ReadGroup (rg_id, lib_id, pu_id, sample) of readunit
+    unitname, e.g. for setting @RG of mapped reads
+    """
+    return unit_index(config).read_groups[unitname]
 
 
 def gen_rg_pu_id(unit):
@@ -116,8 +228,34 @@ def fastqs_from_unit_as_list(unit):
     return [objectify_remote(x) for x in fqs]
 
 
+def max_sample_input_bytes(samples, readunits):
+    """Return size of the largest sample in bytes, i.e. the largest sum
+    of fastq sizes of a sample's readunits. Remote and non-existing
+    files are ignored. Returns None if no size is known. Sizes recorded
+    during validation are reused, all others are stat'ed concurrently
+    """
+    fqs = [fq for unit in readunits.values()
+           for fq in [unit['fq1'], unit.get('fq2')]
+           if fq and not is_remote(fq)]
+    stat_files([fq for fq in fqs if file_stats(fq) is None])
+
+    max_bytes = None
+    for sample_rus in samples.values():
+        num_bytes = None
+        for ru_key in sample_rus:
+            unit = readunits[ru_key]
+            for fq in [unit['fq1'], unit.get('fq2')]:
+                if fq and not is_remote(fq) and file_stats(fq):
+                    num_bytes = (num_bytes or 0) + file_stats(fq)[0]
+        if num_bytes is not None and (max_bytes is None or num_bytes > max_bytes):
+            max_bytes = num_bytes
+    return max_bytes
+
+
 def get_samples_and_readunits_from_cfgfile(cfgfile, raise_off=False):
-    """Parse each ReadUnit in cfgfile and return as list
+    """Parse each ReadUnit in cfgfile and return as list. Input files
+    are checked for existence all at once (see missing_input_files())
+    and all missing ones are reported together
     """
 
     with open(cfgfile) as fh_cfg:
@@ -157,23 +295,25 @@ def get_samples_and_readunits_from_cfgfile(cfgfile, raise_off=False):
 
         # if we have s3 paths, leave them as they are, but make
         # relative paths abs relative to cfgfile
-        if not os.path.isabs(fq1) and not fq1.startswith("s3://"):
+        if not os.path.isabs(fq1) and not is_remote(fq1):
             fq1 = os.path.abspath(os.path.join(os.path.dirname(cfgfile), fq1))
-        if fq2 and not os.path.isabs(fq2) and not fq2.startswith("s3://"):
+        if fq2 and not os.path.isabs(fq2) and not is_remote(fq2):
             fq2 = os.path.abspath(os.path.join(os.path.dirname(cfgfile), fq2))
 
-        for f in [fq1, fq2]:
-            if f and not os.path.exists(f) and not f.startswith("s3://"):
-                logger.fatal("Non-existing input file %s in config file %s", f, cfgfile)
-                if not raise_off:
-                    raise ValueError(cfgfile)
-
         ru = ReadUnit(run_id, flowcell_id, library_id, lane_id, rg_id,
                       fq1, fq2)
         if not rg_id:
             ru = ru._replace(rg_id=create_rg_id_from_ru(ru))
         readunits[ru_key] = dict(ru._asdict())
 
+    missing = missing_input_files(
+        [f for ru in readunits.values() for f in [ru['fq1'], ru['fq2']]])
+    if missing:
+        logger.fatal("%d non-existing input file(s) in config file %s:\n%s",
+                     len(missing), cfgfile, "\n".join(missing))
+        if not raise_off:
+            raise ValueError(cfgfile)
+
     return samples, readunits
 
 
@@ -191,10 +331,14 @@ def get_readunits_from_args(fqs1, fqs2):
         fqs2 = len(fqs1)*[None]
         paired = False
 
-    for f in fqs1 + fqs2:
-        if f and not os.path.exists(f):
-            logger.fatal("Non-existing input file %s", f)
-            raise ValueError(f)
+    # unlike in config files, s3 paths are not supported here, i.e.
+    # all paths are stat'ed
+    stats = stat_files([f for f in fqs1 + fqs2 if f])
+    missing = sorted(f for f, stat in stats.items() if stat is None)
+    if missing:
+        logger.fatal("%d non-existing input file(s):\n%s",
+                     len(missing), "\n".join(missing))
+        raise ValueError(", ".join(missing))
 
     if paired:
         print_fq_sort_warning = False
@@ -344,15 +488,19 @@ def readunits_for_sampledir(sampledir, fq1_pattern="*_R1*.fastq.gz",
     if not len(fq1s):
         return None
     scheme = scheme_for_fastq(fq1s[0])
-    readunits = dict()
     for fq1 in fq1s:
-        match = scheme.search(os.path.basename(fq1))
-        mgroups = match.groupdict()
         assert fq1.count(fq1_to_fq2[0]) == 1, (
             "More than one occurence of fq1 to fq2 replacement pattern in {}".format(fq1))
-        fq2 = fq1.replace(fq1_to_fq2[0], fq1_to_fq2[1])
+    # stat all fq1s and fq2 candidates in one go
+    fq2s = dict((fq1, fq1.replace(fq1_to_fq2[0], fq1_to_fq2[1])) for fq1 in fq1s)
+    stats = stat_files(fq1s + list(fq2s.values()))
 
-        if not os.path.exists(fq2):
+    readunits = dict()
+    for fq1 in fq1s:
+        match = scheme.search(os.path.basename(fq1))
+        mgroups = match.groupdict()
+        fq2 = fq2s[fq1]
+        if stats[fq2] is None:
             fq2 = None
         rg = None
 
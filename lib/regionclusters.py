@@ -0,0 +1,391 @@
+"""Planning of region clusters
+
+Region clusters are groups of regions (usually whole chromosomes,
+see config['references']['region_clusters']) which are processed by
+one job each, e.g. in the GATK HaplotypeCaller. If the user provided
+intervals (bed), clusters are intersected with them. Clusters might
+then be empty, in which case no jobs should be created for them.
+
+Balanced region clusters for a reference can be created with
+balanced_clusters() (see tools/plan_region_clusters.py). Per cluster
+output is concatenated in cluster order, so clusters have to be
+consecutive stretches of the genome (in fai order).
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import hashlib
+import logging
+from bisect import bisect_left
+from bisect import bisect_right
+from itertools import accumulate
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+from utils import parse_regions_from_bed
+from utils import read_cache
+from utils import write_cache
+from utils import file_cache_key
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def parse_region(region):
+    """Parse region string of form sq:start-end (0-based, half-open as
+    in bed) into three tuple
+
+    >>> parse_region("chr1:0-1000")
+    ('chr1', 0, 1000)
+    """
+    r_sq, r_startend = region.rsplit(":", 1)
+    r_start, r_end = [int(x) for x in r_startend.split("-")]
+    assert r_start >= 0 and r_end > r_start, ("region {} malformed".format(region))
+    return (r_sq, r_start, r_end)
+
+
+def merge_regions(regions):
+    """Merge overlapping and adjacent regions (three tuples). Returns
+    dict of sequence to sorted list of (start, end)
+
+    >>> merge_regions([('c', 5, 10), ('c', 0, 3), ('c', 3, 4), ('c', 8, 12)])
+    {'c': [(0, 4), (5, 12)]}
+    """
+    per_sq = dict()
+    for sq, start, end in regions:
+        per_sq.setdefault(sq, []).append((start, end))
+    merged = dict()
+    for sq, ivs in per_sq.items():
+        ivs.sort()
+        res = [ivs[0]]
+        for start, end in ivs[1:]:
+            if start <= res[-1][1]:
+                if end > res[-1][1]:
+                    res[-1] = (res[-1][0], end)
+            else:
+                res.append((start, end))
+        merged[sq] = res
+    return merged
+
+
+def intersect_clusters(clusters, merged_intervals):
+    """Intersect clusters (list of list of regions as three tuple) with
+    intervals as returned by merge_regions(). Returns list of
+    intersected regions per cluster
+
+    >>> intersect_clusters([[('c', 0, 100)], [('d', 0, 10)]], {'c': [(5, 10), (90, 200)]})
+    [[('c', 5, 10), ('c', 90, 100)], []]
+    """
+    starts = dict((sq, [s for s, _ in ivs]) for sq, ivs in merged_intervals.items())
+    plan = []
+    for cluster in clusters:
+        regions = []
+        for sq, r_start, r_end in cluster:
+            ivs = merged_intervals.get(sq)
+            if not ivs:
+                continue
+            # first interval that could overlap
+            i = max(bisect_right(starts[sq], r_start) - 1, 0)
+            while i < len(ivs) and ivs[i][0] < r_end:
+                start, end = max(ivs[i][0], r_start), min(ivs[i][1], r_end)
+                if start < end:
+                    regions.append((sq, start, end))
+                i += 1
+        plan.append(regions)
+    return plan
+
+
+def subtract_regions(regions, merged_gaps):
+    """Remove merged_gaps (see merge_regions()) from sorted, non-overlapping
+    regions (three tuples)
+
+    >>> subtract_regions([('c', 0, 100)], {'c': [(10, 20), (90, 120)]})
+    [('c', 0, 10), ('c', 20, 90)]
+    """
+    res = []
+    for sq, r_start, r_end in regions:
+        gaps = merged_gaps.get(sq, [])
+        i = max(bisect_right([s for s, _ in gaps], r_start) - 1, 0)
+        start = r_start
+        while i < len(gaps) and gaps[i][0] < r_end:
+            g_start, g_end = gaps[i]
+            if g_end > start:
+                if g_start > start:
+                    res.append((sq, start, g_start))
+                start = max(start, g_end)
+            i += 1
+        if start < r_end:
+            res.append((sq, start, r_end))
+    return res
+
+
+def callable_segments(chrom_lens, gaps=None, intervals=None):
+    """Return callable segments (three tuples) in order of chrom_lens
+    (list of sequence name and length, e.g. from a fai). gaps (e.g. N
+    regions) are removed and if given, segments are restricted to
+    intervals. gaps and intervals are bed files
+    """
+    segments = [(sq, 0, l) for sq, l in chrom_lens]
+    if gaps:
+        segments = subtract_regions(segments, merge_regions(parse_regions_from_bed(gaps)))
+    if intervals:
+        segments = intersect_clusters(
+            [segments], merge_regions(parse_regions_from_bed(intervals)))[0]
+    return segments
+
+
+def read_benchmark_seconds(benchmark_log):
+    """Return mean wall clock seconds in Snakemake benchmark log"""
+    secs = []
+    with open(benchmark_log) as fh:
+        for line in fh:
+            value = line.split("\t")[0].strip()
+            try:
+                secs.append(float(value))
+            except ValueError:
+                # header
+                continue
+    if not secs:
+        raise ValueError("No runtime found in {}".format(benchmark_log))
+    return sum(secs) / len(secs)
+
+
+def cluster_of_benchmark_log(benchmark_log):
+    """Return cluster number of per cluster benchmark log, e.g.
+    {prefix}.{ctr}.g.vcf.gz.gatk_haplotype_caller.benchmark.log, or None
+
+    >>> cluster_of_benchmark_log("out/s1/s1.12.g.vcf.gz.gatk_haplotype_caller.benchmark.log")
+    12
+    """
+    nums = re.findall(r'\.(\d+)\.', os.path.basename(benchmark_log))
+    return int(nums[-1]) if nums else None
+
+
+def runtime_rates(region_clusters, benchmark_logs, segments):
+    """Derive runtime per callable bp from benchmark logs of runs, which
+    used region_clusters (list of list of region strings). Runtimes of
+    several logs per cluster are averaged. Returns list of (sq, start,
+    end, seconds per bp)
+    """
+    runtimes = dict()
+    for log in benchmark_logs:
+        ctr = cluster_of_benchmark_log(log)
+        if ctr is None or ctr >= len(region_clusters):
+            logger.warning("Ignoring %s: can't match to a region cluster", log)
+            continue
+        runtimes.setdefault(ctr, []).append(read_benchmark_seconds(log))
+
+    clusters = [[parse_region(r) for r in cluster] for cluster in region_clusters]
+    callable_per_cluster = intersect_clusters(clusters, merge_regions(segments))
+    rates = []
+    for ctr, times in sorted(runtimes.items()):
+        bp = sum(e - s for _, s, e in callable_per_cluster[ctr])
+        if not bp:
+            continue
+        rate = sum(times) / len(times) / bp
+        rates.extend((sq, s, e, rate) for sq, s, e in clusters[ctr])
+    return rates
+
+
+def weight_segments(segments, rates=None):
+    """Attach cost per bp to segments, which are split where rates
+    (see runtime_rates()) change. Without rates each bp costs 1.
+    Segments not covered by rates get the mean rate
+    """
+    if not rates:
+        return [(sq, s, e, 1.0) for sq, s, e in segments]
+
+    total_bp = sum(e - s for _, s, e, _ in rates)
+    default_rate = sum((e - s) * r for _, s, e, r in rates) / total_bp
+    rates_per_sq = dict()
+    for sq, s, e, r in sorted(rates, key=lambda x: (x[0], x[1])):
+        rates_per_sq.setdefault(sq, []).append((s, e, r))
+
+    weighted = []
+    for sq, s, e in segments:
+        pos = s
+        for r_start, r_end, rate in rates_per_sq.get(sq, []):
+            if r_end <= pos or r_start >= e:
+                continue
+            if r_start > pos:
+                weighted.append((sq, pos, r_start, default_rate))
+                pos = r_start
+            end = min(r_end, e)
+            weighted.append((sq, pos, end, rate))
+            pos = end
+        if pos < e:
+            weighted.append((sq, pos, e, default_rate))
+    return weighted
+
+
+def balanced_clusters(weighted_segments, num_clusters, snap_tolerance=0.05):
+    """Partition ordered weighted_segments (sq, start, end, cost per bp;
+    see weight_segments()) into num_clusters consecutive clusters of
+    equal cost. This is optimal for a fixed order (unlike bin packing,
+    which would scramble the genome order). Cuts are placed at segment
+    boundaries (e.g. gaps or sequence ends) if one is within
+    snap_tolerance (fraction of cost per cluster) of the ideal cut,
+    otherwise within a segment. Returns list of regions (three
+    tuples) per cluster
+
+    >>> balanced_clusters([('a', 0, 100, 1.0), ('b', 0, 50, 1.0), ('c', 0, 50, 1.0)], 2)
+    [[('a', 0, 100)], [('b', 0, 50), ('c', 0, 50)]]
+    >>> balanced_clusters([('a', 0, 100, 1.0)], 4)
+    [[('a', 0, 25)], [('a', 25, 50)], [('a', 50, 75)], [('a', 75, 100)]]
+    """
+    costs = [(e - s) * r for _, s, e, r in weighted_segments]
+    cum = list(accumulate(costs))
+    total = cum[-1] if cum else 0
+    if not total:
+        raise ValueError("Nothing to distribute")
+    target = total / num_clusters
+
+    # cuts per segment index: None means before segment, otherwise a
+    # position within it
+    cuts = dict()
+    last_cut = (0, None)
+    for j in range(1, num_clusters):
+        ideal = j * target
+        i = bisect_left(cum, ideal)
+        best = None
+        best_dist = snap_tolerance * target
+        # segment ends closest to ideal are those of i-1 and i
+        for k in (i - 1, i):
+            if 0 <= k < len(cum) - 1 and abs(cum[k] - ideal) <= best_dist:
+                if best is None or abs(cum[k] - ideal) < best_dist:
+                    best, best_dist = k, abs(cum[k] - ideal)
+        if best is not None:
+            cut = (best + 1, None)
+        else:
+            _, s, e, rate = weighted_segments[i]
+            pos = s + int(round((ideal - (cum[i] - costs[i])) / rate))
+            cut = (i, min(max(pos, s + 1), e - 1))
+        # keep cuts strictly increasing (might collide for tiny input)
+        if (cut[0], cut[1] if cut[1] is not None else -1) <= \
+           (last_cut[0], last_cut[1] if last_cut[1] is not None else -1):
+            continue
+        cuts.setdefault(cut[0], []).append(cut[1])
+        last_cut = cut
+
+    clusters = [[]]
+    for i, (sq, s, e, _) in enumerate(weighted_segments):
+        start = s
+        for pos in cuts.get(i, []):
+            if pos is None:
+                clusters.append([])
+            else:
+                clusters[-1].append((sq, start, pos))
+                clusters.append([])
+                start = pos
+        clusters[-1].append((sq, start, e))
+    if len(clusters) < num_clusters:
+        logger.warning("Could only create %d instead of %d clusters",
+                       len(clusters), num_clusters)
+    return clusters
+
+
+def cluster_costs(clusters, weighted_segments):
+    """Return cost per cluster (list of regions as three tuples) given
+    weighted_segments (see weight_segments())
+
+    >>> cluster_costs([[('a', 0, 10)], [('a', 10, 30)]], [('a', 0, 20, 1.0), ('a', 20, 30, 2.0)])
+    [10.0, 30.0]
+    """
+    per_sq = dict()
+    for sq, s, e, rate in weighted_segments:
+        per_sq.setdefault(sq, []).append((s, e, rate))
+    costs = []
+    for cluster in clusters:
+        cost = 0
+        for sq, r_start, r_end in cluster:
+            for s, e, rate in per_sq.get(sq, []):
+                overlap = min(e, r_end) - max(s, r_start)
+                if overlap > 0:
+                    cost += overlap * rate
+        costs.append(cost)
+    return costs
+
+
+def region_strings(clusters):
+    """Format clusters (list of list of three tuples) as used in
+    config['references']['region_clusters']
+
+    >>> region_strings([[('1', 0, 10), ('2', 5, 7)]])
+    [['1:0-10', '2:5-7']]
+    """
+    return [["{}:{}-{}".format(sq, s, e) for sq, s, e in cluster]
+            for cluster in clusters]
+
+
+def plan_region_clusters(region_clusters, intervals=None, use_cache=True):
+    """Return list of regions (three tuples) per region cluster, where
+    region_clusters is a list of list of region strings (see
+    parse_region()). If intervals (bed) is given, clusters are
+    intersected with it and might end up empty. Results are cached
+    as long as clusters and intervals don't change
+    """
+
+    if use_cache:
+        clusters_md5 = hashlib.md5(repr(region_clusters).encode()).hexdigest()
+        cache_name = "region_clusters:{}".format(
+            os.path.abspath(intervals) if intervals else "")
+        cache_key = (clusters_md5, file_cache_key(intervals) if intervals else None)
+        plan = read_cache(cache_name, cache_key)
+        if plan is not None:
+            return plan
+
+    clusters = [[parse_region(r) for r in cluster] for cluster in region_clusters]
+    if intervals:
+        plan = intersect_clusters(
+            clusters, merge_regions(parse_regions_from_bed(intervals)))
+    else:
+        plan = clusters
+    num_empty = sum(1 for regions in plan if not regions)
+    if num_empty:
+        logger.info("%d of %d region clusters are empty", num_empty, len(plan))
+
+    if use_cache:
+        write_cache(cache_name, cache_key, plan)
+    return plan
+
+
+def nonempty_clusters(plan):
+    """Indices of non-empty clusters in plan"""
+    return [ctr for ctr, regions in enumerate(plan) if regions]
+
+
+def write_bed(regions, bed):
+    """Write regions (three tuples) to bed"""
+    with open(bed, 'w') as fh:
+        for sq, start, end in regions:
+            fh.write("{}\t{}\t{}\n".format(sq, start, end))
+
+
+def write_manifest(plan, manifest):
+    """Write YAML manifest listing for each cluster in plan whether it's
+    non-empty and how many bp it covers
+    """
+    entries = []
+    for ctr, regions in enumerate(plan):
+        entries.append({'cluster': ctr,
+                        'nonempty': bool(regions),
+                        'bp': sum(end - start for _, start, end in regions)})
+    with open(manifest, 'w') as fh:
+        yaml.dump(entries, fh, default_flow_style=False)
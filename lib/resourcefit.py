@@ -0,0 +1,234 @@
+"""Per rule cluster resource recommendations from historical runs
+
+Observations (peak memory, wall time and threads per job) come from
+benchmark logs and scheduler accounting records collected with
+benchmarklogs.BenchmarkStore and optionally from the accounting
+database created by tools/aws.py. Memory and wall time are modelled per
+rule as linear function of the analysis input size (size of the largest
+sample), falling back to a constant if sizes are unknown or unrelated.
+Models can be turned into cluster configs for a given input size.
+"""
+
+#--- standard library imports
+#
+import math
+import logging
+import sqlite3
+import statistics
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from benchmarklogs import JOBNAME_RE
+from benchmarklogs import percentile
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# minimum number of observations with known input size needed for
+# fitting a size dependent model
+MIN_FIT_POINTS = 5
+# ... and minimum coefficient of determination of the fit
+MIN_R2 = 0.5
+
+# extra safety margins on top of the 95th percentile of observations
+# (or residuals)
+MEM_HEADROOM = 1.2
+TIME_HEADROOM = 1.5
+
+# never recommend less than this
+MIN_MEM_MB = 1024
+MIN_TIME_S = 3600
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def observations_from_store(store, pipeline=None):
+    """Return dict of rule to list of observations (dicts with
+    input_bytes, wall_s, mem_mb, threads and load) from
+    benchmarklogs.BenchmarkStore. Accounting records (maxvmem, i.e.
+    virtual memory) are only used for rules of an analysis without
+    benchmark logs. Failed jobs are ignored
+    """
+    obs = dict()
+    where = ""
+    params = []
+    if pipeline:
+        where = " AND a.pipeline_name = ?"
+        params.append(pipeline)
+    benchmarked = set()
+    for analysis_id, rule, input_bytes, wall_s, mem_mb, threads, load in store.conn.execute(
+            "SELECT a.id, b.rule, a.input_bytes, b.s, b.max_rss, b.threads, b.mean_load"
+            " FROM benchmarks b JOIN analyses a ON a.id = b.analysis_id"
+            " WHERE b.s IS NOT NULL" + where, params):
+        benchmarked.add((analysis_id, rule))
+        obs.setdefault(rule, []).append({
+            'input_bytes': input_bytes, 'wall_s': wall_s, 'mem_mb': mem_mb,
+            'threads': threads, 'load': load})
+    for analysis_id, rule, input_bytes, wall_s, mem_mb, slots in store.conn.execute(
+            "SELECT a.id, c.rule, a.input_bytes, c.wall_s, c.maxvmem_mb, c.slots"
+            " FROM accounting c JOIN analyses a ON a.id = c.analysis_id"
+            " WHERE c.failed = 0" + where, params):
+        if (analysis_id, rule) in benchmarked:
+            continue
+        obs.setdefault(rule, []).append({
+            'input_bytes': input_bytes, 'wall_s': wall_s, 'mem_mb': mem_mb,
+            'threads': slots, 'load': None})
+    return obs
+
+
+def observations_from_accounting_db(dbfile, obs=None):
+    """Add successful Snakemake jobs in accounting database created by
+    tools/aws.py to obs (dict of rule to list of observations, see
+    observations_from_store()) and return it. Input sizes are unknown
+    for these
+    """
+    if obs is None:
+        obs = dict()
+    conn = sqlite3.connect(dbfile)
+    try:
+        for jobname, wall_s, maxvmem, slots in conn.execute(
+                "SELECT jobname, ru_wallclock, maxvmem, slots FROM success_jobs"):
+            match = JOBNAME_RE.search(jobname)
+            if not match:
+                continue
+            obs.setdefault(match.group(1), []).append({
+                'input_bytes': None, 'wall_s': float(wall_s),
+                'mem_mb': float(maxvmem) / 1024**2 if maxvmem else None,
+                'threads': int(slots) if slots else None, 'load': None})
+    finally:
+        conn.close()
+    return obs
+
+
+def fit_linear(xs, ys):
+    """Least squares fit of y = intercept + slope * x. Returns
+    intercept and slope. Slope is zero if xs don't vary
+
+    >>> fit_linear([1, 2, 3], [3, 5, 7])
+    (1.0, 2.0)
+    """
+    mean_x = statistics.mean(xs)
+    mean_y = statistics.mean(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return mean_y, 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return mean_y - slope * mean_x, slope
+
+
+def fit_metric(points, headroom):
+    """Fit model for one metric from points (list of input_bytes and
+    value, where input_bytes might be None). Returns dict with
+    intercept, slope (per GB) and number of points. A size dependent
+    model is only used if enough sizes are known and the fit explains
+    the data (MIN_R2). The prediction covers the 95th percentile of
+    observations (or of residuals for size dependent models) times
+    headroom
+    """
+    values = sorted(v for _, v in points)
+    sized = [(x / 1024**3, v) for x, v in points if x is not None]
+    if len(sized) >= MIN_FIT_POINTS:
+        intercept, slope = fit_linear([x for x, _ in sized], [v for _, v in sized])
+        residuals = sorted(v - (intercept + slope * x) for x, v in sized)
+        mean_v = statistics.mean(v for _, v in sized)
+        ss_tot = sum((v - mean_v) ** 2 for _, v in sized)
+        r2 = 1 - sum(r ** 2 for r in residuals) / ss_tot if ss_tot else 0
+        if slope > 0 and r2 >= MIN_R2:
+            margin = max(percentile(residuals, 95), 0)
+            return {'intercept': round((intercept + margin) * headroom, 1),
+                    'slope_per_gb': round(slope * headroom, 1),
+                    'r2': round(r2, 2),
+                    'points': len(points)}
+    return {'intercept': round(percentile(values, 95) * headroom, 1),
+            'slope_per_gb': 0.0,
+            'points': len(points)}
+
+
+def fit_rule(observations):
+    """Fit memory (MB) and wall time (s) model for one rule from list of
+    observations. Also recommends threads based on observed CPU load
+    (if known), which is never more than the threads used
+    """
+    model = dict()
+    for metric, key, headroom in [('mem_mb', 'mem_mb', MEM_HEADROOM),
+                                  ('time_s', 'wall_s', TIME_HEADROOM)]:
+        points = [(o['input_bytes'], o[key]) for o in observations if o[key] is not None]
+        if points:
+            model[metric] = fit_metric(points, headroom)
+
+    threads = [o['threads'] for o in observations if o['threads']]
+    if threads:
+        model['threads'] = max(threads)
+        loads = [o['load'] / 100.0 for o in observations if o['load'] is not None]
+        if loads:
+            model['threads_used'] = round(statistics.median(loads), 1)
+            model['threads'] = min(max(threads), max(1, int(math.ceil(percentile(sorted(loads), 90)))))
+    return model
+
+
+def fit_models(obs):
+    """Fit models for all rules in obs (dict of rule to list of
+    observations)
+    """
+    return dict((rule, fit_rule(rule_obs)) for rule, rule_obs in sorted(obs.items()))
+
+
+def predict(metric_model, input_bytes=None):
+    """Predict value of metric model for input size (in bytes). Uses
+    intercept only if size is unknown
+
+    >>> predict({'intercept': 100.0, 'slope_per_gb': 10.0}, 2 * 1024**3)
+    120.0
+    """
+    value = metric_model['intercept']
+    if input_bytes:
+        value += metric_model['slope_per_gb'] * input_bytes / 1024**3
+    return value
+
+
+def format_mem(mem_mb):
+    """Format memory in MB as cluster config value in full GB (rounded up)
+
+    >>> format_mem(1025)
+    '2G'
+    """
+    return "{:d}G".format(int(math.ceil(max(mem_mb, MIN_MEM_MB) / 1024.0)))
+
+
+def format_time(time_s):
+    """Format wall time in seconds as cluster config value in full
+    hours (rounded up)
+
+    >>> format_time(7300)
+    '03:00:00'
+    """
+    return "{:02d}:00:00".format(int(math.ceil(max(time_s, MIN_TIME_S) / 3600.0)))
+
+
+def recommend_cluster_cfg(models, cluster_cfg=None, input_bytes=None):
+    """Return copy of cluster config (dict of rule to resources) with
+    mem and time of all modelled rules set to predictions for
+    input_bytes. Other rules and keys are kept
+    """
+    cfg = dict((k, dict(v)) for k, v in (cluster_cfg or dict()).items())
+    for rule, model in models.items():
+        entry = cfg.setdefault(rule, dict())
+        if 'mem_mb' in model:
+            entry['mem'] = format_mem(predict(model['mem_mb'], input_bytes))
+        if 'time_s' in model:
+            entry['time'] = format_time(predict(model['time_s'], input_bytes))
+    return cfg
@@ -0,0 +1,195 @@
+"""Client for the ELM/datahub REST services listed in rest.yaml
+
+Uses one pooled session with keep-alive, bounded retries and timeouts
+and caches JSON responses (in memory and on disk) for a short time,
+since a single cron cycle tends to ask for the same run several times.
+Cached data is returned as copy, so callers may modify it.
+"""
+
+#--- standard library imports
+#
+import copy
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+#--- third-party imports
+#
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#--- project specific imports
+#
+from config import rest_services
+from utils import read_cache
+from utils import write_cache
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 3
+# responses are cached for this long. ELM data may change, so keep it short
+DEFAULT_CACHE_TTL_SEC = 10 * 60
+DEFAULT_MAX_WORKERS = 8
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+class RestClient(object):
+    """Pooled, retrying and caching client for JSON REST services. Safe
+    to use from several threads
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 cache_ttl_sec=DEFAULT_CACHE_TTL_SEC, disk_cache=True,
+                 pool_size=DEFAULT_MAX_WORKERS):
+        """cache_ttl_sec=0 disables caching
+        """
+        self.timeout = timeout
+        self.cache_ttl_sec = cache_ttl_sec
+        self.disk_cache = disk_cache
+        self._cache = dict()# url -> (time, data)
+        self._lock = threading.Lock()
+
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']))
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def _cached(self, url):
+        """return copy of cached data for url or None"""
+        if not self.cache_ttl_sec:
+            return None
+        with self._lock:
+            entry = self._cache.get(url)
+        if entry and time.time() - entry[0] < self.cache_ttl_sec:
+            return copy.deepcopy(entry[1])
+        if self.disk_cache:
+            data = read_cache("rest:" + url, url, max_age_sec=self.cache_ttl_sec)
+            if data is not None:
+                with self._lock:
+                    self._cache[url] = (time.time(), data)
+                return copy.deepcopy(data)
+        return None
+
+
+    def get_json(self, url, use_cache=True):
+        """Return decoded JSON response for url. Raises
+        requests.HTTPError for non-ok status codes and
+        requests.RequestException if retries were exhausted
+        """
+
+        if use_cache:
+            data = self._cached(url)
+            if data is not None:
+                logger.debug("Using cached response for %s", url)
+                return data
+
+        logger.debug("Requesting %s", url)
+        response = self.session.get(url, timeout=self.timeout)
+        if response.status_code != requests.codes.ok:
+            response.raise_for_status()
+        data = response.json()
+
+        if self.cache_ttl_sec:
+            with self._lock:
+                self._cache[url] = (time.time(), data)
+            if self.disk_cache:
+                write_cache("rest:" + url, url, data)
+            data = copy.deepcopy(data)
+        return data
+
+
+    def get_json_many(self, urls, max_workers=DEFAULT_MAX_WORKERS, use_cache=True,
+                      raise_errors=True):
+        """Fetch JSON for all urls concurrently. Returns dict of url to
+        data. Errors are raised as in get_json(), unless raise_errors
+        is False, in which case they are logged and failed urls are
+        left out (e.g. for best-effort prefetching)
+        """
+
+        def fetch(url):
+            """returns (success, data)"""
+            try:
+                return True, self.get_json(url, use_cache=use_cache)
+            except (requests.RequestException, ValueError) as e:
+                if raise_errors:
+                    raise
+                logger.warning("Fetching %s failed: %s", url, e)
+                return False, None
+
+        urls = list(set(urls))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(fetch, urls)
+            return dict((url, data) for url, (success, data) in zip(urls, results)
+                        if success)
+
+
+# default client, created on first use
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client():
+    """Return process-wide default RestClient
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = RestClient()
+    return _CLIENT
+
+
+def service_url(service, testing=False, **placeholders):
+    """Return URL for service as defined in rest.yaml, with placeholders
+    (e.g. run_num, lib_id) replaced
+    """
+    url = rest_services[service]['testing' if testing else 'production']
+    for k, v in placeholders.items():
+        url = url.replace(k, v)
+    return url
+
+
+def run_details(run_num, testing=False):
+    """ELM run details for run number (without flowcell id)
+    """
+    return get_client().get_json(service_url('run_details', testing, run_num=run_num))
+
+
+def lib_details(lib_id, testing=False):
+    """ELM library details (e.g. component libraries for a MUX)
+    """
+    return get_client().get_json(service_url('lib_details', testing, lib_id=lib_id))
+
+
+def run_details_many(run_nums, testing=False, max_workers=DEFAULT_MAX_WORKERS,
+                     raise_errors=True):
+    """ELM run details for many run numbers fetched concurrently.
+    Returns dict of run number to details. If raise_errors is False,
+    runs that failed are logged and left out (see
+    RestClient.get_json_many())
+    """
+    urls = dict((run_num, service_url('run_details', testing, run_num=run_num))
+                for run_num in set(run_nums))
+    data = get_client().get_json_many(urls.values(), max_workers=max_workers,
+                                      raise_errors=raise_errors)
+    return dict((run_num, data[url]) for run_num, url in urls.items() if url in data)
@@ -0,0 +1,155 @@
+"""Batched cluster scheduler (SGE/UGE and PBS Pro) job state queries
+
+Instead of running qstat once per job, the state of all jobs of a user
+is fetched with a single qstat call (XML output for SGE, JSON for PBS
+Pro), parsed once and kept for the lifetime of the process (see
+get_snapshot()). The qstat command can be replaced, e.g. by a fake for
+testing.
+"""
+
+#--- standard library imports
+#
+import getpass
+import json
+import logging
+import subprocess
+import xml.etree.ElementTree as ET
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# states of finished jobs (PBS Pro with history). everything else
+# listed by qstat counts as active
+FINISHED_STATES = ['F', 'X']
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def detect_scheduler(qstat="qstat"):
+    """Return 'pbspro' or 'sge' depending on qstat --version"""
+    try:
+        res = subprocess.check_output([qstat, '--version'], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        # SGE's qstat doesn't know --version
+        return 'sge'
+    if 'PBSPro' in res.decode():
+        return 'pbspro'
+    raise ValueError(res.decode())
+
+
+def normalize_jid(jid):
+    """Strip server name (PBS Pro) or task id (SGE array jobs) from job id
+
+    >>> normalize_jid('1234.wlm01')
+    '1234'
+    >>> normalize_jid(5678)
+    '5678'
+    """
+    return str(jid).strip().split('.')[0]
+
+
+def parse_sge_xml(xml_str):
+    """Parse output of SGE's qstat -xml and return dict of job id to
+    state
+    """
+    states = dict()
+    root = ET.fromstring(xml_str)
+    for job in root.iter('job_list'):
+        jid = job.findtext('JB_job_number')
+        if jid:
+            states[normalize_jid(jid)] = job.findtext('state') or job.get('state')
+    return states
+
+
+def parse_pbspro_json(json_str, user=None):
+    """Parse output of PBS Pro's qstat -f -F json and return dict of job
+    id to state. Only jobs owned by user are returned, if given
+    """
+    states = dict()
+    data = json.loads(json_str)
+    for jid, info in data.get('Jobs', dict()).items():
+        if user and info.get('Job_Owner', '').split('@')[0] != user:
+            continue
+        states[normalize_jid(jid)] = info.get('job_state')
+    return states
+
+
+class JobSnapshot(object):
+    """States of all jobs of a user, fetched with one qstat call on
+    first use
+    """
+
+    def __init__(self, scheduler=None, user=None, qstat="qstat"):
+        self.qstat = qstat
+        self.scheduler = scheduler if scheduler else detect_scheduler(qstat)
+        assert self.scheduler in ['sge', 'pbspro']
+        self.user = user if user else getpass.getuser()
+        self._states = None
+
+
+    def _fetch(self):
+        """Run qstat and parse its output"""
+        if self.scheduler == 'pbspro':
+            # PBS Pro doesn't combine -f and -u
+            cmd = [self.qstat, '-f', '-F', 'json']
+        else:
+            cmd = [self.qstat, '-xml', '-u', self.user]
+        logger.debug("Running %s", ' '.join(cmd))
+        out = subprocess.check_output(cmd).decode()
+        if self.scheduler == 'pbspro':
+            user = self.user if self.user != '*' else None
+            return parse_pbspro_json(out, user) if out.strip() else dict()
+        else:
+            return parse_sge_xml(out)
+
+
+    @property
+    def states(self):
+        """dict of (normalized) job id to state"""
+        if self._states is None:
+            self._states = self._fetch()
+            logger.info("Got state of %d jobs from %s", len(self._states), self.qstat)
+        return self._states
+
+
+    def state(self, jid):
+        """Return state of jid or None if it's not known to the scheduler
+        (anymore)
+        """
+        return self.states.get(normalize_jid(jid))
+
+
+    def is_running(self, jid):
+        """Whether jid is still queued or running"""
+        state = self.state(jid)
+        return state is not None and state not in FINISHED_STATES
+
+
+_snapshots = dict()
+
+def get_snapshot(scheduler=None, user=None, qstat="qstat"):
+    """Return cached JobSnapshot for given arguments, so that all checks
+    within one command use the same qstat call
+    """
+    key = (scheduler, user, qstat)
+    if key not in _snapshots:
+        _snapshots[key] = JobSnapshot(scheduler, user, qstat)
+    return _snapshots[key]
@@ -4,6 +4,10 @@
 #--- standard library imports
 #
 import os
+import pickle
+import hashlib
+import tempfile
+import time
 from datetime import datetime
 
 #--- third-party imports
@@ -21,6 +25,12 @@ __copyright__ = "2016 Genome Institute of Singapore"
 __license__ = "The MIT License (MIT)"
 
 
+# per user cache for derived data (parsed configs etc.). can be
+# overwritten via environment. cache files are pickles, so the directory
+# is created private (0700) and files not owned by the current user are
+# never loaded (see read_cache())
+CACHE_DIR = os.getenv('RPD_CACHE_DIR', os.path.join(
+    os.path.expanduser("~"), ".cache", "rpd-pipelines"))
 
 def generate_timestamp():
     """generate ISO8601 timestamp incl microsends, but with colons
@@ -76,3 +86,55 @@ def bed_and_fa_are_compat(bed, fasta):
 
     return all([s in fa_sqs for s in bed_sqs])
 
+
+
+def _cache_file(name):
+    """return path of cache file for given (arbitrary) name
+    """
+    return os.path.join(CACHE_DIR, hashlib.md5(name.encode()).hexdigest() + ".pickle")
+
+
+def read_cache(name, key, max_age_sec=None):
+    """return value cached under name if it was stored with the same key
+    (and is not older than max_age_sec). returns None otherwise. A
+    cache is a convenience only, so all errors are treated as misses.
+    Files not owned by the current user are ignored, since unpickling
+    them could run arbitrary code
+    """
+    cache_file = _cache_file(name)
+    try:
+        with open(cache_file, 'rb') as fh:
+            stat = os.fstat(fh.fileno())
+            if stat.st_uid != os.getuid():
+                return None
+            if max_age_sec is not None and time.time() - stat.st_mtime > max_age_sec:
+                return None
+            cached_key, value = pickle.load(fh)
+    except Exception:# pylint: disable=broad-except
+        return None
+    if cached_key != key:
+        return None
+    return value
+
+
+def write_cache(name, key, value):
+    """store value under name together with key, which needs to match
+    on reading. written atomically, so that concurrent cron jobs never
+    see partial files. errors are silently ignored
+    """
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump((key, value), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, _cache_file(name))
+    except Exception:# pylint: disable=broad-except
+        pass
+
+
+def file_cache_key(path):
+    """return key identifying the current state of a file, i.e. one
+    that changes if the file is modified
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
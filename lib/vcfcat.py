@@ -0,0 +1,659 @@
+"""Ordered concatenation of BGZF compressed VCF files with tabix indexing
+
+Compressed BGZF blocks are copied as they are. Only the block in
+which the header of a file ends is recompressed, since its header part
+has to be dropped (the header is only kept for the first file that has
+one). The tabix index of the output is built on the fly from the
+written blocks, i.e. no extra pass over the output is needed.
+
+Input that is plain gzip (e.g. empty placeholders created with
+gzip) or not compressed at all is recompressed instead.
+"""
+
+#--- standard library imports
+#
+import gzip
+import logging
+import os
+import struct
+import zlib
+
+#--- third-party imports
+#
+#/ by design
+
+#--- project specific imports
+#
+#/ by design
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# see SAM specification (section 4.1) for BGZF
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_LEN = 18
+# maximum uncompressed size of data in one block (as used by htslib)
+BGZF_BLOCK_DATA_MAX = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# tabix index constants (see tabix specification)
+TBI_MAGIC = b'TBI\x01'
+TBI_FORMAT_VCF = 2
+TBI_MIN_SHIFT = 14
+TBI_PSEUDO_BIN = 37450
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def is_bgzf(path):
+    """Check whether file starts with a BGZF block header"""
+    with open(path, 'rb') as fh:
+        header = fh.read(BGZF_HEADER_LEN)
+    return len(header) == BGZF_HEADER_LEN and header[:4] == BGZF_MAGIC \
+        and header[10:16] == b'\x06\x00BC\x02\x00'
+
+
+def bgzf_compress_block(data):
+    """Return BGZF block for data, which must not be larger than
+    BGZF_BLOCK_DATA_MAX
+    """
+    assert len(data) <= BGZF_BLOCK_DATA_MAX
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = BGZF_HEADER_LEN + len(cdata) + 8 - 1
+    return b''.join([
+        BGZF_MAGIC, b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00',
+        struct.pack('<H', bsize), cdata,
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))])
+
+
+def bgzf_read_blocks(fh):
+    """Yield raw (still compressed) blocks of BGZF file handle fh.
+    Raises ValueError for malformed blocks
+    """
+    while True:
+        header = fh.read(BGZF_HEADER_LEN)
+        if not header:
+            return
+        if len(header) != BGZF_HEADER_LEN or header[:4] != BGZF_MAGIC \
+           or header[10:16] != b'\x06\x00BC\x02\x00':
+            raise ValueError("Invalid BGZF block header in {}".format(fh.name))
+        bsize = struct.unpack('<H', header[16:18])[0]
+        rest = fh.read(bsize + 1 - BGZF_HEADER_LEN)
+        if len(rest) != bsize + 1 - BGZF_HEADER_LEN:
+            raise ValueError("Truncated BGZF block in {}".format(fh.name))
+        yield header + rest
+
+
+def bgzf_block_size(raw):
+    """Uncompressed size of raw BGZF block"""
+    return struct.unpack('<I', raw[-4:])[0]
+
+
+def bgzf_block_data(raw):
+    """Return uncompressed data of raw BGZF block. Raises ValueError
+    if block is corrupt
+    """
+    data = zlib.decompress(raw[BGZF_HEADER_LEN:-8], -15)
+    crc, isize = struct.unpack('<II', raw[-8:])
+    if isize != len(data) or crc != zlib.crc32(data) & 0xffffffff:
+        raise ValueError("Corrupt BGZF block")
+    return data
+
+
+def read_chunks(path):
+    """Yield uncompressed data for non-BGZF input, which could be gzip
+    or uncompressed. Data is split to fit into BGZF blocks
+    """
+    with open(path, 'rb') as fh:
+        is_gzip = fh.read(2) == b'\x1f\x8b'
+    opener = gzip.open if is_gzip else open
+    with opener(path, 'rb') as fh:
+        while True:
+            data = fh.read(BGZF_BLOCK_DATA_MAX)
+            if not data:
+                return
+            yield data
+
+
+class BgzfWriter(object):
+    """Writes BGZF blocks and keeps track of the compressed offset"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.offset = 0
+
+
+    def write_block(self, raw):
+        """Write raw (compressed) block and return its offset"""
+        offset = self.offset
+        self.fh.write(raw)
+        self.offset += len(raw)
+        return offset
+
+
+    def write_data(self, data):
+        """Compress data into blocks. Returns list of (offset, data) for
+        the written blocks
+        """
+        blocks = []
+        for i in range(0, len(data), BGZF_BLOCK_DATA_MAX):
+            chunk = data[i:i+BGZF_BLOCK_DATA_MAX]
+            blocks.append((self.write_block(bgzf_compress_block(chunk)), chunk))
+        return blocks
+
+
+    def close(self):
+        """Write EOF marker block. Doesn't close fh"""
+        self.write_block(BGZF_EOF)
+
+
+def reg2bin(beg, end):
+    """UCSC/tabix bin for 0-based, half-open interval"""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+
+
+class _RefIndex(object):
+    """Index data for one sequence"""
+
+    def __init__(self):
+        self.bins = dict()# bin -> list of [beg, end] virtual offsets
+        self.linear = []# 16kb window -> smallest virtual offset
+        self.last_bin = None
+        self.chunk = None
+        self.off_beg = None
+        self.off_end = None
+        self.num_records = 0
+
+
+    def add(self, beg, end, vbeg, vend):
+        """Add record with 0-based half-open coordinates and virtual
+        offsets of its start and end. Records have to be added sorted
+        by start
+        """
+        if self.off_beg is None:
+            self.off_beg = vbeg
+        self.off_end = vend
+        self.num_records += 1
+
+        binnum = reg2bin(beg, end)
+        if binnum == self.last_bin:
+            self.chunk[1] = vend
+        else:
+            self.chunk = [vbeg, vend]
+            self.bins.setdefault(binnum, []).append(self.chunk)
+            self.last_bin = binnum
+
+        # since records are sorted, windows before the end of the
+        # linear index are either set already or can't be reached
+        linear = self.linear
+        wend = (end - 1) >> TBI_MIN_SHIFT
+        if wend >= len(linear):
+            wbeg = beg >> TBI_MIN_SHIFT
+            if wbeg > len(linear):
+                linear.extend([None] * (wbeg - len(linear)))
+            linear.extend([vbeg] * (wend + 1 - len(linear)))
+
+
+    def merge(self, bins, linear, meta):
+        """Merge index data of records following the ones indexed
+        already (see read_tabix_index())
+        """
+        for binnum, chunks in bins.items():
+            self.bins.setdefault(binnum, []).extend(chunks)
+        for w, offset in enumerate(linear):
+            if w >= len(self.linear):
+                self.linear.append(offset)
+            elif self.linear[w] is None:
+                self.linear[w] = offset
+        off_beg, off_end, num_records = meta
+        if self.off_beg is None:
+            self.off_beg = off_beg
+        self.off_end = off_end
+        self.num_records += num_records
+        self.last_bin = self.chunk = None
+
+
+    def serialize(self):
+        """Return binary representation as used in tabix indices"""
+        parts = []
+        bins = sorted(self.bins.items())
+        parts.append(struct.pack('<i', len(bins) + 1))
+        for binnum, chunks in bins:
+            # merge chunks that are adjacent or share a block
+            chunks = sorted(chunks)
+            merged = [list(chunks[0])]
+            for beg, end in chunks[1:]:
+                if beg >> 16 <= merged[-1][1] >> 16:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([beg, end])
+            parts.append(struct.pack('<Ii', binnum, len(merged)))
+            parts.extend(struct.pack('<QQ', beg, end) for beg, end in merged)
+        # pseudo-bin with meta data as written by htslib
+        parts.append(struct.pack('<IiQQQQ', TBI_PSEUDO_BIN, 2,
+                                 self.off_beg, self.off_end, self.num_records, 0))
+
+        # fill empty windows as htslib does: leading ones with the
+        # first offset of this sequence, others with the previous one
+        linear = list(self.linear)
+        fill = self.off_beg
+        for w, offset in enumerate(linear):
+            if offset is None:
+                linear[w] = fill
+            else:
+                fill = offset
+        parts.append(struct.pack('<i', len(linear)))
+        parts.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+        return b''.join(parts)
+
+
+def read_tabix_index(path):
+    """Parse tabix index of a VCF. Returns list of (name, bins, linear,
+    meta) per sequence, where bins maps bin number to list of [beg, end]
+    virtual offsets, linear is the linear index and meta is (first
+    offset, last offset, number of records). Raises ValueError if path
+    is not a tabix index for VCF
+    """
+    with gzip.open(path, 'rb') as fh:
+        buf = fh.read()
+    if buf[:4] != TBI_MAGIC:
+        raise ValueError("Not a tabix index: {}".format(path))
+    n_ref, fmt, col_seq, col_beg, col_end, meta_char, skip, l_nm = \
+        struct.unpack_from('<8i', buf, 4)
+    if (fmt, col_seq, col_beg, col_end, meta_char, skip) != \
+       (TBI_FORMAT_VCF, 1, 2, 0, ord('#'), 0):
+        raise ValueError("Not a VCF tabix index: {}".format(path))
+    pos = 36
+    names = buf[pos:pos+l_nm].split(b'\0')[:n_ref]
+    pos += l_nm
+
+    refs = []
+    for name in names:
+        n_bin = struct.unpack_from('<i', buf, pos)[0]
+        pos += 4
+        bins = dict()
+        meta = None
+        for _ in range(n_bin):
+            binnum, n_chunk = struct.unpack_from('<Ii', buf, pos)
+            pos += 8
+            offsets = struct.unpack_from('<{}Q'.format(2*n_chunk), buf, pos)
+            pos += 16 * n_chunk
+            if binnum == TBI_PSEUDO_BIN:
+                meta = (offsets[0], offsets[1], offsets[2])
+            else:
+                bins[binnum] = [[offsets[i], offsets[i+1]]
+                                for i in range(0, len(offsets), 2)]
+        n_intv = struct.unpack_from('<i', buf, pos)[0]
+        pos += 4
+        linear = list(struct.unpack_from('<{}Q'.format(n_intv), buf, pos))
+        pos += 8 * n_intv
+        if meta is None:
+            chunks = [c for cs in bins.values() for c in cs]
+            meta = (min(c[0] for c in chunks), max(c[1] for c in chunks), 0)
+        refs.append((name.decode(), bins, linear, meta))
+    return refs
+
+
+class VcfTabixIndexer(object):
+    """Builds a tabix index for a BGZF compressed VCF, either from
+    blocks, which have to be fed in order with their compressed offset,
+    or by merging existing indices
+    """
+
+    def __init__(self):
+        self.refs = []# sequence names in order of appearance
+        self.ref_index = dict()
+        self.cur_ref = None
+        self.cur_ref_b = None
+        self.last_beg = -1
+        self.carry = b''
+        self.carry_voffset = None
+
+
+    def feed(self, offset, data, next_offset):
+        """Index records in uncompressed block data, which was written
+        at compressed offset. next_offset is the offset of the next block
+        """
+        if not data:
+            return
+        if self.carry:
+            carry_len = len(self.carry)
+            data = self.carry + data
+        else:
+            carry_len = 0
+            self.carry_voffset = offset << 16
+        lines = data.split(b'\n')
+        self.carry = lines.pop()
+
+        base = offset << 16
+        block_len = len(data) - carry_len
+        pos = -carry_len
+        vbeg = self.carry_voffset
+        add_record = self._add_record
+        for line in lines:
+            pos += len(line) + 1
+            # end offset of a line ending a block is the next block
+            vend = base | pos if pos < block_len else next_offset << 16
+            if line and line[0] != 35:# '#'
+                add_record(line, vbeg, vend)
+            vbeg = vend
+        self.carry_voffset = vbeg
+
+
+    def _add_record(self, line, vbeg, vend):
+        """Add VCF record line"""
+        fields = line.split(b'\t', 8)
+        if len(fields) < 8:
+            raise ValueError("Invalid VCF line: {}".format(line[:100]))
+        beg = int(fields[1]) - 1
+        end = beg + len(fields[3])
+        # END in INFO overrides end (as in htslib)
+        info = fields[7]
+        i = info.find(b'END=')
+        if i != -1:
+            if i == 0 or info[i-1] == 59:# ';'
+                j = info.find(b';', i)
+                end = int(info[i+4:j] if j != -1 else info[i+4:])
+            else:
+                for kv in info.split(b';'):
+                    if kv.startswith(b'END='):
+                        end = int(kv[4:])
+                        break
+        if end <= beg:
+            end = beg + 1
+
+        if fields[0] != self.cur_ref_b:
+            self._set_ref(fields[0].decode())
+            self.cur_ref_b = fields[0]
+        if beg < self.last_beg:
+            raise ValueError("Positions not sorted on {} at {}".format(
+                self.cur_ref, beg + 1))
+        self.last_beg = beg
+        self.ref_index[self.cur_ref].add(beg, end, vbeg, vend)
+
+
+    def _set_ref(self, name):
+        """Switch to sequence name, which must not have been seen before
+        unless it's the current one
+        """
+        if name == self.cur_ref:
+            return
+        if name in self.ref_index:
+            raise ValueError("Sequence {} is not contiguous. Input not sorted?".format(name))
+        self.refs.append(name)
+        self.ref_index[name] = _RefIndex()
+        self.cur_ref = name
+        self.last_beg = -1
+
+
+    def merge(self, refs):
+        """Merge index of records following the ones indexed already, as
+        returned by read_tabix_index() (with virtual offsets translated
+        to the output)
+        """
+        names = [ref[0] for ref in refs]
+        for i, name in enumerate(names):
+            if name in self.ref_index and (i > 0 or name != self.cur_ref) \
+               or name in names[:i]:
+                raise ValueError("Sequence {} is not contiguous. Input not sorted?".format(name))
+        for name, bins, linear, meta in refs:
+            self._set_ref(name)
+            self.ref_index[name].merge(bins, linear, meta)
+        # positions of the merged records are unknown
+        self.cur_ref_b = None
+        self.last_beg = -1
+
+
+    def serialize(self):
+        """Return uncompressed tabix index"""
+        if self.carry.strip():
+            raise ValueError("Last line not newline terminated")
+        names = b''.join(r.encode() + b'\0' for r in self.refs)
+        parts = [TBI_MAGIC,
+                 struct.pack('<iiiiiii', len(self.refs), TBI_FORMAT_VCF,
+                             1, 2, 0, ord('#'), 0),
+                 struct.pack('<i', len(names)), names]
+        parts.extend(self.ref_index[r].serialize() for r in self.refs)
+        # number of unplaced records
+        parts.append(struct.pack('<Q', 0))
+        return b''.join(parts)
+
+
+    def write(self, path):
+        """Write BGZF compressed index to path"""
+        with open(path, 'wb') as fh:
+            writer = BgzfWriter(fh)
+            writer.write_data(self.serialize())
+            writer.close()
+
+
+def _header_end(data, in_header):
+    """Return offset of first non-header line in data or None if data
+    contains only header. in_header tells whether data starts at a line
+    start within the header (otherwise it continues a header line)
+    """
+    pos = 0
+    if not in_header:
+        nl = data.find(b'\n')
+        if nl == -1:
+            return None
+        pos = nl + 1
+    while pos < len(data):
+        if data[pos] != 35:# '#'
+            return pos
+        nl = data.find(b'\n', pos)
+        if nl == -1:
+            return None
+        pos = nl + 1
+    return None
+
+
+def _input_blocks(vcf):
+    """Yield (offset, raw block, data) for vcf. For BGZF input data is
+    None (decompress on demand), otherwise raw block is None
+    """
+    if is_bgzf(vcf):
+        offset = 0
+        with open(vcf, 'rb') as fh:
+            for raw in bgzf_read_blocks(fh):
+                yield offset, raw, None
+                offset += len(raw)
+    else:
+        logger.info("%s is not BGZF compressed. Will recompress", vcf)
+        for data in read_chunks(vcf):
+            yield None, None, data
+
+
+def _existing_index(vcf):
+    """Return parsed tabix index of vcf if it exists and is up to date,
+    otherwise None
+    """
+    tbi = vcf + ".tbi"
+    try:
+        if os.path.getmtime(tbi) < os.path.getmtime(vcf) or not is_bgzf(vcf):
+            return None
+        return read_tabix_index(tbi)
+    except (OSError, ValueError, struct.error) as e:
+        logger.info("Can't use index %s: %s", tbi, e)
+        return None
+
+
+def _translate_index(refs, offset_map):
+    """Translate virtual offsets in index refs (see read_tabix_index())
+    using offset_map, which maps input block offsets to output offset
+    or list of (output offset, start in input block data). Raises
+    KeyError for offsets of unknown blocks
+    """
+    def translate(voffset):
+        pieces = offset_map[voffset >> 16]
+        if isinstance(pieces, int):
+            return pieces << 16
+        uoffset = voffset & 0xffff
+        for offset, start in reversed(pieces):
+            if uoffset >= start:
+                return (offset << 16) | (uoffset - start)
+        return pieces[0][0] << 16
+
+    translated = []
+    for name, bins, linear, meta in refs:
+        bins = dict((binnum, [[translate(beg), translate(end)] for beg, end in chunks])
+                    for binnum, chunks in bins.items())
+        linear = [translate(offset) for offset in linear]
+        meta = (translate(meta[0]), translate(meta[1]), meta[2])
+        translated.append((name, bins, linear, meta))
+    return translated
+
+
+def _rescan_blocks(path, start, end):
+    """Yield (offset, data) for blocks in BGZF file path between
+    compressed offsets start and end
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        offset = start
+        for raw in bgzf_read_blocks(fh):
+            if offset >= end:
+                break
+            yield offset, bgzf_block_data(raw)
+            offset += len(raw)
+
+
+def concat_vcfs(vcfs, out_vcf, index=True):
+    """Concatenate vcfs (usually BGZF compressed) in given order into
+    BGZF compressed out_vcf, keeping only the header of the first file
+    that has one. The tabix index is written to out_vcf + '.tbi' if
+    index is True. Existing, up to date input indices are merged,
+    otherwise records are indexed while copying. Returns number of
+    copied (i.e. not recompressed) blocks. Raises ValueError if vcfs is
+    empty, since a valid output needs at least one header
+
+    >>> concat_vcfs([], os.devnull)
+    Traceback (most recent call last):
+    ...
+    ValueError: No VCFs to concatenate
+    """
+
+    if not vcfs:
+        raise ValueError("No VCFs to concatenate")
+    indexer = VcfTabixIndexer() if index else None
+    header_written = False
+    num_copied = 0
+
+    # keep one block in pending, so that the indexer knows the offset of
+    # the next block
+    pending = []
+    def emit(offset, data):
+        if indexer and pending:
+            indexer.feed(pending[0][0], pending[0][1], offset)
+        pending[:] = [(offset, data)]
+
+    with open(out_vcf, 'wb') as fhout:
+        writer = BgzfWriter(fhout)
+        for vcf in vcfs:
+            logger.debug("Concatenating %s", vcf)
+            tbi = _existing_index(vcf) if indexer else None
+            scan = indexer is not None and tbi is None
+            out_start = writer.offset
+            # input block offset to output offset(s), see _translate_index()
+            offset_map = dict()
+            # skipped input blocks, which map to the next written one
+            unresolved = []
+
+            # header continues until a line doesn't start with '#'. it's
+            # skipped if written already
+            in_header = True
+            at_line_start = True
+            had_header = None
+            # input virtual offset of first record
+            first_record = None
+            for in_offset, raw, data in _input_blocks(vcf):
+                if raw is not None:
+                    if not bgzf_block_size(raw):
+                        unresolved.append(in_offset)
+                        continue
+                    if in_header or scan:
+                        data = bgzf_block_data(raw)
+                elif not data:
+                    continue
+                if had_header is None:
+                    had_header = data[0] == 35# '#'
+
+                start = 0
+                if in_header:
+                    record_start = _header_end(data, at_line_start)
+                    if record_start is None:
+                        at_line_start = data.endswith(b'\n')
+                    else:
+                        in_header = False
+                        first_record = ((in_offset or 0) << 16) | record_start
+                    if header_written:
+                        if record_start is None:
+                            unresolved.append(in_offset)
+                            continue
+                        start = record_start
+
+                if raw is not None and start == 0:
+                    offset = writer.write_block(raw)
+                    pieces = [(offset, 0)]
+                    num_copied += 1
+                    emit(offset, data if scan else None)
+                else:
+                    pieces = []
+                    for offset, chunk in writer.write_data(data[start:]):
+                        pieces.append((offset, start))
+                        start += len(chunk)
+                        emit(offset, chunk if scan else None)
+                for o in unresolved:
+                    offset_map[o] = pieces[0][0]
+                unresolved = []
+                offset_map[in_offset] = pieces
+            for o in unresolved:
+                offset_map[o] = writer.offset
+            if had_header:
+                header_written = True
+
+            if tbi is not None:
+                try:
+                    # cheap check whether index belongs to this file
+                    if (tbi[0][3][0] if tbi else None) != first_record:
+                        raise ValueError("offset of first record differs")
+                    indexer.merge(_translate_index(tbi, offset_map))
+                except (KeyError, ValueError) as e:
+                    logger.warning("Index of %s doesn't match its content (%s)."
+                                   " Indexing records instead", vcf, e)
+                    fhout.flush()
+                    if writer.offset > out_start:
+                        # pending is the last block of this file
+                        pending[:] = []
+                    for offset, data in _rescan_blocks(out_vcf, out_start, writer.offset):
+                        emit(offset, data)
+        writer.close()
+        if pending and indexer:
+            indexer.feed(pending[0][0], pending[0][1], writer.offset - len(BGZF_EOF))
+
+    if indexer:
+        indexer.write(out_vcf + ".tbi")
+    return num_copied
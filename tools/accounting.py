@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 """
 collection: gisds.accountinglogs
+
+Prints jobs matching owner(s) and/or jobNo(s) or summaries per owner or
+pipeline. Filtering and aggregation happen in the database, so only
+matching jobs or summaries are transferred
 """
 
 #--- standard library imports
@@ -30,6 +34,82 @@ __copyright__ = "2016 Genome Institute of Singapore"
 __license__ = "The MIT License (MIT)"
 
 
+# used for grouping by pipeline in summaries: first dot-separated part
+# of the job name, e.g. <pipeline>.slave.<rule>.<n>.sh for snakemake jobs
+JOBNAME_FIELD = "jobName"
+
+
+def job_match(owners=None, job_nos=None, since=None, until=None):
+    """
+    Returns query matching jobs (prefixed with jobs.) by owner, jobNo and submission time window (epoch seconds)
+    """
+    query = {}
+    if owners:
+        query["jobs.owner"] = {"$in": owners}
+    if job_nos:
+        query["jobs.jobNo"] = {"$in": job_nos}
+    if since or until:
+        query["jobs.submissionTime"] = {}
+        if since:
+            query["jobs.submissionTime"]["$gte"] = since
+        if until:
+            query["jobs.submissionTime"]["$lt"] = until
+    return query
+
+
+def jobs_pipeline(match):
+    """
+    Aggregation pipeline returning only matching jobs: documents are
+    first selected using the index, then unwound and filtered again
+    """
+    return [{"$match": match},
+            {"$unwind": "$jobs"},
+            {"$match": match},
+            {"$project": {"_id": 0, "jobs": 1}}]
+
+
+def summary_pipeline(match, group_by):
+    """
+    Aggregation pipeline computing CPU hours, peak vmem (GB) and wallclock hours per owner or pipeline
+    """
+    if group_by == "owner":
+        key = "$jobs.owner"
+    else:
+        key = {"$arrayElemAt": [{"$split": [{"$ifNull": ["$jobs." + JOBNAME_FIELD, ""]}, "."]}, 0]}
+    return jobs_pipeline(match)[:-1] + [
+        {"$group": {"_id": key,
+                    "jobs": {"$sum": 1},
+                    "cpu": {"$sum": "$jobs.cpu"},
+                    "maxvmem": {"$max": "$jobs.maxvmem"},
+                    "ruWallClock": {"$sum": "$jobs.ruWallClock"}}},
+        {"$project": {"_id": 0,
+                      group_by: "$_id",
+                      "jobs": 1,
+                      "cpuHours": {"$divide": ["$cpu", 3600]},
+                      "peakVmemGB": {"$divide": ["$maxvmem", pow(2, 30)]},
+                      "wallClockHours": {"$divide": ["$ruWallClock", 3600]}}},
+        {"$sort": {group_by: 1}}]
+
+
+def format_job(job):
+    """
+    Converts job fields for printing
+    """
+    job["cpu"] = strftime("%Hh%Mm%Ss", gmtime(job["cpu"]))
+    job["maxvmem"] = str(job["maxvmem"] / pow(2, 30)) + " GB"
+    job["ruWallClock"] = strftime("%Hh%Mm%Ss", gmtime(job["ruWallClock"]))
+    job["submissionTime"] = str(datetime.fromtimestamp(
+        job["submissionTime"]).isoformat()).replace(":", "-")
+    return job
+
+
+def date_to_epoch(date):
+    """
+    Converts YYYY-MM-DD to epoch seconds (local time)
+    """
+    return int(datetime.strptime(date, "%Y-%m-%d").timestamp())
+
+
 def main():
     """
     Main function
@@ -37,40 +117,26 @@ def main():
     instance = ArgumentParser(description=__doc__)
     instance.add_argument("-j", "--jobNo", nargs="*", help="filter records by jobNo of jobs")
     instance.add_argument("-o", "--owner", nargs="*", help="filter records by owner of jobs")
+    instance.add_argument("-s", "--since", help="only jobs submitted on or after this date (YYYY-MM-DD)")
+    instance.add_argument("-u", "--until", help="only jobs submitted before this date (YYYY-MM-DD)")
+    instance.add_argument("-S", "--summary", choices=["owner", "pipeline"],
+                          help="print CPU hours, peak vmem and wallclock hours per owner or pipeline instead of jobs")
     args = instance.parse_args()
 
-    if (not args.jobNo) and (args.owner):
-        for document in mongodb_conn(False).gisds.accountinglogs.find({"jobs.owner": {"$in": args.owner}}):
-            for job in document["jobs"]:
-                if job["owner"] in args.owner:
-                    job["cpu"] = strftime("%Hh%Mm%Ss", gmtime(job["cpu"]))
-                    job["maxvmem"] = str(job["maxvmem"] / pow(2, 30)) + " GB"
-                    job["ruWallClock"] = strftime("%Hh%Mm%Ss", gmtime(job["ruWallClock"]))
-                    job["submissionTime"] = str(datetime.fromtimestamp(
-                        job["submissionTime"]).isoformat()).replace(":", "-")
-                    PrettyPrinter(indent=2).pprint(job)
-
-    if (args.jobNo) and (not args.owner):
-        for document in mongodb_conn(False).gisds.accountinglogs.find({"jobs.jobNo": {"$in": args.jobNo}}):
-            for job in document["jobs"]:
-                if job["jobNo"] in args.jobNo:
-                    job["cpu"] = strftime("%Hh%Mm%Ss", gmtime(job["cpu"]))
-                    job["maxvmem"] = str(job["maxvmem"] / pow(2, 30)) + " GB"
-                    job["ruWallClock"] = strftime("%Hh%Mm%Ss", gmtime(job["ruWallClock"]))
-                    job["submissionTime"] = str(datetime.fromtimestamp(
-                        job["submissionTime"]).isoformat()).replace(":", "-")
-                    PrettyPrinter(indent=2).pprint(job)
-
-    if args.jobNo and args.owner:
-        for document in mongodb_conn(False).gisds.accountinglogs.find({"jobs.jobNo": {"$in": args.jobNo}, "jobs.owner": {"$in": args.owner}}):
-            for job in document["jobs"]:
-                if (job["jobNo"] in args.jobNo) and (job["owner"] in args.owner):
-                    job["cpu"] = strftime("%Hh%Mm%Ss", gmtime(job["cpu"]))
-                    job["maxvmem"] = str(job["maxvmem"] / pow(2, 30)) + " GB"
-                    job["ruWallClock"] = strftime("%Hh%Mm%Ss", gmtime(job["ruWallClock"]))
-                    job["submissionTime"] = str(datetime.fromtimestamp(
-                        job["submissionTime"]).isoformat()).replace(":", "-")
-                    PrettyPrinter(indent=2).pprint(job)
+    since = date_to_epoch(args.since) if args.since else None
+    until = date_to_epoch(args.until) if args.until else None
+    match = job_match(args.owner, args.jobNo, since, until)
+    accountinglogs = mongodb_conn(False).gisds.accountinglogs
+
+    if args.summary:
+        print("\t".join([args.summary, "jobs", "cpuHours", "peakVmemGB", "wallClockHours"]))
+        for row in accountinglogs.aggregate(summary_pipeline(match, args.summary), allowDiskUse=True):
+            print("\t".join([str(row[args.summary]), str(row["jobs"]), "{0:.2f}".format(row["cpuHours"]),
+                             "{0:.3f}".format(row["peakVmemGB"] or 0), "{0:.2f}".format(row["wallClockHours"])]))
+
+    elif args.jobNo or args.owner:
+        for document in accountinglogs.aggregate(jobs_pipeline(match), allowDiskUse=True):
+            PrettyPrinter(indent=2).pprint(format_job(document["jobs"]))
 
 
 if __name__ == "__main__":
@@ -12,13 +12,18 @@ import os
 import argparse
 import logging
 import glob
-import subprocess
 
 #--- third-party imports
 #/
 
 #--- project specific imports
-#/
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from scheduler import get_snapshot
 
 # master log relative to outdir
 MASTERLOG = "snakemake.log"
@@ -32,28 +37,6 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
-def jid_is_running(jid, is_pbspro):
-    """run qstat to find out whether jid is still running
-    """
-    if is_pbspro:
-        cmd = ['qstat', jid]
-    else:
-        cmd = ['qstat', '-j', jid]
-    try:
-        _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        return True
-    except subprocess.CalledProcessError as e:
-        if is_pbspro:
-            # Unknown Job Id happens on log rotation.
-            # NOTE (possible workaround): accouting info actually part of OU
-            if not any(['Unknown Job Id' in x for x in [e.output.decode(), e.output.decode()]]):
-                assert any(['has finished' in x for x in [e.output.decode(), e.output.decode()]])
-        else:
-            assert any(["Following jobs do not exist" in x for x in [e.output.decode(), e.output.decode()]])
-            # otherwise communication error?
-            return False
-
-
 def jid_from_cluster_logfile(logfile):
     """extract jid from cluster log file"""
     jid = ""
@@ -76,50 +59,17 @@ def jid_from_cluster_logfile(logfile):
     return jid
 
 
-def main():
-    """main function
+def print_analysis_status(analysis_dir, snapshot):
+    """Print status of master and slave jobs of analysis_dir, using
+    scheduler.JobSnapshot snapshot for job states
     """
-
-    # should atually check first if we run qstat at all
-    try:
-        res = subprocess.check_output(['qstat', '--version'], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        is_pbspro = False
-    else:
-        if 'PBSPro' in res.decode():
-            is_pbspro = True
-        else:
-            raise ValueError(res.decode())
-
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('dir', nargs=1,
-                        help="Analysis directory (output dir of pipeline wrapper)")
-    parser.add_argument('-v', '--verbose', action='count', default=0,
-                            help="Increase verbosity")
-    parser.add_argument('-q', '--quiet', action='count', default=0,
-                            help="Decrease verbosity")
-    args = parser.parse_args()
-
-    # Repeateable -v and -q for setting logging level.
-    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
-    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
-    # script -vv -> DEBUG
-    # script -v -> INFO
-    # script -> WARNING
-    # script -q -> ERROR
-    # script -qq -> CRITICAL
-    # script -qqq -> no logging at all
-    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
-
-
-    if not os.path.exists(args.dir[0]):
-        logger.fatal("Log directory {} doesn't exist".format(args.dir[0]))
-        sys.exit(1)
-    logdir = os.path.join(args.dir[0], 'logs')
+    if not os.path.exists(analysis_dir):
+        logger.error("Log directory {} doesn't exist".format(analysis_dir))
+        return
+    logdir = os.path.join(analysis_dir, 'logs')
     if not os.path.exists(logdir):
-        logger.fatal("Couldn't find expected log directory in {}".format(args.dir[0]))
-        sys.exit(1)
-
+        logger.error("Couldn't find expected log directory in {}".format(analysis_dir))
+        return
 
     cluster_logfiles = []
     # LFS
@@ -129,7 +79,7 @@ def main():
     print("Found {} slaves (cluster log files)".format(len(cluster_logfiles)))
     slave_jids = [jid_from_cluster_logfile(f) for f in cluster_logfiles]
     for jid in slave_jids:
-        if jid_is_running(jid, is_pbspro):
+        if snapshot.is_running(jid):
             print("Slave jid {} still running".format(jid))
         else:
             print("Slave jid {} not running (anymore).".format(jid))
@@ -142,16 +92,16 @@ def main():
         with open(submissionlog) as fh:
             for line in fh:
                 line = line.rstrip()
-                if is_pbspro:
+                if snapshot.scheduler == 'pbspro':
                     jid = line.strip()
-                    if jid_is_running(jid, is_pbspro):
+                    if snapshot.is_running(jid):
                         print("Master jid {} still running".format(jid))
                     else:
                         print("Master jid {} not running (anymore).".format(jid))
 
                 elif line.startswith("Your job") and line.endswith("has been submitted"):
                     jid = line.split()[2]
-                    if jid_is_running(jid, is_pbspro):
+                    if snapshot.is_running(jid):
                         print("Master jid {} still running".format(jid))
                     else:
                         print("Master jid {} not running (anymore).".format(jid))
@@ -175,5 +125,42 @@ def main():
             print("Workflow not complete")
 
 
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dir', nargs='+',
+                        help="Analysis directory (output dir of pipeline wrapper)."
+                        " Several can be given, sharing one scheduler query")
+    parser.add_argument('-u', '--user',
+                        help="Owner of jobs (default: current user; '*' for all)")
+    parser.add_argument('--qstat', default="qstat",
+                        help="qstat command to use (default: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                            help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                            help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    # one qstat call for all analyses, issued on first job lookup
+    snapshot = get_snapshot(user=args.user, qstat=args.qstat)
+    for analysis_dir in args.dir:
+        if len(args.dir) > 1:
+            print("# {}".format(analysis_dir))
+        print_analysis_status(analysis_dir, snapshot)
+
+
 if __name__ == "__main__":
     main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-[1]	To create a new database, please specify one or more input accounting filename(s) with -a, one output database filename with -b, and optionally -r to replace (default: append) the output database. 
+[1]	To create a new database, please specify one or more input accounting filename(s) with -a, one output database filename with -b, job owner(s) with -o, and optionally -r to replace (default: append) the output database. Appending only ingests records added since the last run.
 [2]	To display a database view, please specify one database filename with -b, one database view with -v, and one or more column widths with -w. 
 [3]	To display cluster limits, please specify one database filename with -b, one or more completed run directories with -c, and one or more column widths with -w. 
 """
@@ -13,8 +13,9 @@ from collections import OrderedDict
 import gzip
 from math import pow
 from os import listdir, path, remove
-from re import findall, sub
-from sqlite3 import connect, OperationalError
+from os import stat as stat_file
+from re import compile
+from sqlite3 import connect
 from sys import argv
 from time import gmtime, strftime
 
@@ -29,48 +30,113 @@ FIELDS = ['qname', 'hostname', 'owner', 'jobname', 'jobnumber', 'qsub_time', 'st
 		  'failed', 'exit_status', 'ru_wallclock', 'maxvmem', 'h_rt', 'h_vmem', 'mem_free', 'slots']
 
 
-def parse_list(l, args, FIELDS):
+RE_H_RT = compile(r"h_rt=(\d+)")
+RE_H_VMEM = compile(r"h_vmem=(\d+)")
+RE_MEM_FREE = compile(r"mem_free=(\d+)")
+RE_OPENMP = compile(r"OpenMP\s(\d+)")
+
+INSERT_SQL = "INSERT OR IGNORE INTO accounting (" + ", ".join(FIELDS) + ") VALUES (" + ", ".join(["?"] * len(FIELDS)) + ");"
+
+# rows per executemany and transaction
+BATCH_SIZE = 100000
+
+
+def parse_list(l, owners):
+	"""
+	Returns tuple of values for FIELDS for split accounting line l or None for comments and jobs of other owners
+	"""
 	if l[0].startswith("#"):
-		return ""
-
-	owner_count = 0
-	if args.owner:
-		for owner in args.owner:
-			if l[3] == owner:
-				owner_count += 1
-	if owner_count == 0:
-		return ""
-
-	a = ""
-	for f in FIELDS:
-		a = (a + ", '" + f + "'")
-
-	b = ""
-	for j in [l[0], l[1], l[3], l[4], l[5], l[8], l[9], l[10], l[11], l[12], l[13], l[42]]:
-		b = (b + ", '" + j + "'")
-
-	c = ""
-	if len(findall("h_rt=\d+", l[39])) > 0:
-		c = (c + ", '" + findall("h_rt=\d+", l[39])[0][5:] + "'")
-	else:
-		c = (c + ", ''")
+		return None
+	if l[3] not in owners:
+		return None
 
-	if len(findall("h_vmem=\d+", l[39])) > 0:
-		c = (c + ", '" + findall("h_vmem=\d+", l[39])[0][7:] + "'")
-	else:
-		c = (c + ", ''")
+	values = [l[0], l[1], l[3], l[4], l[5], l[8], l[9], l[10], l[11], l[12], l[13], l[42]]
+	for regex in [RE_H_RT, RE_H_VMEM, RE_MEM_FREE, RE_OPENMP]:
+		m = regex.search(l[39])
+		values.append(m.group(1) if m else "")
+	return tuple(values)
 
-	if len(findall("mem_free=\d+", l[39])) > 0:
-		c = (c + ", '" + findall("mem_free=\d+", l[39])[0][9:] + "'")
-	else:
-		c = (c + ", ''")
 
-	if len(findall("OpenMP\s\d+", l[39])) > 0:
-		c = (c + ", '" + findall("OpenMP\s\d+", l[39])[0].split(" ")[1] + "'")
-	else:
-		c = (c + ", ''")
+def create_offset_table(db):
+	"""
+	Creates table for remembering ingested part of accounting files unless existing
+	"""
+	db.execute("CREATE TABLE IF NOT EXISTS ingested_files (path TEXT PRIMARY KEY, inode INTEGER NOT NULL, size INTEGER NOT NULL, offset INTEGER NOT NULL, owners TEXT NOT NULL, complete INTEGER NOT NULL);")
+	db.commit()
 
-	return "INSERT OR IGNORE INTO accounting (" + a[2:] + ") VALUES (" + b[2:] + c + ");"
+
+def create_indexes(db):
+	"""
+	Creates indexes unless existing. Done after ingest, since building them once is faster than maintaining them while inserting into a new database
+	"""
+	for column in ["owner", "jobname", "end_time"]:
+		db.execute("CREATE INDEX IF NOT EXISTS accounting_" + column + " ON accounting (" + column + ");")
+	db.commit()
+
+
+def ingest_accounting(db, acct, owners, show_exceptions=False, batch_size=BATCH_SIZE):
+	"""
+	Streams plain or gzipped accounting file into database using batched inserts, one transaction per batch
+	Remembers byte offset (of uncompressed data) after last complete line, so reruns only ingest appended or, after an interruption, remaining records
+	A completely ingested file with unchanged size is skipped. Of a gzipped file the known part is decompressed but not parsed again
+	Files are read from the start if replaced (inode changed), truncated or if owners differ from the last run
+	Returns number of lines read and number of records inserted
+	"""
+	stat = stat_file(acct)
+	owners_str = ",".join(sorted(owners))
+	row = db.execute("SELECT inode, size, offset, owners, complete FROM ingested_files WHERE path = ?;", (path.abspath(acct),)).fetchone()
+	offset = 0
+	if row and row[0] == stat.st_ino and row[1] <= stat.st_size and row[3] == owners_str:
+		# size is the size at the start of the last run, so only skip if that run read to the end of the file
+		if row[4] and row[1] == stat.st_size:
+			return 0, 0
+		offset = row[2]
+
+	num_lines = 0
+	num_inserted = 0
+	batch = []
+
+	def flush(offset, complete=False):
+		"""
+		Inserts batch and stores offset in one transaction. complete marks the end of the file as reached
+		"""
+		nonlocal num_inserted
+		with db:
+			cursor = db.executemany(INSERT_SQL, batch)
+			num_inserted += cursor.rowcount
+			db.execute("INSERT OR REPLACE INTO ingested_files (path, inode, size, offset, owners, complete) VALUES (?, ?, ?, ?, ?, ?);", (path.abspath(acct), stat.st_ino, stat.st_size, offset, owners_str, int(complete)))
+		del batch[:]
+
+	if acct[-3:] == ".gz":
+		fh = gzip.open(acct)
+	else:
+		fh = open(acct, "rb")
+	with fh:
+		fh.seek(offset)
+		for line in fh:
+			if not line.endswith(b"\n"):
+				# incomplete last line (still being written): picked up in next run
+				break
+			offset += len(line)
+			num_lines += 1
+			try:
+				values = parse_list(line.decode().rstrip().split(":"), owners)
+			except UnicodeDecodeError as ude:
+				if show_exceptions:
+					print ("UnicodeDecodeError: {0}".format(ude))
+					print (line)
+				continue
+			except IndexError as ie:
+				if show_exceptions:
+					print ("IndexError: {0}".format(ie))
+					print (line)
+				continue
+			if values:
+				batch.append(values)
+				if len(batch) >= batch_size:
+					flush(offset)
+	flush(offset, complete=True)
+	return num_lines, num_inserted
 
 
 def main():
@@ -132,50 +198,22 @@ def main():
 			PRIMARY KEY (jobnumber, qsub_time, start_time, end_time));''')
 			db.close()
 
+		if not args.owner:
+			print ("NO JOB OWNER(S) GIVEN WITH -o:\tNOTHING TO INGEST")
+		owners = set(args.owner or [])
+
+		db = connect(args.database)
+		db.execute("PRAGMA journal_mode = WAL;")
+		db.execute("PRAGMA synchronous = NORMAL;")
+		create_offset_table(db)
 		acct_count = 0
 		for acct in args.accounting:
 			acct_count += 1
 			print ("ACCOUNTING FILE (" + str(acct_count) + "/" + str(len(args.accounting)) + "):\t" + acct)
-
-			db = connect(args.database)
-			if acct[-3:] == ".gz":
-				with gzip.open(acct) as fh:
-					for line in fh:
-						try:
-							l = line.decode().rstrip().split(":")
-#							db = connect(args.database)
-							db.execute(parse_list(l, args, FIELDS))
-#							db.commit()
-#							db.close()
-						except UnicodeDecodeError as ude:
-							if args.exception:
-								print ("UnicodeDecodeError: {0}".format(ude))
-								print (line)
-						except OperationalError as oe:
-							if args.exception:
-								print ("OperationalError: {0}".format(oe))
-								print (line)
-					fh.close()
-			else:
-				with open(acct) as fh:
-					for line in fh:
-						try:
-							l = line.split(":")
-#							db = connect(args.database)
-							db.execute(parse_list(l, args, FIELDS))
-#							db.commit()
-#							db.close()
-						except UnicodeDecodeError as ude:
-							if args.exception:
-								print ("UnicodeDecodeError: {0}".format(ude))
-								print (line)
-						except OperationalError as oe:
-							if args.exception:
-								print ("OperationalError: {0}".format(oe))
-								print (line)
-					fh.close()
-			db.commit()
-			db.close()
+			num_lines, num_inserted = ingest_accounting(db, acct, owners, args.exception)
+			print ("NEW LINES / RECORDS:\t" + str(num_lines) + " / " + str(num_inserted))
+		create_indexes(db)
+		db.close()
 
 		db = connect(args.database)
 		if len([str(i[0]) for i in db.execute("SELECT name FROM sqlite_master WHERE type = 'view' AND name = 'duplicate_jobs';")]) == 0:
@@ -142,11 +142,13 @@ def form_post():
 
 
 @app.route('/')
-def form_none(mongo_results=instantiate_mongo(False).find({"": ""}), nav_caption=""):
+def form_none(mongo_results=None, nav_caption=""):
 	"""
 	Flask callback function for all requests
 	path_to_url: /mnt/projects/userrig/solexa/.. -> rpd/userrig/runs/solexaProjects/..
 	"""
+	if mongo_results is None:
+		mongo_results = instantiate_mongo(False).find({"": ""})
 	result = ""
 	result += ("<script>$(function(){$('.nav_caption').replaceWith('" \
 		+ '<span class="nav_caption">' + nav_caption + "</span>" + "');});</script>")
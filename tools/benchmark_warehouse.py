@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Collect Snakemake benchmark logs of analyses into an SQLite database
+and report per rule runtime distributions, regressions between
+pipeline versions and the most expensive rules
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from benchmarklogs import BenchmarkStore
+from benchmarklogs import format_table
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def fmt(value, spec="{:.1f}"):
+    """format number or return NA for None"""
+    return "NA" if value is None else spec.format(value)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--db', required=True,
+                        help="SQLite database file (created if needed)")
+    parser.add_argument('-p', '--pipeline',
+                        help="Restrict reports to this pipeline")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    subparsers = parser.add_subparsers(dest='command')
+    parser_collect = subparsers.add_parser('collect', help="Collect analyses")
+    parser_collect.add_argument('outdirs', nargs='+',
+                                help="Analysis output directories")
+    subparsers.add_parser('rules', help="Per rule runtime and memory distribution")
+    parser_regr = subparsers.add_parser('regressions', help="Runtime regressions between versions")
+    parser_regr.add_argument('--min-ratio', type=float, default=1.2,
+                             help="Minimum ratio of median runtimes (default: %(default)s)")
+    parser_regr.add_argument('--min-jobs', type=int, default=3,
+                             help="Minimum number of jobs per version (default: %(default)s)")
+    parser_top = subparsers.add_parser('top', help="Most expensive rules by core time")
+    parser_top.add_argument('-n', type=int, default=10,
+                            help="Number of rules to list (default: %(default)s)")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+
+    store = BenchmarkStore(args.db)
+    if args.command == 'collect':
+        for outdir in args.outdirs:
+            if not os.path.isdir(outdir):
+                logger.warning("Skipping non-existing directory %s", outdir)
+                continue
+            num = store.add_analysis(outdir)
+            logger.info("Collected %d benchmark records from %s", num, outdir)
+
+    elif args.command == 'rules':
+        rows = [[s['rule'], s['jobs'], fmt(s['s_median']), fmt(s['s_p90']), fmt(s['s_max']),
+                 fmt(s['rss_median'], "{:.0f}"), fmt(s['rss_max'], "{:.0f}")]
+                for s in store.rule_stats(args.pipeline)]
+        print(format_table(["Rule", "Jobs", "Median (s)", "P90 (s)", "Max (s)",
+                            "Median RSS (MB)", "Max RSS (MB)"], rows))
+
+    elif args.command == 'regressions':
+        rows = [[r['pipeline'], r['rule'], r['old_version'], r['new_version'],
+                 fmt(r['old_median_s']), fmt(r['new_median_s']), fmt(r['ratio'], "{:.2f}")]
+                for r in store.version_regressions(args.pipeline, args.min_ratio, args.min_jobs)]
+        print(format_table(["Pipeline", "Rule", "Old version", "New version",
+                            "Old median (s)", "New median (s)", "Ratio"], rows))
+
+    elif args.command == 'top':
+        rows = [[t['rule'], t['jobs'], fmt(t['wall_h'], "{:.2f}"), fmt(t['core_h'], "{:.2f}"),
+                 fmt(t['rss_max'], "{:.0f}")]
+                for t in store.top_rules(args.n, args.pipeline)]
+        print(format_table(["Rule", "Jobs", "Wall (h)", "Core (h)", "Max RSS (MB)"], rows))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
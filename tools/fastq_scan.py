@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Scan FastQ files in a single pass each: verify gzip integrity,
+compute MD5, count reads and bases and collect read length and quality
+histograms. Results are written to JSON sidecars (<fastq>.scan.json),
+which are reused for unchanged files. Exits non-zero if any file is
+corrupt.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import json
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from fastqscan import scan_fastqs
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('fastqs', nargs='+',
+                        help="FastQ files (gzipped or not)")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="Number of files to scan in parallel (default: %(default)s)")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Rescan even if up to date sidecar exists")
+    parser.add_argument('--no-sidecar', action='store_true',
+                        help="Don't write sidecars")
+    parser.add_argument('-j', '--json', action='store_true',
+                        help="Print full results as JSON (default: tab separated summary)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    results, errors = scan_fastqs(args.fastqs, processes=args.processes,
+                                  use_sidecar=not args.force, write=not args.no_sidecar)
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        print("\t".join(["#fastq", "reads", "bases", "md5"]))
+        for fastq in args.fastqs:
+            if fastq in results:
+                r = results[fastq]
+                print("\t".join([fastq, str(r['reads']), str(r['bases']), r['md5']]))
+    if errors:
+        logger.fatal("%d of %d files failed", len(errors), len(args.fastqs))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
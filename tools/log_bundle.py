@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""List or print logs in a log bundle (logs/logs.tar.gz) of a pipeline
+run. Uses the bundle's index if present, so that printing a single log
+doesn't require decompressing the whole bundle
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import fnmatch
+import logging
+import argparse
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from logbundle import list_members
+from logbundle import read_member
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('bundle',
+                        help="Log bundle")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    subparsers = parser.add_subparsers(dest='command')
+    subparser = subparsers.add_parser('ls', help="List logs")
+    subparser.add_argument('pattern', nargs='?', default="*",
+                           help="Only list logs matching this glob pattern")
+    subparser = subparsers.add_parser('cat', help="Print logs")
+    subparser.add_argument('names', nargs='+',
+                           help="Name of log(s) in bundle")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not os.path.exists(args.bundle):
+        logger.fatal("Non-existing file %s", args.bundle)
+        sys.exit(1)
+
+    if args.command == 'ls':
+        for name in list_members(args.bundle):
+            if fnmatch.fnmatch(name, args.pattern):
+                print(name)
+    elif args.command == 'cat':
+        for name in args.names:
+            try:
+                data = read_member(args.bundle, name)
+            except KeyError:
+                logger.fatal("No log named %s in %s", name, args.bundle)
+                sys.exit(1)
+            sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
-"""FIXME
+"""Write accounting info in qacct -j format next to each cluster log
+(<log>.acct) of one or more analyses.
+
+All job ids are resolved in one go: either in a single pass over the
+(plain or gzipped) accounting file or with indexed lookups in a
+database created by aws.py. qacct is only run (once per job) if neither
+is available.
 """
 
 #--- standard library imports
@@ -8,8 +14,13 @@ import os
 import sys
 import glob
 import re
+import gzip
 import shlex
+import sqlite3
+import logging
+import argparse
 import subprocess
+from datetime import datetime
 
 #--- third-party imports
 #
@@ -33,37 +44,256 @@ __license__ = "The MIT License (MIT)"
 
 
 #JOB_LOG_RE = '(?P<pipeline>[A-Za-z0-9-]+)\.(?P<jobtype>[A-Za-z0-9-]+)\.(?P<rule>[A-Za-z0-9-]+)\.(?P<smjobid>[0-9]+)\.sh\.o(?P<clusterjobid>[0-9]+)'
-JOB_LOG_RE = '.*\.sh\.o([0-9]+)$'
+JOB_LOG_RE = r'.*\.sh\.o([0-9]+)$'
 ACCT_CMD = 'qacct -j {}'
 
+# field names of (U/S)GE accounting file in order
+ACCT_FIELDS = ['qname', 'hostname', 'group', 'owner', 'jobname', 'jobnumber',
+               'account', 'priority', 'qsub_time', 'start_time', 'end_time',
+               'failed', 'exit_status', 'ru_wallclock', 'ru_utime', 'ru_stime',
+               'ru_maxrss', 'ru_ixrss', 'ru_ismrss', 'ru_idrss', 'ru_isrss',
+               'ru_minflt', 'ru_majflt', 'ru_nswap', 'ru_inblock', 'ru_oublock',
+               'ru_msgsnd', 'ru_msgrcv', 'ru_nsignals', 'ru_nvcsw', 'ru_nivcsw',
+               'project', 'department', 'granted_pe', 'slots', 'taskid', 'cpu',
+               'mem', 'io', 'category', 'iow', 'pe_taskid', 'maxvmem', 'arid',
+               'ar_sub_time']
+# fields printed by qacct -j (in that order)
+QACCT_FIELDS = ['qname', 'hostname', 'group', 'owner', 'project', 'department',
+                'jobname', 'jobnumber', 'taskid', 'account', 'priority',
+                'qsub_time', 'start_time', 'end_time', 'granted_pe', 'slots',
+                'failed', 'exit_status', 'ru_wallclock', 'ru_utime', 'ru_stime',
+                'ru_maxrss', 'ru_ixrss', 'ru_ismrss', 'ru_idrss', 'ru_isrss',
+                'ru_minflt', 'ru_majflt', 'ru_nswap', 'ru_inblock', 'ru_oublock',
+                'ru_msgsnd', 'ru_msgrcv', 'ru_nsignals', 'ru_nvcsw', 'ru_nivcsw',
+                'cpu', 'mem', 'io', 'iow', 'maxvmem', 'arid']
+TIME_FIELDS = ['qsub_time', 'start_time', 'end_time']
+# columns of accounting table in aws.py database
+DB_FIELDS = ['qname', 'hostname', 'owner', 'jobname', 'jobnumber', 'qsub_time',
+             'start_time', 'end_time', 'failed', 'exit_status', 'ru_wallclock',
+             'maxvmem', 'slots']
+# max number of host parameters in one sqlite query
+DB_CHUNK_SIZE = 500
 
-def produce_acct_logs(cluster_log_dir, overwrite=False):
-    """bundle log files in pipeline_outdir+result_outdir and"""
 
-    for logf in glob.glob(os.path.join(cluster_log_dir, "*")):
-        #print("Checking {}".format(logf))
-        pattern = re.compile(JOB_LOG_RE)
-        match = pattern.search(os.path.basename(logf))
-        if not match:
-            #print("Not a match {}".format(logf))
-            continue
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def default_accounting_file():
+    """Return accounting file of SGE installation or None if not found"""
+    sge_root = os.environ.get('SGE_ROOT')
+    if not sge_root:
+        return None
+    acct_file = os.path.join(sge_root, os.environ.get('SGE_CELL', 'default'),
+                             'common', 'accounting')
+    return acct_file if os.path.exists(acct_file) else None
+
+
+def format_time(value):
+    """Format accounting timestamp (seconds or, as in newer UGE
+    versions, milliseconds since epoch) in local time as qacct does
+    """
+    epoch = float(value)
+    if epoch > 1e11:
+        epoch /= 1000.0
+    if epoch <= 0:
+        return "-/-"
+    return datetime.fromtimestamp(epoch).strftime("%a %b %d %H:%M:%S %Y")
+
 
-        acct_out = logf + ".acct"
-        if os.path.exists(acct_out) and not overwrite:
+def format_size(value):
+    """Format size in bytes as qacct does
+
+    >>> format_size('4666009041')
+    '4.346G'
+    >>> format_size('0')
+    '0.000B'
+    """
+    size = float(value)
+    for unit, factor in [('G', 1024**3), ('M', 1024**2), ('K', 1024)]:
+        if size >= factor:
+            return "{:.3f}{}".format(size / factor, unit)
+    return "{:.3f}B".format(size)
+
+
+def format_qacct(record):
+    """Format record (dict of accounting field names to raw values) as
+    qacct -j output. Only fields present in record are printed
+    """
+    lines = ["=" * 62]
+    for field in QACCT_FIELDS:
+        value = record.get(field)
+        if value is None or value == "":
             continue
-        assert len(match.groups()) == 1
-        jobid = match.groups()[0]
-        cmd = shlex.split(ACCT_CMD.format(jobid))
-        try:
-            res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            sys.stderr.write("Couldn't execute {}. Got {}. Skipping\n".format(' '.join(cmd), e.output.decode().rstrip()))# FIXME
+        value = str(value)
+        if field in TIME_FIELDS:
+            value = format_time(value)
+        elif field == 'maxvmem':
+            value = format_size(value)
+        elif field == 'ru_wallclock':
+            value = value + "s"
+        lines.append("{:13s}{}".format(field, value))
+    return "\n".join(lines) + "\n"
+
+
+def jobids_from_cluster_logs(cluster_log_dirs, overwrite=False):
+    """Return dict of job id to list of acct files to produce for
+    cluster logs in cluster_log_dirs. Existing acct files are skipped
+    unless overwrite is set
+    """
+    pattern = re.compile(JOB_LOG_RE)
+    jobids = dict()
+    for cluster_log_dir in cluster_log_dirs:
+        for logf in glob.glob(os.path.join(cluster_log_dir, "*")):
+            match = pattern.search(os.path.basename(logf))
+            if not match:
+                continue
+            acct_out = logf + ".acct"
+            if os.path.exists(acct_out) and not overwrite:
+                continue
+            assert len(match.groups()) == 1
+            jobids.setdefault(match.groups()[0], []).append(acct_out)
+    return jobids
+
+
+def records_from_accounting(acct_file, jobids):
+    """Read (plain or gzipped) accounting file once and return dict of
+    job id to list of records (in file order) for given job ids
+    """
+    jobids = set(jobids)
+    records = dict()
+    opener = gzip.open if acct_file.endswith(".gz") else open
+    with opener(acct_file, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b"#"):
+                continue
+            # cheap check before full split
+            parts = line.split(b":", 6)
+            if len(parts) < 7 or parts[5].decode() not in jobids:
+                continue
+            values = line.decode(errors='replace').rstrip("\n").split(":")
+            record = dict(zip(ACCT_FIELDS, values))
+            records.setdefault(record['jobnumber'], []).append(record)
+    return records
+
+
+def records_from_db(dbfile, jobids):
+    """Look up job ids in accounting database created by aws.py (using
+    its jobnumber index) and return dict of job id to list of records
+    """
+    jobids = sorted(jobids, key=int)
+    records = dict()
+    conn = sqlite3.connect(dbfile)
+    try:
+        for i in range(0, len(jobids), DB_CHUNK_SIZE):
+            chunk = [int(j) for j in jobids[i:i + DB_CHUNK_SIZE]]
+            query = "SELECT {} FROM accounting WHERE jobnumber IN ({}) ORDER BY end_time".format(
+                ", ".join(DB_FIELDS), ", ".join(["?"] * len(chunk)))
+            for row in conn.execute(query, chunk):
+                record = dict(zip(DB_FIELDS, row))
+                records.setdefault(str(record['jobnumber']), []).append(record)
+    finally:
+        conn.close()
+    return records
+
+
+def qacct_output(jobid):
+    """Run qacct for jobid and return its output or None on error"""
+    cmd = shlex.split(ACCT_CMD.format(jobid))
+    try:
+        res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        logger.warning("Couldn't execute %s. Got %s. Skipping",
+                       ' '.join(cmd), e.output.decode().rstrip())
+        return None
+    return res.decode()
+
+
+def produce_acct_logs(cluster_log_dirs, overwrite=False, accounting=None, db=None):
+    """Write <log>.acct for all cluster logs in cluster_log_dirs (one or
+    list of directories) using accounting file, aws.py database or, if
+    neither is given, qacct. Returns number of acct files written
+    """
+    if isinstance(cluster_log_dirs, str):
+        cluster_log_dirs = [cluster_log_dirs]
+    jobids = jobids_from_cluster_logs(cluster_log_dirs, overwrite)
+    if not jobids:
+        return 0
+    logger.info("Resolving %d job ids", len(jobids))
+
+    if db:
+        records = records_from_db(db, jobids)
+    elif accounting:
+        records = records_from_accounting(accounting, jobids)
+    else:
+        records = None
+
+    num_written = 0
+    for jobid, acct_outs in sorted(jobids.items()):
+        if records is None:
+            output = qacct_output(jobid)
+        elif jobid in records:
+            output = "".join(format_qacct(r) for r in records[jobid])
+        else:
+            logger.warning("No accounting record found for job %s. Skipping", jobid)
+            output = None
+        if output is None:
             continue
+        for acct_out in acct_outs:
+            with open(acct_out, 'w') as fh:
+                fh.write(output)
+            num_written += 1
+    return num_written
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('cluster_log_dirs', nargs='+',
+                        help="Cluster log directories (e.g. <analysis>/logs)")
+    parser.add_argument('-a', '--accounting',
+                        help="Accounting file (plain or gzipped; default: accounting file of"
+                        " SGE installation if found)")
+    parser.add_argument('-d', '--db',
+                        help="Accounting database created with aws.py (used instead of accounting file)")
+    parser.add_argument('-f', '--overwrite', action='store_true',
+                        help="Overwrite existing acct files")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    for f in [args.accounting, args.db]:
+        if f and not os.path.exists(f):
+            logger.fatal("Non-existing file %s", f)
+            sys.exit(1)
+    accounting = args.accounting
+    if not accounting and not args.db:
+        accounting = default_accounting_file()
+        if not accounting:
+            logger.warning("No accounting file found. Falling back to running qacct per job")
 
-        with open(acct_out, 'w') as fh:
-            for line in res.decode():
-                fh.write(line)
+    num_written = produce_acct_logs(args.cluster_log_dirs, args.overwrite, accounting, args.db)
+    logger.info("Wrote %d acct files", num_written)
 
 
 if __name__ == "__main__":
-    produce_acct_logs(sys.argv[1])
+    main()
@@ -13,7 +13,6 @@ import glob
 #
 import pymongo
 import yaml
-import requests
 
 # project specific imports
 #
@@ -30,7 +29,8 @@ from pipelines import generate_window
 from pipelines import get_machine_run_flowcell_id
 from utils import generate_timestamp
 from config import novogene_conf
-from config import rest_services
+from rest import run_details
+from rest import run_details_many
 from readunits import readunits_for_sampledir
 
 __author__ = "Lavanya Veeravalli"
@@ -65,6 +65,12 @@ def runs_from_db(connection, testing, win=14):
     results = db.find({"run" : {"$regex" : "^NG00"},
                        "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
     logger.info("Found %d runs", results.count())
+    results = list(results)
+    # fetch ELM details of all runs concurrently. cached for
+    # run_details() below. best-effort: errors surface there, per run
+    run_details_many([get_machine_run_flowcell_id(record['run'])[1]
+                      for record in results if record.get('analysis')], testing,
+                     raise_errors=False)
     for record in results:
         run_number = record['run']
         logger.debug("record: %s", record)
@@ -72,14 +78,7 @@ def runs_from_db(connection, testing, win=14):
             continue
         # Check if Novogene run_mode
         _, run_id, _ = get_machine_run_flowcell_id(run_number)
-        if testing:
-            rest_url = rest_services['run_details']['testing'].replace("run_num", run_id)
-        else:
-            rest_url = rest_services['run_details']['production'].replace("run_num", run_id)
-        response = requests.get(rest_url)
-        if response.status_code != requests.codes.ok:
-            response.raise_for_status()
-        rest_data = response.json()
+        rest_data = run_details(run_id, testing)
         sg10k_lib_list = get_sg10_lib_list(rest_data)
         run_records = {}
         for (analysis_count, analysis) in enumerate(record['analysis']):
@@ -312,8 +311,6 @@ def main():
         if args.break_after_first and trigger == 1:
             logger.info("Stopping after first run")
             break
-    # close the connection to MongoDB
-    connection.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Create region clusters of balanced cost for a reference and print
+them as reference config (YAML)
+
+Cost is the number of callable bases (i.e. without gaps and restricted
+to intervals if given) or, if benchmark logs of per cluster jobs (e.g.
+gatk_haplotype_caller) are given, the runtime extrapolated from them.
+Clusters are consecutive stretches of the genome (in fai order) and are
+preferably cut at gaps or sequence ends.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from regionclusters import callable_segments
+from regionclusters import runtime_rates
+from regionclusters import weight_segments
+from regionclusters import balanced_clusters
+from regionclusters import cluster_costs
+from regionclusters import region_strings
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# only dump() and following do not automatically create aliases
+yaml.Dumper.ignore_aliases = lambda *args: True
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def chrom_lens_from_fai(fai):
+    """return list of sequence name and length in fai"""
+    chrom_lens = []
+    with open(fai) as fh:
+        for line in fh:
+            sq, l = line.split()[:2]
+            chrom_lens.append((sq, int(l)))
+    return chrom_lens
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('fai',
+                        help="Reference fasta index")
+    parser.add_argument('-k', '--num-clusters', type=int, required=True,
+                        help="Number of region clusters")
+    parser.add_argument('--gaps',
+                        help="Bed file listing gaps (N regions) to skip")
+    parser.add_argument('--intervals',
+                        help="Bed file listing regions of interest")
+    parser.add_argument('--benchmark-logs', nargs='+',
+                        help="Snakemake benchmark logs of per cluster jobs"
+                        " (balance runtime instead of bases)")
+    parser.add_argument('--benchmark-references',
+                        help="Reference config with region clusters used"
+                        " for the benchmarked runs")
+    parser.add_argument('-r', '--references',
+                        help="Reference config to copy all other values from")
+    parser.add_argument('--snap-tolerance', type=float, default=0.05,
+                        help="Cut at gaps if within this fraction of"
+                        " the cost per cluster (default: %(default)s)")
+    parser.add_argument('-o', '--output',
+                        help="Output file (default: stdout)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if args.num_clusters < 1:
+        logger.fatal("Need at least one cluster")
+        sys.exit(1)
+    if bool(args.benchmark_logs) != bool(args.benchmark_references):
+        logger.fatal("Benchmark logs and the references used for them have to be given together")
+        sys.exit(1)
+    if args.output and os.path.exists(args.output):
+        logger.fatal("Refusing to overwrite existing file %s", args.output)
+        sys.exit(1)
+
+    segments = callable_segments(chrom_lens_from_fai(args.fai), args.gaps, args.intervals)
+    logger.info("%d callable segments with %d bp", len(segments),
+                sum(e - s for _, s, e in segments))
+
+    rates = None
+    if args.benchmark_logs:
+        with open(args.benchmark_references) as fh:
+            bench_refs = yaml.safe_load(fh)
+        rates = runtime_rates(bench_refs['region_clusters'], args.benchmark_logs, segments)
+        if not rates:
+            logger.fatal("No usable benchmark logs")
+            sys.exit(1)
+    weighted = weight_segments(segments, rates)
+
+    clusters = balanced_clusters(weighted, args.num_clusters, args.snap_tolerance)
+    costs = cluster_costs(clusters, weighted)
+    logger.info("Cost per cluster: min %.1f, max %.1f, mean %.1f",
+                min(costs), max(costs), sum(costs)/len(costs))
+
+    if args.references:
+        with open(args.references) as fh:
+            refs = yaml.safe_load(fh)
+    else:
+        refs = dict()
+    refs['region_clusters'] = region_strings(clusters)
+
+    fh = open(args.output, 'w') if args.output else sys.stdout
+    yaml.dump(refs, fh, default_flow_style=None, sort_keys=False)
+    if fh != sys.stdout:
+        fh.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,23 @@
 Keep an eye on production jobs etc and issue warnings if predefined
 thresholds are exceeded
 
+Checks run concurrently, each with its own timeout, so that e.g. a
+hung NFS mount doesn't stall the others
+
 """
 
 # standard library imports
+import argparse
+import asyncio
 import datetime
+import json
+import math
 import os
 #from pprint import PrettyPrinter
-from subprocess import CalledProcessError, check_output, getoutput
+from subprocess import getoutput
 import sys
+import threading
+import time
 
 # third party imports
 # /
@@ -46,25 +55,23 @@ FS_TO_CHECK = ["/mnt/seq", "/mnt/projects/rpd", "/mnt/projects/userrig", "/mnt/s
 MAX_WINDOW = 7
 # max age in days for started runs
 MAX_RUN = 3
+QSTAT_CMD = ["qstat", "-u", "userrig"]
+# per check timeouts in seconds
+TIMEOUT_QSTAT = 60
+TIMEOUT_DF = 30
+TIMEOUT_MONGO = 120
 
 
-def check_qstat():
+def parse_qstat(output):
     """
-    run several checks on qstat
+    run several checks on (SGE) qstat output
     warnings returned as strings/lines
     """
-    qstat_cmd = ["qstat", "-u", "userrig"]
     warnings = ""
-    try:
-        _ = check_output(qstat_cmd)
-    except CalledProcessError:
-        warnings += ("[qstat fail]")
-        return warnings
-
     count_qw = 0
     count_eqw = 0
     count_all = 0
-    for line in check_output(qstat_cmd).splitlines():
+    for line in output.splitlines():
         if str.isdigit(str(line.split()[0], "utf-8")):
             count_all += 1
             status = str(line.split()[4], "utf-8")
@@ -87,26 +94,50 @@ def check_qstat():
     return warnings
 
 
-def check_df(fs_to_check):
+async def check_qstat():
     """
-    check file systems usage
+    run qstat once (killed on timeout) and check its output
     warnings returned as strings/lines
     """
-    warnings = ""
-    for filesys in fs_to_check:
-        result = []
-        for line in check_output(["df", "-h", filesys]).splitlines():
-            result.append(line.split())
-        if int(result[2][3][:-1]) > MAX_DF:
-            warnings += ("[Use% > " + str(MAX_DF) + "%]:\t" + filesys + "\n")
-    return warnings
+    proc = await asyncio.create_subprocess_exec(
+        *QSTAT_CMD, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        output, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    if proc.returncode != 0:
+        return "[qstat fail]"
+    return parse_qstat(output)
 
 
-def check_mongo():
+def fs_usage_percent(filesys):
+    """
+    percent usage of file system as reported by df (rounded up)
     """
-    Instantiates MongoDB database object
-    For Test Server, testing == True
-    For Production Server, testing == False
+    stat = os.statvfs(filesys)
+    used = stat.f_blocks - stat.f_bfree
+    avail = used + stat.f_bavail
+    if avail == 0:
+        return 0
+    return int(math.ceil(100.0 * used / avail))
+
+
+def check_fs(filesys):
+    """
+    check file system usage
+    warnings returned as strings/lines
+    """
+    if fs_usage_percent(filesys) > MAX_DF:
+        return "[Use% > " + str(MAX_DF) + "%]:\t" + filesys + "\n"
+    return ""
+
+
+def check_mongo(max_time_ms=None):
+    """
+    Checks runs started in window of interest with a single query on
+    the (indexed) timestamp, only fetching run and analysis status
+    Uses production server
     """
     warnings = ""
     epoch_present, epoch_window = generate_window(MAX_WINDOW)
@@ -115,32 +146,102 @@ def check_mongo():
 
     query = {}
     query["timestamp"] = {"$gte": epoch_window, "$lte": epoch_started}
-    query["analysis.Status"] = "STARTED"
-    mongo = mongodb_conn(False).gisds.runcomplete.find(query)
-    count_warnings = 0
-    for record in mongo:
-#        PrettyPrinter(indent=2).pprint(record)
-        if record["analysis"][-1]["Status"] != "SUCCESS":
-            warnings += ("[started >= " + str(MAX_RUN) + " days]:\t" + str(record["run"]) + "\n")
-            count_warnings += 1
-    if count_warnings > 0:
-        warnings += ("[started >= " + str(MAX_RUN) + " days]:\t" + str(count_warnings) + "\n\n")
+    query["$or"] = [{"analysis.Status": "STARTED"}, {"analysis": {"$exists": False}}]
+    projection = {"_id": 0, "run": 1, "analysis.Status": 1}
+    cursor = mongodb_conn(False).gisds.runcomplete.find(query, projection)
+    if max_time_ms:
+        cursor = cursor.max_time_ms(max_time_ms)
 
-    query = {}
-    query["timestamp"] = {"$gte": epoch_window, "$lte": epoch_started}
-    query["analysis"] = {"$exists": False}
-    mongo = mongodb_conn(False).gisds.runcomplete.find(query)
-    count_warnings = 0
-    for record in mongo:
-#        PrettyPrinter(indent=2).pprint(record)
-        warnings += ("[no analysis >= " + str(MAX_RUN) + " days]:\t" + str(record["run"]) + "\n")
-        count_warnings += 1
-    if count_warnings > 0:
-        warnings += ("[no analysis >= " + str(MAX_RUN) + " days]:\t" + str(count_warnings) + "\n\n")
+    started_runs = []
+    unanalysed_runs = []
+    for record in cursor:
+        if "analysis" not in record:
+            unanalysed_runs.append(record["run"])
+        elif record["analysis"][-1]["Status"] != "SUCCESS":
+            started_runs.append(record["run"])
+
+    for run in started_runs:
+        warnings += ("[started >= " + str(MAX_RUN) + " days]:\t" + str(run) + "\n")
+    if started_runs:
+        warnings += ("[started >= " + str(MAX_RUN) + " days]:\t" + str(len(started_runs)) + "\n\n")
+    for run in unanalysed_runs:
+        warnings += ("[no analysis >= " + str(MAX_RUN) + " days]:\t" + str(run) + "\n")
+    if unanalysed_runs:
+        warnings += ("[no analysis >= " + str(MAX_RUN) + " days]:\t" + \
+                     str(len(unanalysed_runs)) + "\n\n")
 
     return warnings
 
 
+def run_in_daemon_thread(func, *args):
+    """
+    run blocking func in a daemon thread and return awaitable future
+    a thread stuck e.g. on a hung NFS mount can't be killed, but as
+    daemon it won't keep the process alive after timing out
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def set_result(result, exc):
+        if future.done():
+            # cancelled on timeout
+            return
+        if exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def target():
+        result, exc = None, None
+        try:
+            result = func(*args)
+        except Exception as e:
+            exc = e
+        try:
+            loop.call_soon_threadsafe(set_result, result, exc)
+        except RuntimeError:
+            # loop closed already
+            pass
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+async def timed_check(name, awaitable, timeout):
+    """
+    await check with timeout and return result dict with check name,
+    status (ok, timeout or error), latency in seconds and warnings
+    """
+    start = time.monotonic()
+    try:
+        warnings = await asyncio.wait_for(awaitable, timeout)
+        status = "ok"
+    except asyncio.TimeoutError:
+        status = "timeout"
+        warnings = "[" + name + " timeout > " + str(timeout) + "s]\n"
+    except Exception as e:
+        status = "error"
+        warnings = "[" + name + " fail]:\t" + str(e) + "\n"
+    return {"check": name,
+            "status": status,
+            "latency_s": round(time.monotonic() - start, 3),
+            "warnings": warnings}
+
+
+async def run_checks(fs_to_check):
+    """
+    run all checks concurrently, each with its own timeout
+    returns list of result dicts (see timed_check)
+    """
+    checks = [timed_check("qstat", check_qstat(), TIMEOUT_QSTAT)]
+    for filesys in fs_to_check:
+        checks.append(timed_check("df " + filesys, run_in_daemon_thread(check_fs, filesys),
+                                  TIMEOUT_DF))
+    checks.append(timed_check("mongo", run_in_daemon_thread(check_mongo, TIMEOUT_MONGO * 1000),
+                              TIMEOUT_MONGO))
+    return await asyncio.gather(*checks)
+
+
 def send_email(email, subject, message):
     """
     Send alert email
@@ -152,9 +253,29 @@ def main():
     """
     Main function
     """
-    warnings = check_qstat()
-    warnings += check_df(FS_TO_CHECK)
-    warnings += check_mongo()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--report',
+                        help="Write machine-readable (JSON) report with per check status"
+                        " and latency to this file ('-' for stdout)")
+    args = parser.parse_args()
+
+    # not using asyncio.run(), which needs Python 3.7
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(run_checks(FS_TO_CHECK))
+    finally:
+        loop.close()
+    warnings = "".join(r["warnings"] for r in results)
+    if args.report:
+        report = {"timestamp": datetime.datetime.now().isoformat(),
+                  "checks": results}
+        if args.report == "-":
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.report, 'w') as fh:
+                json.dump(report, fh, indent=2)
     if len(warnings):
         print(warnings)
 #        send_email("rpd@gis.a-star.edu.sg", "[RPD] Production Warnings", warnings)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Recommend per rule cluster resources (memory, walltime, threads)
+from historical runs collected with benchmark_warehouse.py and/or an
+accounting database created with aws.py
+
+Writes a suggested cluster config for a given input size and/or the
+fitted models, which can be applied at submission time with
+--extra-conf resource_model:<models.yaml>
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from benchmarklogs import BenchmarkStore
+from benchmarklogs import format_table
+from resourcefit import observations_from_store
+from resourcefit import observations_from_accounting_db
+from resourcefit import fit_models
+from resourcefit import recommend_cluster_cfg
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# only dump() and following do not automatically create aliases
+yaml.Dumper.ignore_aliases = lambda *args: True
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def main():
+    """main function
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--db',
+                        help="Benchmark database (see benchmark_warehouse.py)")
+    parser.add_argument('-a', '--accounting-db',
+                        help="Accounting database (see aws.py)")
+    parser.add_argument('-p', '--pipeline',
+                        help="Only use analyses of this pipeline (benchmark database only)")
+    parser.add_argument('-c', '--cluster-cfg',
+                        help="Existing cluster config to update and compare against")
+    parser.add_argument('-s', '--input-gb', type=float,
+                        help="Input size (GB, largest sample) for recommendations"
+                        " (default: use size independent part of models only)")
+    parser.add_argument('-o', '--output',
+                        help="Write suggested cluster config to this file")
+    parser.add_argument('-m', '--models',
+                        help="Write fitted models to this file")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not args.db and not args.accounting_db:
+        logger.fatal("Need at least one of benchmark or accounting database")
+        sys.exit(1)
+    for f in [args.output, args.models]:
+        if f and os.path.exists(f):
+            logger.fatal("Refusing to overwrite existing file %s", f)
+            sys.exit(1)
+
+    obs = dict()
+    if args.db:
+        store = BenchmarkStore(args.db)
+        obs = observations_from_store(store, args.pipeline)
+        store.close()
+    if args.accounting_db:
+        obs = observations_from_accounting_db(args.accounting_db, obs)
+    if not obs:
+        logger.fatal("No observations found")
+        sys.exit(1)
+    models = fit_models(obs)
+
+    cluster_cfg = dict()
+    if args.cluster_cfg:
+        with open(args.cluster_cfg) as fh:
+            cluster_cfg = yaml.safe_load(fh)
+    input_bytes = args.input_gb * 1024**3 if args.input_gb else None
+    suggested = recommend_cluster_cfg(models, cluster_cfg, input_bytes)
+
+    rows = []
+    default = cluster_cfg.get('__default__', dict())
+    for rule, model in models.items():
+        current = cluster_cfg.get(rule, default)
+        rows.append([rule, len(obs[rule]),
+                     current.get('mem', "NA"), suggested[rule].get('mem', "NA"),
+                     current.get('time', "NA"), suggested[rule].get('time', "NA"),
+                     model.get('threads_used', "NA"), model.get('threads', "NA"),
+                     "yes" if model.get('mem_mb', {}).get('slope_per_gb') or
+                     model.get('time_s', {}).get('slope_per_gb') else "no"])
+    print(format_table(["Rule", "Jobs", "Mem", "Suggested mem", "Time", "Suggested time",
+                        "Threads used", "Suggested threads", "Size dependent"], rows))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            yaml.dump(suggested, fh, default_flow_style=False)
+    if args.models:
+        with open(args.models, 'w') as fh:
+            yaml.dump(models, fh, default_flow_style=False)
+
+
+if __name__ == "__main__":
+    main()
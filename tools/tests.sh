@@ -0,0 +1,124 @@
+#!/bin/bash
+
+# Tests for tools which can run without cluster and database, e.g.
+# scheduler queries of analysis_status.py against a fake qstat (see
+# tests/fake_qstat)
+
+# http://redsymbol.net/articles/unofficial-bash-strict-mode/
+set -euo pipefail
+
+MYNAME=$(basename $(readlink -f $0))
+MYDIR=$(dirname $(readlink -f $0))
+FAKE_QSTAT=$MYDIR/tests/fake_qstat
+ANALYSIS_STATUS_PY=$MYDIR/analysis_status.py
+
+usage() {
+    echo "$MYNAME: run tool tests"
+    echo " -d: Run dry-run tests (ignored: tests always run)"
+    echo " -r: Run real-run tests (ignored: tests always run)"
+}
+
+# accepted for compatibility with test_all.sh. all tests here are
+# offline and quick, so they are always run
+while getopts "dr" opt; do
+    case $opt in
+        d|r)
+            ;;
+        \?)
+            usage
+            exit 1
+            ;;
+    esac
+done
+
+
+log=$(mktemp)
+COMPLETE_MSG="*** All tests completed ***"
+echo "Starting tests"
+echo "Logging to $log"
+echo "Check log if the following final message is not printed: \"$COMPLETE_MSG\""
+
+testdir=$(mktemp -d)
+trap "rm -rf $testdir" EXIT
+out=$testdir/out.txt
+qstat_log=$testdir/qstat.log
+
+
+# create fake analysis dir: make_analysis <dir> <submission log line>
+# <master log line> <cluster log file>...
+make_analysis() {
+    dir=$1; submission=$2; master=$3
+    shift 3
+    mkdir -p $dir/logs
+    echo "$submission" > $dir/logs/submission.log
+    echo "$master" > $dir/logs/snakemake.log
+    for f in "$@"; do
+        touch $dir/logs/$f
+    done
+}
+
+expect_output() {
+    if ! grep -qxF "$1" $out; then
+        echo "ERROR: expected line \"$1\" missing in output:" | tee -a $log
+        cat $out | tee -a $log
+        exit 1
+    fi
+}
+
+expect_num_qstat_calls() {
+    num=$(grep -cF -- "$1" $qstat_log || true)
+    if [ "$num" -ne "$2" ]; then
+        echo "ERROR: expected $2 qstat call(s) with \"$1\" but got $num" | tee -a $log
+        exit 1
+    fi
+}
+
+
+echo "analysis_status.py: SGE, two analyses" | tee -a $log
+make_analysis $testdir/sge1 'Your job 1000 ("BWA-MEM.master") has been submitted' \
+    "[Thu Jun  1 10:10:00 2017] 3 of 10 steps (30%) done" \
+    BWA-MEM.slave.map_sort.1.sh.o1001 BWA-MEM.slave.unit_merge.2.sh.o1002 BWA-MEM.slave.map_sort.3.sh.o999
+make_analysis $testdir/sge2 'Your job 997 ("BWA-MEM.master") has been submitted' \
+    "[Thu Jun  1 09:10:00 2017] 10 of 10 steps (100%) done" \
+    BWA-MEM.slave.map_sort.1.sh.o998
+rm -f $qstat_log
+FAKE_QSTAT_SCHEDULER=sge FAKE_QSTAT_LOG=$qstat_log \
+    $ANALYSIS_STATUS_PY --qstat $FAKE_QSTAT -u userrig $testdir/sge1 $testdir/sge2 > $out 2>> $log
+expect_output "Slave jid 1001 still running"
+expect_output "Slave jid 1002 still running"
+expect_output "Slave jid 999 not running (anymore)."
+expect_output "Master jid 1000 still running"
+expect_output "Workflow not complete"
+expect_output "Slave jid 998 not running (anymore)."
+expect_output "Master jid 997 not running (anymore)."
+expect_output "Workflow completed: [Thu Jun  1 09:10:00 2017] 10 of 10 steps (100%) done"
+# one query shared by both analyses
+expect_num_qstat_calls "-xml -u userrig" 1
+
+
+echo "analysis_status.py: PBS Pro, jobs of user only" | tee -a $log
+make_analysis $testdir/pbs1 "2000.wlm01" \
+    "[Thu Jun  1 10:10:00 2017] 3 of 10 steps (30%) done" \
+    2001.wlm01.OU 2002.wlm01.OU 2003.wlm01.OU 2004.wlm01.OU
+rm -f $qstat_log
+FAKE_QSTAT_SCHEDULER=pbspro FAKE_QSTAT_LOG=$qstat_log \
+    $ANALYSIS_STATUS_PY --qstat $FAKE_QSTAT -u userrig $testdir/pbs1 > $out 2>> $log
+expect_output "Found 4 slaves (cluster log files)"
+expect_output "Slave jid 2001.wlm01 still running"
+expect_output "Slave jid 2002.wlm01 still running"
+# finished (history)
+expect_output "Slave jid 2003.wlm01 not running (anymore)."
+# job of other user
+expect_output "Slave jid 2004.wlm01 not running (anymore)."
+expect_output "Master jid 2000.wlm01 still running"
+expect_num_qstat_calls "-f -F json" 1
+
+
+echo "analysis_status.py: PBS Pro, jobs of all users" | tee -a $log
+FAKE_QSTAT_SCHEDULER=pbspro \
+    $ANALYSIS_STATUS_PY --qstat $FAKE_QSTAT -u '*' $testdir/pbs1 > $out 2>> $log
+expect_output "Slave jid 2004.wlm01 still running"
+
+
+echo
+echo "$COMPLETE_MSG"
@@ -3,7 +3,6 @@
 """
 import os
 import sys
-import requests
 
 #--- project specific imports
 #
@@ -12,17 +11,12 @@ LIB_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
-from config import rest_services
+from rest import run_details
 
 def main(run_num):
     """main function
     """
-    rest_url = rest_services['run_details']['testing'].replace("run_num", run_num)
-    r = requests.get(rest_url)
-    if r.status_code != requests.codes.ok:
-        r.raise_for_status()
-
-    get_data = r.json()
+    get_data = run_details(run_num, testing=True)
     # if runId missing assume wrong run number
     if 'runId' not in get_data:
         sys.stderr.write("FATAL: Run number not found in ELM\n")